@@ -1,25 +1,303 @@
 import os
-import boto3
 import time
-from openai import OpenAI
 from datetime import datetime, timedelta
 from io import StringIO
 import csv
 import json
+import hashlib
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from query_runner import AthenaQueryRunner, AthenaQueryError
+from llm_cache import cache_from_url
+from llm_client import HedgedLLMClient, LLMUnavailableError
+from llm_batch import AsyncRateLimiter, generate_insights
+from runtime import LazyClient, LazyObject
+import telemetry
 
 # --- CLIENTS ---
-s3 = boto3.client("s3")
-athena = boto3.client("athena")
-client = OpenAI(
-    base_url=os.environ["OPENROUTER_BASE_URL"],
-    api_key=os.environ["OPENROUTER_API_KEY"]
+# Created on first use; openai is only imported once a period actually needs the LLM
+s3 = LazyClient("s3")
+athena = LazyClient("athena")
+
+
+def make_openai_client():
+    from openai import OpenAI
+
+    return OpenAI(
+        base_url=os.environ["OPENROUTER_BASE_URL"],
+        api_key=os.environ["OPENROUTER_API_KEY"]
+    )
+
+
+client = LazyObject(make_openai_client)
+
+REPORT_BUCKET = "sk-shopsense-retail-uploads"
+
+# --- Batch scheduling ---
+# Periods generated at the same time, further capped so that periods in flight times
+# queries per period stays inside the account's Athena concurrent-query quota
+PERIOD_CONCURRENCY = int(os.environ.get("PERIOD_CONCURRENCY", "4"))
+ATHENA_MAX_CONCURRENT_QUERIES = int(os.environ.get("ATHENA_MAX_CONCURRENT_QUERIES", "20"))
+# OpenRouter limits: calls in flight and call starts per minute
+LLM_MAX_CONCURRENT = int(os.environ.get("LLM_MAX_CONCURRENT", "2"))
+LLM_REQUESTS_PER_MINUTE = int(os.environ.get("LLM_REQUESTS_PER_MINUTE", "20"))
+# Don't start a new period with less time than this left before the deadline
+MIN_SECONDS_PER_PERIOD = 60
+CHECKPOINT_PREFIX = "report-checkpoints"
+
+# --- Incremental reporting ---
+# Only periods whose dt= partitions changed (or whose report is missing) are regenerated
+INCREMENTAL_REPORTS = os.environ.get("INCREMENTAL_REPORTS", "false").lower() == "true"
+CLEANED_DATA_BUCKET = os.environ.get("CLEANED_DATA_BUCKET", REPORT_BUCKET)
+CLEANED_DATA_PREFIX = "retail-cleaned-data/"
+MANIFEST_PREFIX = "report-manifests"
+
+
+class RateLimiter:
+    """Caps concurrent calls and spaces call starts to stay under a requests-per-minute limit."""
+
+    def __init__(self, max_concurrent, per_minute):
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.interval = 60.0 / per_minute if per_minute else 0
+        self.lock = threading.Lock()
+        self.next_start = 0.0
+
+    def __enter__(self):
+        self.slots.acquire()
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_start - now
+            self.next_start = max(now, self.next_start) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+        return self
+
+    def __exit__(self, *exc):
+        self.slots.release()
+
+
+llm_limiter = RateLimiter(LLM_MAX_CONCURRENT, LLM_REQUESTS_PER_MINUTE)
+
+# --- LLM models ---
+# Tried in this order until observed latency/success says otherwise (see llm_client)
+PREFERRED_MODELS = [
+    "deepseek/deepseek-chat:free",
+    "google/gemini-2.0-flash-experimental:free",
+    "meta-llama/llama-3.1-8b-instruct:free"
+]
+llm = HedgedLLMClient(client, PREFERRED_MODELS, limiter=llm_limiter)
+
+# "sync" asks the LLM from each period's worker thread; "async" first runs the Athena
+# stage for every period, then sends all prompts through one asyncio batch
+LLM_GENERATION_MODE = os.environ.get("LLM_GENERATION_MODE", "sync").lower()
+LLM_ASYNC_CONCURRENCY = int(os.environ.get("LLM_ASYNC_CONCURRENCY", "8"))
+LLM_TOKENS_PER_MINUTE = int(os.environ.get("LLM_TOKENS_PER_MINUTE", "100000"))
+
+# --- LLM response cache ---
+# s3://bucket/prefix, sqlite:///path.db or a local directory; "off" disables it
+LLM_CACHE = os.environ.get("LLM_CACHE", f"s3://{REPORT_BUCKET}/llm-cache")
+LLM_CACHE_TTL_DAYS = float(os.environ.get("LLM_CACHE_TTL_DAYS", "30"))
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "10000"))
+llm_cache = cache_from_url(
+    LLM_CACHE, s3=s3, ttl_seconds=LLM_CACHE_TTL_DAYS * 86400, max_entries=LLM_CACHE_MAX_ENTRIES
 )
 
-# --- Core logic moved into this new helper function ---
-def generate_and_save_report(database, table, output_location, start_date_str, end_date_str, report_date_str, report_mode):
+# "separate" runs the seven section queries; "fused" computes every section from one scan;
+# "rollup" reads the cleaner's per-day rollup table instead of the row-level data
+REPORT_QUERY_MODE = os.environ.get("REPORT_QUERY_MODE", "separate").lower()
+ATHENA_ROLLUP_TABLE = os.environ.get("ATHENA_ROLLUP_TABLE", "daily_rollup")
+# "athena", or "duckdb" to run the same queries in-process over the cleaned
+# partitions (a local copy of the bucket, or mirrored from S3; see duckdb_runner)
+QUERY_BACKEND = os.environ.get("QUERY_BACKEND", "athena").lower()
+
+# Column headers of each report section, in prompt order (same as the separate queries)
+SECTION_HEADERS = {
+    "top_sellers": ["product_id", "total_sales"],
+    "holiday_sales": ["day_type", "avg_sales"],
+    "weather_impact": ["weather", "temp_range", "avg_sales"],
+    "weekly_trend": ["week", "total_sales"],
+    "discount_impact": ["discount_level", "avg_sales"],
+    "sales_by_city": ["city_id", "total_sales"],
+    "co_purchase_simulation": ["product_id", "product_days"],
+}
+
+
+def make_runner(database, table, output_location, deadline=None):
+    """Query runner for QUERY_BACKEND; both expose run/run_many, metrics and deadline."""
+    if QUERY_BACKEND == "duckdb":
+        from duckdb_runner import DuckDBQueryRunner, DUCKDB_DATA_PATH
+
+        tables = {table: CLEANED_DATA_PREFIX.rstrip("/")}
+        if REPORT_QUERY_MODE == "rollup":
+            tables[ATHENA_ROLLUP_TABLE] = "retail-rollups"
+        return DuckDBQueryRunner(DUCKDB_DATA_PATH or f"s3://{CLEANED_DATA_BUCKET}", tables, deadline=deadline, s3=s3)
+    return AthenaQueryRunner(athena, database, output_location, deadline=deadline, s3=s3)
+
+
+def build_fused_query(table, date_filter):
     """
-    Generates and saves a single report for a specific time period.
+    One scan of the period with GROUPING SETS for every section. The CTE is read
+    once, buckets are computed per row, and the top-10 sections are ranked after
+    aggregation so the result stays small.
     """
+    return f"""
+        WITH base AS (
+            SELECT
+                product_id,
+                city_id,
+                sale_amount,
+                CASE
+                    WHEN coalesce(holiday_flag, 0) >= 0.9 THEN 'Holiday'
+                    ELSE 'Non-Holiday'
+                END AS day_type,
+                CASE WHEN precpt > 5 THEN 'Rainy' ELSE 'Dry' END AS weather,
+                CASE
+                    WHEN avg_temperature < 15 THEN 'Cold'
+                    WHEN avg_temperature BETWEEN 15 AND 30 THEN 'Moderate'
+                    ELSE 'Hot'
+                END AS temp_range,
+                date_trunc('week', DATE_PARSE(dt, '%Y-%m-%d')) AS week,
+                CASE
+                    WHEN discount = 0 THEN 'No Discount'
+                    WHEN discount < 0.5 THEN 'Low Discount'
+                    ELSE 'High Discount'
+                END AS discount_level,
+                CASE WHEN sale_amount > 0 THEN CAST(store_id AS VARCHAR) || dt END AS positive_store_day
+            FROM {table}
+            WHERE {date_filter}
+        ),
+        sections AS (
+            SELECT
+                CASE
+                    WHEN GROUPING(product_id) = 0 THEN 'product'
+                    WHEN GROUPING(day_type) = 0 THEN 'day_type'
+                    WHEN GROUPING(weather) = 0 THEN 'weather'
+                    WHEN GROUPING(week) = 0 THEN 'week'
+                    WHEN GROUPING(discount_level) = 0 THEN 'discount'
+                    ELSE 'city'
+                END AS grouping_set,
+                product_id, city_id, day_type, weather, temp_range, week, discount_level,
+                SUM(sale_amount) AS total_sales,
+                ROUND(SUM(sale_amount), 2) AS total_sales_rounded,
+                ROUND(AVG(sale_amount), 2) AS avg_sales,
+                COUNT(DISTINCT positive_store_day) AS product_days
+            FROM base
+            GROUP BY GROUPING SETS (
+                (product_id), (day_type), (weather, temp_range), (week), (discount_level), (city_id)
+            )
+        ),
+        ranked AS (
+            SELECT
+                *,
+                ROW_NUMBER() OVER (PARTITION BY grouping_set ORDER BY total_sales DESC) AS sales_rank,
+                ROW_NUMBER() OVER (PARTITION BY grouping_set ORDER BY product_days DESC) AS days_rank
+            FROM sections
+        )
+        SELECT *
+        FROM ranked
+        WHERE grouping_set NOT IN ('product', 'city')
+            OR sales_rank <= 10
+            OR (grouping_set = 'product' AND days_rank <= 10 AND product_days > 0);
+    """
+
+
+def split_fused_results(results):
+    """Turns the fused query result into the same `tables` dict the separate queries produce."""
+    rows = results["ResultSet"]["Rows"]
+    headers = [col["VarCharValue"] for col in rows[0]["Data"]] if rows else []
+    records = [dict(zip(headers, [col.get("VarCharValue", "") for col in row["Data"]])) for row in rows[1:]]
+
+    def pick(grouping_set, columns, rank=None, keep=lambda r: True):
+        selected = [r for r in records if r["grouping_set"] == grouping_set and keep(r)]
+        if rank:
+            selected = sorted((r for r in selected if int(r[rank]) <= 10), key=lambda r: int(r[rank]))
+        return [[r[c] for c in columns] for r in selected]
+
+    tables = {
+        "top_sellers": pick("product", ["product_id", "total_sales"], rank="sales_rank"),
+        "holiday_sales": pick("day_type", ["day_type", "avg_sales"]),
+        "weather_impact": pick("weather", ["weather", "temp_range", "avg_sales"]),
+        "weekly_trend": sorted(pick("week", ["week", "total_sales"])),
+        "discount_impact": pick("discount", ["discount_level", "avg_sales"]),
+        "sales_by_city": pick("city", ["city_id", "total_sales_rounded"], rank="sales_rank"),
+        "co_purchase_simulation": pick("product", ["product_id", "product_days"], rank="days_rank",
+                                       keep=lambda r: int(r["product_days"]) > 0),
+    }
+    return {name: [SECTION_HEADERS[name]] + section_rows for name, section_rows in tables.items()}
+
+
+def build_rollup_queries(rollup_table, date_filter):
+    """
+    The seven report sections computed from the daily rollup (see DailyRollup in the
+    data cleaner). Averages are re-derived from summed totals and counts, and
+    product_days sums each day's distinct selling stores, so the answers match the
+    row-level queries.
+    """
+    def avg_by(grain, columns, group_by="1"):
+        return f"""
+            SELECT {columns}, ROUND(SUM(total_sales) / NULLIF(SUM(sales_count), 0), 2) AS avg_sales
+            FROM {rollup_table}
+            WHERE grain = '{grain}' AND {date_filter}
+            GROUP BY {group_by};
+        """
+
+    return {
+        "top_sellers": f"""
+            SELECT key1 AS product_id, SUM(total_sales) AS total_sales
+            FROM {rollup_table}
+            WHERE grain = 'product' AND {date_filter}
+            GROUP BY key1
+            ORDER BY total_sales DESC
+            LIMIT 10;
+        """,
+        "holiday_sales": avg_by("holiday", "key1 AS day_type"),
+        "weather_impact": avg_by("weather", "key1 AS weather, key2 AS temp_range", "1, 2"),
+        "weekly_trend": f"""
+            SELECT
+                date_trunc('week', DATE_PARSE(dt, '%Y-%m-%d')) AS week,
+                SUM(total_sales) AS total_sales
+            FROM {rollup_table}
+            WHERE grain = 'day' AND {date_filter}
+            GROUP BY 1
+            ORDER BY 1;
+        """,
+        "discount_impact": avg_by("discount", "key1 AS discount_level"),
+        "sales_by_city": f"""
+            SELECT key1 AS city_id, ROUND(SUM(total_sales), 2) AS total_sales
+            FROM {rollup_table}
+            WHERE grain = 'city' AND {date_filter}
+            GROUP BY key1
+            ORDER BY total_sales DESC
+            LIMIT 10;
+        """,
+        "co_purchase_simulation": f"""
+            SELECT key1 AS product_id, CAST(SUM(active_stores) AS BIGINT) AS product_days
+            FROM {rollup_table}
+            WHERE grain = 'product' AND active_stores > 0 AND {date_filter}
+            GROUP BY key1
+            ORDER BY product_days DESC
+            LIMIT 10;
+        """,
+    }
+
+
+def results_to_table_data(results):
+    rows = results["ResultSet"]["Rows"]
+    if not rows: return [["No Data"], [""]]
+    headers = [col["VarCharValue"] for col in rows[0]["Data"]]
+    table_data = [headers]
+    for row in rows[1:]:
+        table_data.append([col.get("VarCharValue", "") for col in row["Data"]])
+    return table_data
+
+
+def prepare_report(database, table, output_location, start_date_str, end_date_str, report_date_str, report_mode, runner=None):
+    """
+    Runs the Athena queries for one period, saves its actual-sales CSV and builds
+    the LLM request. Returns (messages, params), or None when the period has no data.
+    """
+    runner = runner or make_runner(database, table, output_location)
     print(f" Generating report for period: {start_date_str} -> {end_date_str}")
 
     date_filter = f"""
@@ -107,54 +385,34 @@ def generate_and_save_report(database, table, output_location, start_date_str, e
         """,
     }
 
-    # Nested helper functions for running queries and processing results
-    def run_query(query):
-        response = athena.start_query_execution(
-            QueryString=query,
-            QueryExecutionContext={"Database": database},
-            ResultConfiguration={"OutputLocation": output_location}
-        )
-        query_id = response["QueryExecutionId"]
-        final_result = None
-        while True:
-            result = athena.get_query_execution(QueryExecutionId=query_id)
-            state = result["QueryExecution"]["Status"]["State"]
-            if state in ["SUCCEEDED", "FAILED", "CANCELLED"]:
-                final_result = result
-                break
-            time.sleep(1)
-        if state != "SUCCEEDED":
-            reason = final_result["QueryExecution"]["Status"].get("StateChangeReason", "No reason provided.")
-            raise Exception(f"Athena query for period {report_date_str} failed: {state}. Reason: {reason}")
-        return athena.get_query_results(QueryExecutionId=query_id)
-
-    def results_to_table_data(results):
-        rows = results["ResultSet"]["Rows"]
-        if not rows: return [["No Data"], [""]]
-        headers = [col["VarCharValue"] for col in rows[0]["Data"]]
-        table_data = [headers]
-        for row in rows[1:]:
-            table_data.append([col.get("VarCharValue", "") for col in row["Data"]])
-        return table_data
-
-    # Run all queries for the period
-    tables = {}
-    for name, query in queries.items():
-        print(f"  -> Running '{name}' sub-query...")
-        result = run_query(query)
-        tables[name] = results_to_table_data(result)
-        
+    try:
+        if REPORT_QUERY_MODE == "fused":
+            print("  -> Running fused single-scan query for all sections...")
+            tables = split_fused_results(runner.run("fused_report", build_fused_query(table, date_filter)))
+        elif REPORT_QUERY_MODE == "rollup":
+            print(f"  -> Running section queries against rollup table '{ATHENA_ROLLUP_TABLE}'...")
+            results = runner.run_many(build_rollup_queries(ATHENA_ROLLUP_TABLE, date_filter))
+            tables = {name: results_to_table_data(result) for name, result in results.items()}
+        else:
+            # Run all queries for the period (concurrently)
+            for name in queries:
+                print(f"  -> Running '{name}' sub-query...")
+            results = runner.run_many(queries)
+            tables = {name: results_to_table_data(result) for name, result in results.items()}
+    except AthenaQueryError as e:
+        raise Exception(f"Athena query for period {report_date_str} failed: {e.state}. Reason: {e.reason}")
+
     # Check if we got any data before proceeding
     if not tables.get("top_sellers") or len(tables["top_sellers"]) <= 1:
         print(f" No data found for period {report_date_str}. Skipping report generation.")
-        return
+        return None
 
     # --- LLM and S3 saving logic ---
     csv_buffer = StringIO()
     writer = csv.writer(csv_buffer)
     writer.writerows(tables["top_sellers"])
     actual_key = f"actual-sales/{report_mode}/actual_{report_date_str}.csv"
-    s3.put_object(Bucket="sk-shopsense-retail-uploads", Key=actual_key, Body=csv_buffer.getvalue())
+    s3.put_object(Bucket=REPORT_BUCKET, Key=actual_key, Body=csv_buffer.getvalue())
     print(f"  -> Saved CSV to {actual_key}")
 
     def markdown_block(table):
@@ -206,28 +464,26 @@ def generate_and_save_report(database, table, output_location, start_date_str, e
         """
     # --- PROMPT ENDS HERE ---
 
-    PREFERRED_MODELS = [
-    "deepseek/deepseek-chat:free",
-    "google/gemini-2.0-flash-experimental:free",
-    "meta-llama/llama-3.1-8b-instruct:free"
+    messages = [
+        {"role": "system", "content": "You are a retail data analyst."},
+        {"role": "user", "content": prompt}
     ]
-    for model in PREFERRED_MODELS:
-        try:
-            summary = client.chat.completions.create(
-                model=model,
-                messages=[
-                {"role": "system", "content": "You are a retail data analyst."},
-                {"role": "user", "content": prompt}
-                ],
-                max_tokens=500,
-                temperature=0.7,
-            )
-            break  # If successful, stop trying others
-        except Exception as e:
-            print(f"Model {model} failed: {e}")
+    params = {"max_tokens": 500, "temperature": 0.7}
+
+    return messages, params
+
+
+def cached_insight(messages, params):
+    """Answer from an earlier run with the same prompt (any preferred model), or None."""
+    if not llm_cache:
+        return None
+    cached_model, insight = llm_cache.get_any(PREFERRED_MODELS, messages, params)
+    if insight is not None:
+        print(f"  -> LLM cache hit ({cached_model})")
+    return insight
+
 
-    insight = summary.choices[0].message.content
-    
+def save_insight(report_mode, report_date_str, insight):
     llm_output = {
         "report_type": report_mode,
         "report_date": report_date_str,
@@ -235,36 +491,217 @@ def generate_and_save_report(database, table, output_location, start_date_str, e
         "llm_summary": insight
     }
     llm_key = f"llm-insights/{report_mode}/report_{report_date_str}.json"
-    s3.put_object(Bucket="sk-shopsense-retail-uploads", Key=llm_key, Body=json.dumps(llm_output, indent=2))
+    s3.put_object(Bucket=REPORT_BUCKET, Key=llm_key, Body=json.dumps(llm_output, indent=2))
     print(f"  -> Saved JSON insight to {llm_key}")
+    return llm_key
 
 
+# --- Core logic moved into this new helper function ---
+def generate_and_save_report(database, table, output_location, start_date_str, end_date_str, report_date_str, report_mode, runner=None):
+    """
+    Generates and saves a single report for a specific time period.
+    Pass a shared query runner to reuse its deadline and polling history across periods.
+    Returns the llm-insights key that was written, or None when the period has no data.
+    """
+    runner = runner or make_runner(database, table, output_location)
+    with telemetry.span("report_period", report_date=report_date_str, mode=report_mode) as span:
+        prepared = prepare_report(database, table, output_location, start_date_str, end_date_str,
+                                  report_date_str, report_mode, runner=runner)
+        if prepared is None:
+            span.set(empty=1)
+            return None
+        messages, params = prepared
+
+        insight = cached_insight(messages, params)
+        span.set(cache_hit=int(insight is not None))
+        if insight is None:
+            try:
+                model, insight = llm.complete(messages, deadline=runner.deadline, **params)
+            except LLMUnavailableError as e:
+                raise Exception(f"All LLM models failed for period {report_date_str}: {e}")
+            print(f"  -> LLM insight from {model}")
+            span.tag(model=model)
+            if llm_cache:
+                llm_cache.put(model, messages, params, insight)
+
+        return save_insight(report_mode, report_date_str, insight)
+
+
+def generate_insights_async(prompts, report_mode, on_saved, deadline=None):
+    """
+    Async LLM stage: sends {report_date: (messages, params)} with LLM_ASYNC_CONCURRENCY
+    requests in flight under the RPM/TPM limits, saving each insight (and calling
+    on_saved(report_date, llm_key)) as soon as it arrives.
+    Returns (completed report dates, {report_date: error}, report dates never started).
+    """
+    def on_result(report_date, model, insight):
+        messages, params = prompts[report_date]
+        print(f"  -> LLM insight for {report_date} from {model}")
+        if llm_cache:
+            llm_cache.put(model, messages, params, insight)
+        on_saved(report_date, save_insight(report_mode, report_date, insight))
+
+    async def run():
+        from openai import AsyncOpenAI
+
+        async_client = AsyncOpenAI(
+            base_url=os.environ["OPENROUTER_BASE_URL"],
+            api_key=os.environ["OPENROUTER_API_KEY"]
+        )
+        try:
+            return await generate_insights(
+                async_client,
+                [(report_date, messages, params) for report_date, (messages, params) in prompts.items()],
+                llm.ordered_models(),
+                on_result,
+                LLM_ASYNC_CONCURRENCY,
+                AsyncRateLimiter(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE),
+                deadline=deadline,
+                stats=llm.stats,
+            )
+        finally:
+            await async_client.close()
+
+    return asyncio.run(run())
+
+
+def build_periods(overall_start_dt, overall_end_dt, report_mode):
+    """Splits the data range into (period_start, period_end, report_date) string tuples."""
+    periods = []
+    current_date = overall_start_dt
+    while current_date <= overall_end_dt:
+        if report_mode == "monthly":
+            period_start = current_date.replace(day=1)
+            # Find the first day of the next month, then subtract one day to get end of current month
+            next_month_start = (period_start + timedelta(days=32)).replace(day=1)
+            period_end = min(next_month_start - timedelta(days=1), overall_end_dt)
+            report_date = period_start.strftime("%Y-%m")
+            # Set the next loop to start at the beginning of the next month
+            current_date = next_month_start
+        else:  # 'weekly' mode
+            period_start = current_date
+            period_end = min(current_date + timedelta(days=6), overall_end_dt)
+            report_date = period_end.strftime("%Y-%m-%d")
+            # Set the next loop to start the day after the current period ends
+            current_date = period_end + timedelta(days=1)
+
+        periods.append((period_start.strftime("%Y-%m-%d"), period_end.strftime("%Y-%m-%d"), report_date))
+    return periods
+
+
+def read_json(key):
+    try:
+        body = s3.get_object(Bucket=REPORT_BUCKET, Key=key)["Body"].read()
+    except s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(body)
+
+
+def write_json(key, data):
+    s3.put_object(Bucket=REPORT_BUCKET, Key=key, Body=json.dumps(data, indent=2))
+
+
+def load_checkpoint(key):
+    checkpoint = read_json(key)
+    return set(checkpoint["completed"]) if checkpoint else set()
+
+
+def save_checkpoint(key, completed):
+    write_json(key, {"completed": sorted(completed), "updated_on": datetime.utcnow().isoformat() + "Z"})
+
+
+def list_partition_files():
+    """Maps each dt= partition value to the 'key:etag' entries of its cleaned files."""
+    partitions = {}
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=CLEANED_DATA_BUCKET, Prefix=CLEANED_DATA_PREFIX):
+        for obj in page.get("Contents", []):
+            partition = obj["Key"][len(CLEANED_DATA_PREFIX):].split("/", 1)[0]
+            if partition.startswith("dt="):
+                partitions.setdefault(partition[3:], []).append(f"{obj['Key']}:{obj['ETag']}")
+    return partitions
+
+
+def period_fingerprint(partitions, period_start, period_end):
+    """Hash of every cleaned file (key + ETag) whose dt falls inside the period."""
+    digest = hashlib.sha256()
+    for dt in sorted(partitions):
+        if period_start <= dt <= period_end:
+            for entry in sorted(partitions[dt]):
+                digest.update(entry.encode("utf-8") + b"\n")
+    return digest.hexdigest()
+
+
+def list_report_dates(report_mode):
+    """Report dates that already have an llm-insights JSON."""
+    prefix = f"llm-insights/{report_mode}/report_"
+    dates = set()
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=REPORT_BUCKET, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            dates.add(obj["Key"][len(prefix):].replace(".json", ""))
+    return dates
+
+
+def run_periods(periods, generate, concurrency, deadline=None, on_done=None):
+    """
+    Calls generate(period_start, period_end, report_date) for every period with at
+    most `concurrency` periods in flight. New periods stop being started after the
+    first failure or when the deadline is close; periods already running finish.
+    on_done(report_date, result) is called with generate's return value as each
+    period finishes. Returns (completed report dates, first error or None,
+    periods never started).
+    """
+    remaining = list(periods)
+    completed = []
+    error = None
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        in_flight = {}
+        while remaining or in_flight:
+            out_of_time = deadline is not None and time.monotonic() > deadline - MIN_SECONDS_PER_PERIOD
+            while remaining and len(in_flight) < concurrency and error is None and not out_of_time:
+                period = remaining.pop(0)
+                in_flight[pool.submit(generate, *period)] = period
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                period = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Period {period[2]} failed: {e}")
+                    error = error or e
+                    continue
+                completed.append(period[2])
+                if on_done:
+                    on_done(period[2], result)
+    return completed, error, remaining
+
+
+@telemetry.instrument("athena_llm_report")
 def lambda_handler(event, context):
     database = os.environ["ATHENA_DATABASE"]
     table = os.environ["ATHENA_TABLE"]
     output_location = os.environ["ATHENA_OUTPUT_LOCATION"]
     report_mode = os.environ.get("REPORT_MODE", "weekly")
 
+    # One runner for the whole batch, stopping with enough time left to return cleanly
+    deadline = None
+    if context is not None and hasattr(context, "get_remaining_time_in_millis"):
+        deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - 30
+    runner = make_runner(database, table, output_location, deadline=deadline)
+
     # --- Function to get the full range of data ---
     def get_full_date_range():
         print("🔍 Finding the full date range of the dataset...")
         query = f"SELECT MIN(dt), MAX(dt) FROM {table} WHERE TRY_CAST(DATE_PARSE(dt, '%Y-%m-%d') AS DATE) IS NOT NULL"
-        response = athena.start_query_execution(
-            QueryString=query,
-            QueryExecutionContext={"Database": database},
-            ResultConfiguration={"OutputLocation": output_location}
-        )
-        query_id = response["QueryExecutionId"]
-        while True:
-            result = athena.get_query_execution(QueryExecutionId=query_id)
-            state = result["QueryExecution"]["Status"]["State"]
-            if state in ["SUCCEEDED", "FAILED", "CANCELLED"]:
-                break
-            time.sleep(1)
-        if state != "SUCCEEDED":
+        try:
+            results = runner.run("date_range", query)
+        except AthenaQueryError:
             raise Exception("Athena query to get MIN/MAX dates failed.")
-            
-        results = athena.get_query_results(QueryExecutionId=query_id)
+
         row = results["ResultSet"]["Rows"][1]["Data"]
         min_date_str = row[0].get("VarCharValue")
         max_date_str = row[1].get("VarCharValue")
@@ -275,34 +712,103 @@ def lambda_handler(event, context):
         print(f"🗓️ Full data range found: {min_date_str} to {max_date_str}")
         return datetime.strptime(min_date_str, "%Y-%m-%d"), datetime.strptime(max_date_str, "%Y-%m-%d")
 
-    # --- Main loop for batch processing ---
+    # --- Batch processing, several periods at a time ---
     overall_start_dt, overall_end_dt = get_full_date_range()
-    
-    current_date = overall_start_dt
-    while current_date <= overall_end_dt:
-        if report_mode == "monthly":
-            period_start = current_date.replace(day=1)
-            # Find the first day of the next month, then subtract one day to get end of current month
-            next_month_start = (period_start + timedelta(days=32)).replace(day=1)
-            period_end = min(next_month_start - timedelta(days=1), overall_end_dt)
-            report_date = period_start.strftime("%Y-%m")
-            # Set the next loop to start at the beginning of the next month
-            current_date = next_month_start
-        else:  # 'weekly' mode
-            period_start = current_date
-            period_end = min(current_date + timedelta(days=6), overall_end_dt)
-            report_date = period_end.strftime("%Y-%m-%d")
-            # Set the next loop to start the day after the current period ends
-            current_date = period_end + timedelta(days=1)
+    periods = build_periods(overall_start_dt, overall_end_dt, report_mode)
+
+    # Periods finished by an interrupted run over the same range are skipped;
+    # pass {"resume": false} in the event to regenerate everything
+    checkpoint_key = f"{CHECKPOINT_PREFIX}/{report_mode}/{overall_start_dt:%Y-%m-%d}_{overall_end_dt:%Y-%m-%d}.json"
+    resume = (event or {}).get("resume", True)
+    completed = load_checkpoint(checkpoint_key) if resume else set()
+    if completed:
+        print(f"Resuming from checkpoint: {len(completed)} of {len(periods)} periods already done.")
+    todo = [period for period in periods if period[2] not in completed]
+
+    # Incremental mode: skip periods whose input files are unchanged since their last report
+    incremental = (event or {}).get("incremental", INCREMENTAL_REPORTS)
+    manifest_key = f"{MANIFEST_PREFIX}/{report_mode}.json"
+    manifest = (read_json(manifest_key) or {}) if incremental else {}
+    if incremental:
+        partitions = list_partition_files()
+        fingerprints = {period[2]: period_fingerprint(partitions, period[0], period[1]) for period in periods}
+        existing_reports = list_report_dates(report_mode)
 
-        # Call the refactored function to do the work for this specific period
-        generate_and_save_report(
+        def needs_report(period):
+            entry = manifest.get(period[2])
+            if not entry or entry["fingerprint"] != fingerprints[period[2]]:
+                return True
+            return entry["has_report"] and period[2] not in existing_reports
+
+        todo = [period for period in todo if needs_report(period)]
+        print(f"Incremental mode: {len(todo)} of {len(periods)} period(s) have new or changed data.")
+
+    queries_per_period = 1 if REPORT_QUERY_MODE == "fused" else len(SECTION_HEADERS)
+    concurrency = max(1, min(PERIOD_CONCURRENCY, ATHENA_MAX_CONCURRENT_QUERIES // queries_per_period))
+    print(f"Generating {len(todo)} {report_mode} period(s), {concurrency} at a time.")
+
+    checkpoint_lock = threading.Lock()
+
+    def mark_done(report_date, llm_key):
+        with checkpoint_lock:
+            completed.add(report_date)
+            save_checkpoint(checkpoint_key, completed)
+            if incremental:
+                manifest[report_date] = {
+                    "fingerprint": fingerprints[report_date],
+                    "has_report": llm_key is not None,
+                    "updated_on": datetime.utcnow().isoformat() + "Z",
+                }
+                write_json(manifest_key, manifest)
+
+    def generate(period_start, period_end, report_date):
+        return generate_and_save_report(
             database, table, output_location,
-            period_start.strftime("%Y-%m-%d"),
-            period_end.strftime("%Y-%m-%d"),
+            period_start,
+            period_end,
             report_date,
-            report_mode
+            report_mode,
+            runner=runner
         )
-    
-    print("Batch processing complete.")
+
+    if LLM_GENERATION_MODE == "async":
+        # Stage 1: Athena for every period; stage 2: one async LLM batch over the prompts
+        prompts = {}
+
+        def prepare(period_start, period_end, report_date):
+            return prepare_report(database, table, output_location, period_start, period_end,
+                                  report_date, report_mode, runner=runner)
+
+        def on_prepared(report_date, prepared):
+            if prepared is None:
+                mark_done(report_date, None)
+                return
+            insight = cached_insight(*prepared)
+            if insight is not None:
+                mark_done(report_date, save_insight(report_mode, report_date, insight))
+            else:
+                prompts[report_date] = prepared
+
+        _, error, not_started = run_periods(todo, prepare, concurrency, deadline=deadline, on_done=on_prepared)
+        if prompts:
+            print(f"Sending {len(prompts)} prompt(s) to the LLM, {LLM_ASYNC_CONCURRENCY} at a time.")
+            _, llm_errors, llm_not_started = generate_insights_async(prompts, report_mode, mark_done, deadline=deadline)
+            error = error or next(iter(llm_errors.values()), None)
+            not_started = not_started + llm_not_started
+    else:
+        _, error, not_started = run_periods(todo, generate, concurrency, deadline=deadline, on_done=mark_done)
+    if error:
+        raise error
+    if not_started:
+        print(f"Stopping early: {len(not_started)} period(s) left, progress saved to {checkpoint_key}.")
+        return {"statusCode": 200, "body": f"Partial batch: {len(not_started)} period(s) remaining. Invoke again to resume."}
+
+    # A finished batch leaves no checkpoint, so the next run starts fresh
+    s3.delete_object(Bucket=REPORT_BUCKET, Key=checkpoint_key)
+
+    scanned_mb = sum(m["bytes_scanned"] for m in runner.metrics) / (1024 * 1024)
+    print(f"Batch processing complete. {len(runner.metrics)} Athena queries, {scanned_mb:.1f} MB scanned.")
+    if llm_cache:
+        print(f"LLM cache: {llm_cache.stats}")
+    print(f"LLM models: {json.dumps(llm.stats_summary())}")
     return {"statusCode": 200, "body": "Batch report generation completed successfully."}
\ No newline at end of file
@@ -0,0 +1,201 @@
+import datetime
+import decimal
+import glob
+import itertools
+import json
+import os
+import time
+from urllib.parse import urlparse
+
+import telemetry
+from query_runner import AthenaQueryError, QueryResultStream
+
+# --- Embedded engine settings ---
+# Local directory laid out like the bucket (retail-cleaned-data/dt=.../...), or
+# s3://bucket to mirror the needed prefixes into DUCKDB_CACHE_DIR first
+DUCKDB_DATA_PATH = os.environ.get("DUCKDB_DATA_PATH", "")
+DUCKDB_CACHE_DIR = os.environ.get("DUCKDB_CACHE_DIR", "/tmp/shopsense-duckdb")
+DUCKDB_THREADS = int(os.environ.get("DUCKDB_THREADS", "0"))  # 0 = DuckDB default
+# Load the partition files into in-memory tables once per runner, instead of views
+# that re-glob and re-parse every file on each query (false for data larger than memory)
+DUCKDB_MATERIALIZE = os.environ.get("DUCKDB_MATERIALIZE", "true").lower() == "true"
+# ETag of every mirrored object, kept in DUCKDB_CACHE_DIR
+MIRROR_INDEX = ".mirror-etags.json"
+
+# Athena (Trino) functions used by the report queries that DuckDB spells differently
+ATHENA_COMPAT_MACROS = [
+    "CREATE OR REPLACE MACRO date_parse(s, fmt) AS try_strptime(s, fmt)",
+]
+
+
+def mirror_from_s3(s3, bucket, prefixes, local_dir):
+    """
+    Makes `local_dir` match the bucket under `prefixes`: objects that are new or
+    whose ETag changed since they were mirrored are downloaded, and local files
+    whose object is gone are deleted. The mirrored ETags are kept in a small JSON
+    index in `local_dir`, so a rewritten object of the same size is still refreshed.
+    """
+    index_path = os.path.join(local_dir, MIRROR_INDEX)
+    try:
+        with open(index_path) as f:
+            etags = json.load(f)
+    except (FileNotFoundError, ValueError):
+        etags = {}
+
+    paginator = s3.get_paginator("list_objects_v2")
+    listed = set()
+    downloaded = 0
+    for prefix in prefixes:
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                key = obj["Key"]
+                listed.add(key)
+                path = os.path.join(local_dir, key)
+                if etags.get(key) == obj["ETag"] and os.path.exists(path):
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                s3.download_file(bucket, key, path)
+                etags[key] = obj["ETag"]
+                downloaded += 1
+
+    removed = 0
+    for prefix in prefixes:
+        root = os.path.join(local_dir, prefix)
+        for dirpath, _, filenames in os.walk(root, topdown=False):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                key = os.path.relpath(path, local_dir).replace(os.sep, "/")
+                if key not in listed:
+                    os.remove(path)
+                    etags.pop(key, None)
+                    removed += 1
+            if os.path.normpath(dirpath) != os.path.normpath(root) and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+
+    os.makedirs(local_dir, exist_ok=True)
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(etags, f)
+    os.replace(index_path + ".tmp", index_path)
+    print(f"DuckDB mirror: {downloaded} new or changed, {removed} deleted file(s) from s3://{bucket}")
+
+
+def to_varchar(value):
+    """Renders a value the way Athena's get_query_results does (None -> no VarCharValue)."""
+    if value is None:
+        return {}
+    if isinstance(value, datetime.datetime):
+        return {"VarCharValue": value.isoformat(sep=" ", timespec="milliseconds")}
+    if isinstance(value, bool):
+        return {"VarCharValue": str(value).lower()}
+    if isinstance(value, (float, decimal.Decimal)):
+        return {"VarCharValue": repr(float(value))}
+    return {"VarCharValue": str(value)}
+
+
+class DuckDBQueryRunner:
+    """
+    Drop-in replacement for AthenaQueryRunner that runs the same SQL in-process
+    with DuckDB over the cleaned CSV/Parquet partitions.
+
+    `tables` maps each table name used in the queries to its prefix under
+    `data_path` (e.g. {"retail_data": "retail-cleaned-data"}); each is loaded into
+    a table once (or a view with DUCKDB_MATERIALIZE=false) with the dt= directory
+    as a string column, like the Glue table. Results come
+    back in get_query_results shape, so results_to_table_data and the report
+    code don't change. Failures raise AthenaQueryError.
+    """
+
+    def __init__(self, data_path, tables, deadline=None, s3=None):
+        import duckdb
+
+        if data_path.startswith("s3://"):
+            bucket = urlparse(data_path).netloc
+            mirror_from_s3(s3, bucket, [prefix.rstrip("/") + "/" for prefix in tables.values()], DUCKDB_CACHE_DIR)
+            data_path = DUCKDB_CACHE_DIR
+
+        self.deadline = deadline
+        self.history = {}
+        self.metrics = []
+        self.ids = itertools.count(1)
+        self.conn = duckdb.connect()
+        if DUCKDB_THREADS:
+            self.conn.execute(f"SET threads = {DUCKDB_THREADS}")
+        for macro in ATHENA_COMPAT_MACROS:
+            self.conn.execute(macro)
+        for table, prefix in tables.items():
+            self._create_table(table, os.path.join(data_path, prefix))
+
+    def _create_table(self, table, root):
+        sources = []
+        # dt stays a string, as in the Glue table, so DATE_PARSE(dt, ...) works the same
+        options = "hive_partitioning = true, hive_types_autocast = false, union_by_name = true"
+        if glob.glob(os.path.join(root, "dt=*", "*.parquet")):
+            sources.append(f"SELECT * FROM read_parquet('{root}/dt=*/*.parquet', {options})")
+        if glob.glob(os.path.join(root, "dt=*", "*.csv")):
+            sources.append(f"SELECT * FROM read_csv('{root}/dt=*/*.csv', {options})")
+        if not sources:
+            print(f"DuckDB: no partitions under {root}, table '{table}' is unavailable")
+            return
+        kind = "TABLE" if DUCKDB_MATERIALIZE else "VIEW"
+        start = time.monotonic()
+        self.conn.execute(f'CREATE OR REPLACE {kind} "{table}" AS ' + " UNION ALL BY NAME ".join(sources))
+        if DUCKDB_MATERIALIZE:
+            rows = self.conn.execute(f'SELECT count(*) FROM "{table}"').fetchone()[0]
+            print(f"DuckDB: loaded {rows} rows into '{table}' in {time.monotonic() - start:.2f}s")
+
+    def run(self, name, query):
+        return self.run_many({name: query})[name]
+
+    def stream(self, name, query, typed=True, from_s3=False, batch_rows=10000):
+        """Same contract as AthenaQueryRunner.stream; rows are fetched in batches (from_s3 is ignored)."""
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise AthenaQueryError(name, f"duckdb-{next(self.ids)}", "TIMED_OUT", "overall deadline reached")
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(query.strip().rstrip(";"))
+        except Exception as e:
+            raise AthenaQueryError(name, f"duckdb-{next(self.ids)}", "FAILED", str(e))
+        columns = [column[0] for column in cursor.description]
+        # DuckDB type names in Athena's spelling (DECIMAL(18,2) -> decimal)
+        types = [str(column[1]).split("(")[0].lower() for column in cursor.description]
+
+        def rows():
+            while True:
+                batch = cursor.fetchmany(batch_rows)
+                if not batch:
+                    return
+                for row in batch:
+                    yield list(row) if typed else [to_varchar(value).get("VarCharValue") for value in row]
+
+        return QueryResultStream(columns, types, rows())
+
+    def run_many(self, queries):
+        results = {}
+        for name, query in queries.items():
+            query_id = f"duckdb-{next(self.ids)}"
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                raise AthenaQueryError(name, query_id, "TIMED_OUT", "overall deadline reached")
+            start = time.monotonic()
+            try:
+                cursor = self.conn.cursor()
+                cursor.execute(query.strip().rstrip(";"))
+                columns = [column[0] for column in cursor.description]
+                rows = cursor.fetchall()
+            except Exception as e:
+                raise AthenaQueryError(name, query_id, "FAILED", str(e))
+            wall_ms = int((time.monotonic() - start) * 1000)
+            self.metrics.append({
+                "name": name, "query_id": query_id, "state": "SUCCEEDED",
+                "wall_ms": wall_ms, "queue_ms": 0, "planning_ms": 0, "engine_ms": wall_ms,
+                "bytes_scanned": 0, "polls": 0,
+            })
+            telemetry.emit("athena_query", {"wall_ms": wall_ms, "engine_ms": wall_ms, "rows": len(rows)},
+                           query=name, query_id=query_id, state="SUCCEEDED", backend="duckdb")
+            print(f"     '{name}' SUCCEEDED in {wall_ms / 1000:.3f}s (duckdb, {len(rows)} rows)")
+            results[name] = {
+                "ResultSet": {
+                    "Rows": [{"Data": [{"VarCharValue": column} for column in columns]}]
+                    + [{"Data": [to_varchar(value) for value in row]} for row in rows]
+                }
+            }
+        return results
@@ -0,0 +1,106 @@
+import asyncio
+import time
+from collections import deque
+
+from llm_client import LLM_CALL_TIMEOUT_SECONDS, record_call
+
+
+def estimate_tokens(messages, max_tokens):
+    """Rough token cost of a request: ~4 characters per prompt token plus the completion budget."""
+    return sum(len(message["content"]) for message in messages) // 4 + (max_tokens or 0)
+
+
+class AsyncRateLimiter:
+    """
+    Sliding one-minute window over request starts and their estimated tokens.
+    acquire() waits until both the requests-per-minute and tokens-per-minute
+    budgets have room for the next request.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window = deque()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                while self.window and now - self.window[0][0] >= 60:
+                    self.window.popleft()
+                used = sum(cost for _, cost in self.window)
+                rpm_ok = not self.requests_per_minute or len(self.window) < self.requests_per_minute
+                # A single request bigger than the whole budget still goes through once the window is empty
+                tpm_ok = not self.tokens_per_minute or not self.window or used + tokens <= self.tokens_per_minute
+                if rpm_ok and tpm_ok:
+                    self.window.append((now, tokens))
+                    return
+                await asyncio.sleep(max(0.05, 60 - (now - self.window[0][0])))
+
+
+async def generate_insights(async_client, jobs, models, on_result, concurrency, limiter,
+                            deadline=None, call_timeout=LLM_CALL_TIMEOUT_SECONDS, stats=None):
+    """
+    Sends every job (key, messages, params) to the LLM with `concurrency` requests
+    in flight, trying `models` in order for each job. on_result(key, model, content)
+    runs in a worker thread as soon as a job's answer arrives, so results are saved
+    as they complete. No new job is started past `deadline` (a time.monotonic()
+    value). `stats` ({model: ModelStats}) is updated with each call's outcome.
+
+    Returns (completed keys, {key: error} for failed jobs, keys never started).
+    """
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+    completed, errors = [], {}
+
+    async def call(model, messages, params):
+        start = time.monotonic()
+        try:
+            response = await asyncio.wait_for(
+                async_client.chat.completions.create(model=model, messages=messages, **params),
+                timeout=call_timeout,
+            )
+            content = response.choices[0].message.content
+            if not content or not content.strip():
+                raise ValueError("empty response")
+        except Exception as e:
+            if stats and model in stats:
+                stats[model].record(time.monotonic() - start, ok=False)
+            record_call(model, time.monotonic() - start, error=e, mode="async")
+            raise
+        if stats and model in stats:
+            stats[model].record(time.monotonic() - start, ok=True)
+        record_call(model, time.monotonic() - start, response, mode="async")
+        return content
+
+    async def worker():
+        while not queue.empty():
+            if deadline is not None and time.monotonic() > deadline - call_timeout:
+                return
+            key, messages, params = queue.get_nowait()
+            failures = []
+            for model in models:
+                await limiter.acquire(estimate_tokens(messages, params.get("max_tokens")))
+                try:
+                    content = await call(model, messages, params)
+                except Exception as e:
+                    print(f"Model {model} failed for {key}: {e}")
+                    failures.append(f"{model}: {e}")
+                    continue
+                try:
+                    await asyncio.to_thread(on_result, key, model, content)
+                    completed.append(key)
+                except Exception as e:
+                    print(f"Saving insight for {key} failed: {e}")
+                    errors[key] = e
+                break
+            else:
+                errors[key] = Exception(f"All LLM models failed for period {key}: {'; '.join(failures)}")
+
+    await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, len(jobs))))))
+    not_started = []
+    while not queue.empty():
+        not_started.append(queue.get_nowait()[0])
+    return completed, errors, not_started
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+
+class DirectoryCacheBackend:
+    """One JSON file per entry in a local directory (handy for tests and local runs)."""
+
+    def __init__(self, path, max_entries=None):
+        self.path = path
+        self.max_entries = max_entries
+        os.makedirs(path, exist_ok=True)
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.path, f"{key}.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, entry):
+        tmp_path = os.path.join(self.path, f".{key}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, os.path.join(self.path, f"{key}.json"))
+        self._evict()
+
+    def delete(self, key):
+        try:
+            os.remove(os.path.join(self.path, f"{key}.json"))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        if not self.max_entries:
+            return
+        files = [os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith(".json")]
+        if len(files) <= self.max_entries:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.max_entries]:
+            os.remove(path)
+
+
+class SQLiteCacheBackend:
+    """Entries in a single SQLite table, oldest evicted first once max_entries is exceeded."""
+
+    def __init__(self, path, max_entries=None):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, created_at REAL, entry TEXT)"
+        )
+        self.conn.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT entry FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, entry):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, created_at, entry) VALUES (?, ?, ?)",
+                (key, entry["created_at"], json.dumps(entry)),
+            )
+            if self.max_entries:
+                self.conn.execute(
+                    "DELETE FROM llm_cache WHERE key NOT IN "
+                    "(SELECT key FROM llm_cache ORDER BY created_at DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+            self.conn.commit()
+
+    def delete(self, key):
+        with self.lock:
+            self.conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            self.conn.commit()
+
+
+class S3CacheBackend:
+    """
+    One JSON object per entry under an S3 prefix. Expired entries are ignored on
+    read; size-based cleanup of the prefix is left to an S3 lifecycle rule.
+    """
+
+    def __init__(self, s3, bucket, prefix):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def _key(self, key):
+        return f"{self.prefix}/{key}.json"
+
+    def get(self, key):
+        try:
+            body = self.s3.get_object(Bucket=self.bucket, Key=self._key(key))["Body"].read()
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        return json.loads(body)
+
+    def put(self, key, entry):
+        self.s3.put_object(Bucket=self.bucket, Key=self._key(key), Body=json.dumps(entry))
+
+    def delete(self, key):
+        self.s3.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+
+class LLMCache:
+    """
+    Content-addressed cache of LLM responses, keyed by a hash of the model, the
+    messages and the generation parameters, so an identical prompt never costs a
+    second round-trip. Entries older than ttl_seconds are treated as misses.
+    Backend errors are logged and counted but never fail the caller.
+    """
+
+    def __init__(self, backend, ttl_seconds=None):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "expired": 0, "errors": 0}
+
+    @staticmethod
+    def make_key(model, messages, params):
+        payload = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def _lookup(self, model, messages, params):
+        key = self.make_key(model, messages, params)
+        try:
+            entry = self.backend.get(key)
+            if entry and self.ttl_seconds and time.time() - entry["created_at"] > self.ttl_seconds:
+                self._count("expired")
+                self.backend.delete(key)
+                entry = None
+        except Exception as e:
+            print(f"LLM cache read failed: {e}")
+            self._count("errors")
+            entry = None
+        return entry["content"] if entry else None
+
+    def get(self, model, messages, params):
+        content = self._lookup(model, messages, params)
+        self._count("hits" if content is not None else "misses")
+        return content
+
+    def get_any(self, models, messages, params):
+        """First cached answer for any of `models` (in order) as (model, content); counts one hit or miss."""
+        for model in models:
+            content = self._lookup(model, messages, params)
+            if content is not None:
+                self._count("hits")
+                return model, content
+        self._count("misses")
+        return None, None
+
+    def put(self, model, messages, params, content):
+        entry = {"model": model, "params": params, "created_at": time.time(), "content": content}
+        try:
+            self.backend.put(self.make_key(model, messages, params), entry)
+        except Exception as e:
+            print(f"LLM cache write failed: {e}")
+            self._count("errors")
+            return
+        self._count("writes")
+
+
+def cache_from_url(url, s3=None, ttl_seconds=None, max_entries=None):
+    """
+    Builds an LLMCache from a location string:
+      s3://bucket/prefix     -> S3CacheBackend (production)
+      sqlite:///path/to.db   -> SQLiteCacheBackend
+      /some/dir or file://.. -> DirectoryCacheBackend
+    Returns None for "", "off" or "none".
+    """
+    if not url or url.lower() in ("off", "none"):
+        return None
+    parsed = urlparse(url)
+    if parsed.scheme == "s3":
+        backend = S3CacheBackend(s3, parsed.netloc, parsed.path)
+    elif parsed.scheme == "sqlite":
+        backend = SQLiteCacheBackend(parsed.path, max_entries=max_entries)
+    else:
+        backend = DirectoryCacheBackend(parsed.path if parsed.scheme == "file" else url, max_entries=max_entries)
+    return LLMCache(backend, ttl_seconds=ttl_seconds)
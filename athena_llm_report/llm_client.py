@@ -0,0 +1,226 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import nullcontext
+
+import telemetry
+
+# --- Deadlines, hedging and retries ---
+LLM_CALL_TIMEOUT_SECONDS = float(os.environ.get("LLM_CALL_TIMEOUT_SECONDS", "60"))
+LLM_TOTAL_TIMEOUT_SECONDS = float(os.environ.get("LLM_TOTAL_TIMEOUT_SECONDS", "150"))
+# Fire the next model once the current one is slower than this percentile of its history
+LLM_HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE", "0.9"))
+# Hedge delay for a model we have no latency history for yet
+LLM_HEDGE_DELAY_SECONDS = float(os.environ.get("LLM_HEDGE_DELAY_SECONDS", "20"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "1"))
+LLM_RETRY_BASE_SECONDS = 1.0
+# Observations needed before a model's own history drives hedging and ordering
+MIN_SAMPLES = 5
+
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 30, 60, float("inf")]
+
+
+def record_call(model, seconds, response=None, error=None, mode="sync"):
+    """Emits an llm_call metric with the latency and token usage of one request."""
+    usage = getattr(response, "usage", None)
+    telemetry.emit("llm_call", {
+        "latency_ms": round(seconds * 1000),
+        "prompt_tokens": getattr(usage, "prompt_tokens", None),
+        "completion_tokens": getattr(usage, "completion_tokens", None),
+        "error": int(error is not None),
+    }, model=model, mode=mode, reason=str(error) if error is not None else None)
+
+
+class LLMUnavailableError(Exception):
+    """Every model failed or the deadline passed before any of them answered."""
+
+
+class ModelStats:
+    """Rolling latency history plus success/failure counts and a latency histogram for one model."""
+
+    def __init__(self, window=100):
+        self.latencies = deque(maxlen=window)
+        self.successes = 0
+        self.failures = 0
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+        self.lock = threading.Lock()
+
+    def record(self, latency, ok):
+        with self.lock:
+            if ok:
+                self.successes += 1
+                self.latencies.append(latency)
+                bucket = next(i for i, upper in enumerate(LATENCY_BUCKETS) if latency <= upper)
+                self.histogram[bucket] += 1
+            else:
+                self.failures += 1
+
+    @property
+    def samples(self):
+        return self.successes + self.failures
+
+    @property
+    def success_rate(self):
+        return self.successes / self.samples if self.samples else 1.0
+
+    def percentile(self, p):
+        with self.lock:
+            ordered = sorted(self.latencies)
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    def summary(self):
+        p50, p90 = self.percentile(0.5), self.percentile(0.9)
+        return {
+            "successes": self.successes,
+            "failures": self.failures,
+            "p50_seconds": round(p50, 2) if p50 is not None else None,
+            "p90_seconds": round(p90, 2) if p90 is not None else None,
+            "histogram": {f"<={upper}s": count for upper, count in zip(LATENCY_BUCKETS, self.histogram) if count},
+        }
+
+
+class HedgedLLMClient:
+    """
+    Races the preferred models under one deadline.
+
+    The best-ranked model is called first; if it hasn't answered by its hedge
+    delay (a latency percentile from its own history), the next model is fired
+    as well and the first non-empty answer wins. A model that errors out hands
+    over to the next one immediately. Every call has its own timeout and is
+    retried a bounded number of times with jittered backoff. Models are ranked
+    by observed median latency over success rate, falling back to preference
+    order until enough calls have been seen. Once a model wins, the calls that
+    lost give their limiter slot back straight away.
+    """
+
+    def __init__(self, client, models, limiter=None, call_timeout=LLM_CALL_TIMEOUT_SECONDS,
+                 total_timeout=LLM_TOTAL_TIMEOUT_SECONDS, max_retries=LLM_MAX_RETRIES):
+        self.client = client
+        self.models = list(models)
+        self.limiter = limiter
+        self.call_timeout = call_timeout
+        self.total_timeout = total_timeout
+        self.max_retries = max_retries
+        self.stats = {model: ModelStats() for model in self.models}
+        self.pool = ThreadPoolExecutor(max_workers=4 * len(self.models))
+        # Requests run here so a call that lost the race can stop waiting for its own
+        self.requests = ThreadPoolExecutor(max_workers=4 * len(self.models))
+
+    def ordered_models(self):
+        def expected_cost(indexed):
+            index, model = indexed
+            stats = self.stats[model]
+            if stats.samples < MIN_SAMPLES:
+                # Unknown models keep their place in the preference list
+                return LLM_HEDGE_DELAY_SECONDS * (index + 1)
+            p50 = stats.percentile(0.5) or self.call_timeout
+            return p50 / max(stats.success_rate, 0.01)
+
+        return [model for _, model in sorted(enumerate(self.models), key=expected_cost)]
+
+    def hedge_delay(self, model):
+        stats = self.stats[model]
+        if stats.successes < MIN_SAMPLES:
+            return LLM_HEDGE_DELAY_SECONDS
+        return stats.percentile(LLM_HEDGE_PERCENTILE)
+
+    def _request(self, model, messages, params, deadline):
+        """
+        Sends one request, with its timeout taken from when it actually starts.
+        Latency is recorded even when the race was settled in the meantime.
+        """
+        timeout = min(self.call_timeout, deadline - time.monotonic())
+        if timeout <= 0:
+            raise TimeoutError(f"{model}: deadline reached")
+        start = time.monotonic()
+        try:
+            response = self.client.chat.completions.create(
+                model=model, messages=messages, timeout=timeout, **params
+            )
+            content = response.choices[0].message.content
+            if not content or not content.strip():
+                raise ValueError("empty response")
+        except Exception as e:
+            self.stats[model].record(time.monotonic() - start, ok=False)
+            record_call(model, time.monotonic() - start, error=e)
+            raise
+        self.stats[model].record(time.monotonic() - start, ok=True)
+        record_call(model, time.monotonic() - start, response)
+        return content
+
+    def _call(self, model, messages, params, deadline, settled):
+        """
+        One model with bounded, jittered retries. Returns non-empty content or raises.
+        `settled` is resolved by complete() once the race is over: a request still
+        in flight then releases the limiter slot and is left to finish on its own.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.limiter or nullcontext():
+                    if settled.done():
+                        raise TimeoutError(f"{model}: another model already answered")
+                    request = self.requests.submit(self._request, model, messages, params, deadline)
+                    wait([request, settled], return_when=FIRST_COMPLETED)
+                    if not request.done():
+                        raise TimeoutError(f"{model}: another model answered first")
+                return request.result()
+            except Exception as e:
+                if settled.done():
+                    raise
+                print(f"Model {model} failed (attempt {attempt + 1}/{self.max_retries + 1}): {e}")
+                if attempt == self.max_retries or time.monotonic() >= deadline:
+                    raise
+                backoff = LLM_RETRY_BASE_SECONDS * (2 ** attempt) * random.uniform(0.5, 1.5)
+                wait([settled], timeout=max(0, min(backoff, deadline - time.monotonic())))
+
+    def complete(self, messages, deadline=None, **params):
+        """Returns (model, content) from the first model to give a good answer."""
+        call_deadline = time.monotonic() + self.total_timeout
+        if deadline is not None:
+            call_deadline = min(call_deadline, deadline)
+
+        queue = self.ordered_models()
+        in_flight = {}
+        errors = []
+        settled = Future()
+
+        def launch():
+            model = queue.pop(0)
+            in_flight[self.pool.submit(self._call, model, messages, params, call_deadline, settled)] = model
+            return model
+
+        last_launched = launch()
+        try:
+            while in_flight:
+                remaining = call_deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                timeout = min(remaining, self.hedge_delay(last_launched)) if queue else remaining
+                done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    model = in_flight.pop(future)
+                    try:
+                        return model, future.result()
+                    except Exception as e:
+                        errors.append(f"{model}: {e}")
+
+                # Hedge on a slow model, or fall back straight away when the only one in flight failed
+                if queue and (not done or not in_flight):
+                    if not done:
+                        print(f"Model {last_launched} slower than its hedge delay, also trying {queue[0]}")
+                    last_launched = launch()
+        finally:
+            # Calls that lost (or outlived the deadline) hand their limiter slots back;
+            # their requests finish on their own per-call timeout
+            settled.set_result(True)
+
+        raise LLMUnavailableError("; ".join(errors) or "deadline reached before any model answered")
+
+    def stats_summary(self):
+        return {model: stats.summary() for model, stats in self.stats.items()}
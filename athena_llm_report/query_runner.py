@@ -0,0 +1,289 @@
+import codecs
+import csv
+import datetime
+import decimal
+import itertools
+import os
+import time
+from urllib.parse import urlparse
+
+import telemetry
+
+TERMINAL_STATES = ["SUCCEEDED", "FAILED", "CANCELLED"]
+
+# --- Polling / deadline settings ---
+ATHENA_QUERY_TIMEOUT_SECONDS = float(os.environ.get("ATHENA_QUERY_TIMEOUT_SECONDS", "300"))
+ATHENA_MIN_POLL_SECONDS = float(os.environ.get("ATHENA_MIN_POLL_SECONDS", "0.2"))
+ATHENA_MAX_POLL_SECONDS = float(os.environ.get("ATHENA_MAX_POLL_SECONDS", "5"))
+# While a query runs, wait this fraction of its elapsed engine time before polling again
+ATHENA_POLL_BACKOFF = float(os.environ.get("ATHENA_POLL_BACKOFF", "0.25"))
+
+
+# Athena result types -> Python values (anything not listed stays a string)
+ATHENA_TYPE_PARSERS = {
+    "tinyint": int,
+    "smallint": int,
+    "integer": int,
+    "bigint": int,
+    "float": float,
+    "real": float,
+    "double": float,
+    "decimal": decimal.Decimal,
+    "boolean": lambda text: text == "true",
+    "date": datetime.date.fromisoformat,
+    "timestamp": lambda text: datetime.datetime.strptime(text, "%Y-%m-%d %H:%M:%S.%f"),
+}
+
+
+class QueryResultStream:
+    """
+    Rows of a finished query, produced lazily. `columns` and `types` are known
+    up front; iterating yields one list per row (typed values, or the raw
+    strings when typed=False, with None for NULL). Can be iterated once.
+    """
+
+    def __init__(self, columns, types, rows):
+        self.columns = columns
+        self.types = types
+        self.rows = rows
+
+    def __iter__(self):
+        return self.rows
+
+    def dicts(self):
+        for row in self.rows:
+            yield dict(zip(self.columns, row))
+
+
+def convert_row(values, types, typed):
+    if not typed:
+        return values
+    return [
+        None if value is None else ATHENA_TYPE_PARSERS.get(athena_type, str)(value)
+        for value, athena_type in zip(values, types)
+    ]
+
+
+def read_result_pages(athena, query_id, typed=True, page_size=1000):
+    """Pages through get_query_results with NextToken, one page in memory at a time."""
+    paginator = athena.get_paginator("get_query_results")
+    pages = iter(paginator.paginate(QueryExecutionId=query_id, PaginationConfig={"PageSize": page_size}))
+    first = next(pages)
+    column_info = first["ResultSet"]["ResultSetMetadata"]["ColumnInfo"]
+    columns = [column["Name"] for column in column_info]
+    types = [column["Type"].lower() for column in column_info]
+
+    def rows():
+        for page_no, page in enumerate(itertools.chain([first], pages)):
+            page_rows = page["ResultSet"]["Rows"]
+            for row_no, row in enumerate(page_rows):
+                values = [datum.get("VarCharValue") for datum in row["Data"]]
+                # SELECT results repeat the column names as the first row
+                if page_no == 0 and row_no == 0 and values == columns:
+                    continue
+                yield convert_row(values, types, typed)
+
+    return QueryResultStream(columns, types, rows())
+
+
+def read_result_csv(athena, s3, query_id, typed=True):
+    """
+    Streams the CSV Athena wrote to the query's output location, which is much
+    faster than get_query_results for large results. The CSV can't tell NULL from
+    an empty string, so empty fields are None except in string columns.
+    """
+    execution = athena.get_query_execution(QueryExecutionId=query_id)["QueryExecution"]
+    location = urlparse(execution["ResultConfiguration"]["OutputLocation"])
+    metadata = athena.get_query_results(QueryExecutionId=query_id, MaxResults=1)["ResultSet"]["ResultSetMetadata"]
+    types = [column["Type"].lower() for column in metadata["ColumnInfo"]]
+
+    body = s3.get_object(Bucket=location.netloc, Key=location.path.lstrip("/"))["Body"]
+    reader = csv.reader(codecs.getreader("utf-8")(body))
+    columns = next(reader, [])
+
+    def rows():
+        try:
+            for values in reader:
+                values = [
+                    None if value == "" and athena_type not in ("varchar", "char", "string") else value
+                    for value, athena_type in zip(values, types)
+                ]
+                yield convert_row(values, types, typed)
+        finally:
+            body.close()
+
+    return QueryResultStream(columns, types, rows())
+
+
+class AthenaQueryError(Exception):
+    """A query finished in FAILED/CANCELLED state, ran past its deadline or had no status from Athena."""
+
+    def __init__(self, name, query_id, state, reason):
+        super().__init__(f"Query '{name}' ({query_id}) {state}: {reason}")
+        self.name = name
+        self.query_id = query_id
+        self.state = state
+        self.reason = reason
+
+
+class AthenaQueryRunner:
+    """
+    Starts Athena queries, waits for them together and records timing metrics.
+
+    Polling is adaptive: a query that has been running for a while is polled less
+    often, and a query seen before (same name) is not polled again until it is
+    close to its previous engine time. Each query has its own timeout, and the
+    runner as a whole stops at `deadline` (a time.monotonic() value); any query
+    still running at either limit is cancelled.
+    """
+
+    def __init__(self, athena, database, output_location, query_timeout=ATHENA_QUERY_TIMEOUT_SECONDS, deadline=None, s3=None):
+        self.athena = athena
+        self.s3 = s3
+        self.database = database
+        self.output_location = output_location
+        self.query_timeout = query_timeout
+        self.deadline = deadline
+        self.history = {}
+        self.metrics = []
+
+    def run(self, name, query):
+        return self.run_many({name: query})[name]
+
+    def run_many(self, queries):
+        """
+        Runs {name: sql} concurrently and returns {name: get_query_results response}
+        in the same order (first page only, which covers the LIMITed report queries).
+        Raises AthenaQueryError for the first failed query (in `queries` order)
+        after cancelling the others.
+        """
+        query_ids = self.execute(queries)
+        results = {}
+        for name in queries:
+            with telemetry.span("athena_fetch", query=name, query_id=query_ids[name]) as span:
+                results[name] = self.athena.get_query_results(QueryExecutionId=query_ids[name])
+                span.set(rows=len(results[name]["ResultSet"]["Rows"]))
+        return results
+
+    def stream(self, name, query, typed=True, from_s3=False):
+        """
+        Runs one query and returns a QueryResultStream over all of its rows, paged
+        lazily through the API, or read from the result CSV in S3 with from_s3=True.
+        """
+        query_id = self.execute({name: query})[name]
+        if from_s3:
+            return read_result_csv(self.athena, self.s3, query_id, typed=typed)
+        return read_result_pages(self.athena, query_id, typed=typed)
+
+    def execute(self, queries):
+        """Runs {name: sql} concurrently until all succeed; returns {name: query_id}."""
+        started = {}
+        finished = {}
+        try:
+            # Inside the try so a failed submit still cancels the queries already started
+            for name, query in queries.items():
+                response = self.athena.start_query_execution(
+                    QueryString=query,
+                    QueryExecutionContext={"Database": self.database},
+                    ResultConfiguration={"OutputLocation": self.output_location}
+                )
+                started[name] = {"query_id": response["QueryExecutionId"], "start": time.monotonic(), "polls": 0}
+
+            names_by_id = {info["query_id"]: name for name, info in started.items()}
+            running = {}
+            pending = set(names_by_id)
+            while pending:
+                pending_ids = sorted(pending)
+                # batch_get_query_execution accepts at most 50 ids per call
+                for i in range(0, len(pending_ids), 50):
+                    batch = self.athena.batch_get_query_execution(QueryExecutionIds=pending_ids[i:i + 50])
+                    for unprocessed in batch.get("UnprocessedQueryExecutionIds", []):
+                        name = names_by_id[unprocessed["QueryExecutionId"]]
+                        reason = f"{unprocessed.get('ErrorCode', 'Unknown')}: {unprocessed.get('ErrorMessage', 'No reason provided.')}"
+                        print(f"     Athena could not report status for '{name}' ({unprocessed['QueryExecutionId']}): {reason}")
+                        raise AthenaQueryError(name, unprocessed["QueryExecutionId"], "UNPROCESSED", reason)
+                    for execution in batch["QueryExecutions"]:
+                        name = names_by_id[execution["QueryExecutionId"]]
+                        started[name]["polls"] += 1
+                        if execution["Status"]["State"] in TERMINAL_STATES:
+                            finished[name] = execution
+                            running.pop(name, None)
+                            pending.discard(execution["QueryExecutionId"])
+                            self._record(name, started[name], execution)
+                        else:
+                            running[name] = execution
+
+                failed = [name for name in queries if name in finished and finished[name]["Status"]["State"] != "SUCCEEDED"]
+                if failed:
+                    status = finished[failed[0]]["Status"]
+                    raise AthenaQueryError(failed[0], started[failed[0]]["query_id"], status["State"],
+                                           status.get("StateChangeReason", "No reason provided."))
+
+                now = time.monotonic()
+                for name in running:
+                    if now - started[name]["start"] > self.query_timeout:
+                        raise AthenaQueryError(name, started[name]["query_id"], "TIMED_OUT",
+                                               f"exceeded per-query timeout of {self.query_timeout:.0f}s")
+                if running and self.deadline is not None and now >= self.deadline:
+                    name = next(iter(running))
+                    raise AthenaQueryError(name, started[name]["query_id"], "TIMED_OUT",
+                                           "overall deadline reached")
+
+                if pending:
+                    time.sleep(self._next_delay(running, started, now))
+        finally:
+            # Never leave queries running (and billing) once we've given up on the batch
+            for name, info in started.items():
+                if name not in finished:
+                    try:
+                        self.athena.stop_query_execution(QueryExecutionId=info["query_id"])
+                    except Exception as e:
+                        print(f"     Could not cancel '{name}': {e}")
+
+        return {name: info["query_id"] for name, info in started.items()}
+
+    def _next_delay(self, running, started, now):
+        delays = []
+        for name, execution in running.items():
+            stats = execution.get("Statistics", {})
+            # Engine time once Athena reports it, wall time since submission while still queued
+            elapsed_s = stats.get("EngineExecutionTimeInMillis", 0) / 1000 or now - started[name]["start"]
+            expected_s = self.history.get(name)
+            if expected_s and expected_s > elapsed_s:
+                # Seen this query before: sleep until it's close to done
+                delays.append((expected_s - elapsed_s) * 0.8)
+            else:
+                delays.append(elapsed_s * ATHENA_POLL_BACKOFF)
+
+        delay = min(delays) if delays else ATHENA_MIN_POLL_SECONDS
+        delay = max(ATHENA_MIN_POLL_SECONDS, min(delay, ATHENA_MAX_POLL_SECONDS))
+        if self.deadline is not None:
+            delay = min(delay, max(self.deadline - now, 0))
+        return delay
+
+    def _record(self, name, info, execution):
+        stats = execution.get("Statistics", {})
+        metric = {
+            "name": name,
+            "query_id": info["query_id"],
+            "state": execution["Status"]["State"],
+            "wall_ms": int((time.monotonic() - info["start"]) * 1000),
+            "queue_ms": stats.get("QueryQueueTimeInMillis", 0),
+            "planning_ms": stats.get("QueryPlanningTimeInMillis", 0),
+            "engine_ms": stats.get("EngineExecutionTimeInMillis", 0),
+            "bytes_scanned": stats.get("DataScannedInBytes", 0),
+            "polls": info["polls"],
+        }
+        self.metrics.append(metric)
+        telemetry.emit(
+            "athena_query",
+            {key: metric[key] for key in ("wall_ms", "queue_ms", "planning_ms", "engine_ms", "bytes_scanned", "polls")},
+            query=name, query_id=metric["query_id"], state=metric["state"], backend="athena",
+        )
+        if metric["state"] == "SUCCEEDED":
+            self.history[name] = metric["engine_ms"] / 1000
+        print(
+            f"     '{name}' {metric['state']} in {metric['wall_ms'] / 1000:.2f}s "
+            f"(queue {metric['queue_ms'] / 1000:.2f}s, engine {metric['engine_ms'] / 1000:.2f}s, "
+            f"{metric['bytes_scanned'] / (1024 * 1024):.1f} MB scanned, {metric['polls']} polls)"
+        )
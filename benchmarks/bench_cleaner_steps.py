@@ -0,0 +1,104 @@
+"""
+Benchmark for Steps 6-8 of the data cleaner: the column-by-column outlier,
+fill and string passes vs the whole-frame engine (numeric_stats/fill_numeric
+and categorical clean_strings). Checks both give identical frames, then reports
+CPU time and peak traced memory per million rows.
+
+Usage:
+    python benchmarks/bench_cleaner_steps.py [rows]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("METRICS_SAMPLE_RATE", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "shared"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "data_cleaner"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from data_cleaner import clean_strings, coerce_numeric, fill_numeric, numeric_stats, standardize_columns  # noqa: E402
+from synthetic_data import generate, parse_rows  # noqa: E402
+
+
+def legacy_steps(df):
+    """Steps 6-8 as the cleaner ran them before the whole-frame engine."""
+    num_cols = df.select_dtypes(include='number').columns
+    outlier_mask = {}
+    for col in num_cols:
+        Q1 = df[col].quantile(0.25)
+        Q3 = df[col].quantile(0.75)
+        IQR = Q3 - Q1
+        is_outlier = (df[col] < Q1 - 1.5 * IQR) | (df[col] > Q3 + 1.5 * IQR)
+        outlier_mask[col] = is_outlier
+        df.loc[is_outlier, col] = np.nan
+
+    for col in num_cols:
+        outliers = outlier_mask[col]
+        median_val = df[col].median()
+        df.loc[outliers, col] = median_val
+        df[col] = df[col].fillna(df[col].mean()).round(2)
+
+    for col in df.select_dtypes(include='object').columns:
+        df[col] = df[col].astype(str).str.strip().replace("nan", "unknown")
+        df[col] = df[col].fillna("unknown")
+        df[col] = df[col].str.lower()
+    if 'city' in df.columns:
+        df['city'] = df['city'].str.title()
+    return df
+
+
+def engine_steps(df):
+    num_cols = list(df.select_dtypes(include='number').columns)
+    stats = numeric_stats(df[num_cols])
+    df[num_cols], _ = fill_numeric(df[num_cols], stats)
+    return clean_strings(df)
+
+
+def measure(steps, frame):
+    """(result, CPU seconds, peak MB allocated on top of the input)."""
+    df = frame.copy()
+    start = time.process_time()
+    result = steps(df)
+    cpu = time.process_time() - start
+
+    df = frame.copy()
+    tracemalloc.start()
+    steps(df)
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return result, cpu, peak
+
+
+def run(rows):
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "raw.csv")
+        generate(path, rows)
+        frame = coerce_numeric(standardize_columns(pd.read_csv(path)))
+    # Step 4 runs before these steps, so dates are already parsed
+    frame['date'] = pd.to_datetime(frame['date'], format='mixed')
+    text_mb = frame.select_dtypes(include='object').memory_usage(deep=True, index=False).sum() / 2**20
+
+    legacy, legacy_cpu, legacy_peak = measure(legacy_steps, frame)
+    engine, engine_cpu, engine_peak = measure(engine_steps, frame)
+    text_columns = list(engine.select_dtypes(include='category').columns)
+    if not legacy.equals(engine.astype({col: object for col in text_columns})):
+        raise SystemExit("Mismatch between the column-by-column and whole-frame cleaning steps!")
+
+    per_million = 1_000_000 / len(frame)
+    engine_text_mb = engine[text_columns].memory_usage(deep=True, index=False).sum() / 2**20
+    print(f"rows={len(frame):,}  numeric columns={len(frame.select_dtypes(include='number').columns)}  "
+          f"text columns={len(text_columns)}")
+    print(f"  column by column : {legacy_cpu * per_million:8.2f} CPU s/M rows   peak {legacy_peak * per_million:7.0f} MB/M rows")
+    print(f"  whole frame      : {engine_cpu * per_million:8.2f} CPU s/M rows   peak {engine_peak * per_million:7.0f} MB/M rows"
+          f"  ({legacy_cpu / engine_cpu:.1f}x faster)")
+    print(f"  text columns     : {text_mb:8.1f} MB as objects -> {engine_text_mb:.1f} MB as categoricals")
+
+
+if __name__ == "__main__":
+    run(parse_rows(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
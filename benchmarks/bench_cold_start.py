@@ -0,0 +1,86 @@
+"""
+Cold-start benchmark: imports each Lambda handler in a fresh interpreter and
+reports the module import time, plus which heavy libraries were loaded by the
+import alone. Those libraries should only load on the code paths that use them.
+--check exits non-zero when one of them is imported eagerly again, or when a
+handler's median import time exceeds --max-ms.
+
+Usage:
+    python benchmarks/bench_cold_start.py [--runs 5] [--check] [--max-ms 1500]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# handler directory -> module
+HANDLERS = {
+    "data_cleaner": "data_cleaner",
+    "glue_trigger": "glue_trigger",
+    "athena_llm_report": "athena_llm_report",
+    "pdf_generator": "pdf_generator",
+    "email_dispatcher": "email_dispatcher",
+}
+# Libraries no handler should pay for at import time
+DEFERRED = ["pandas", "numpy", "dateutil.parser", "pyarrow", "fitz", "pymupdf", "openai", "duckdb", "boto3", "botocore"]
+
+# Placeholder settings so the handlers import without a deployment environment
+ENV = {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "OPENROUTER_BASE_URL": "http://localhost",
+    "OPENROUTER_API_KEY": "benchmark",
+    "SES_SENDER": "sender@example.com",
+    "SES_RECIPIENT": "recipient@example.com",
+}
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+deferred = {deferred!r}
+loaded = [name for name in deferred if name in sys.modules and type(sys.modules[name]).__name__ != "_LazyModule"]
+print(json.dumps({{"import_ms": elapsed * 1000, "loaded": loaded}}))
+"""
+
+
+def measure(directory, module, runs):
+    env = dict(os.environ, **ENV)
+    env["PYTHONPATH"] = os.pathsep.join([os.path.join(ROOT, "shared"), os.path.join(ROOT, directory)])
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE.format(module=module, deferred=DEFERRED)],
+            env=env, capture_output=True, text=True, check=True,
+        ).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return statistics.median(s["import_ms"] for s in samples), min(s["import_ms"] for s in samples), samples[-1]["loaded"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--check", action="store_true", help="fail on eager heavy imports or slow imports")
+    parser.add_argument("--max-ms", type=float, default=None, help="median import budget per handler")
+    args = parser.parse_args()
+
+    failures = []
+    print(f"{'handler':<20}{'median ms':>11}{'min ms':>9}  loaded at import")
+    for directory, module in HANDLERS.items():
+        median, best, loaded = measure(directory, module, args.runs)
+        print(f"{directory:<20}{median:>11.1f}{best:>9.1f}  {', '.join(loaded) or '-'}")
+        if loaded:
+            failures.append(f"{directory} imports {', '.join(loaded)} at load time")
+        if args.max_ms is not None and median > args.max_ms:
+            failures.append(f"{directory} median import {median:.0f} ms > {args.max_ms:.0f} ms")
+
+    if args.check and failures:
+        raise SystemExit("Cold-start regression:\n  " + "\n  ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Benchmark for Step 4 of the data cleaner: per-row dateutil parsing vs the
+vectorized parse_dates() engine. Also checks both paths give identical output.
+
+Usage:
+    python benchmarks/bench_date_parsing.py [rows]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "shared"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "data_cleaner"))
+
+from data_cleaner import parse_dates, try_parse_date  # noqa: E402
+
+
+def make_dates(rows, seed=42):
+    rng = np.random.default_rng(seed)
+    days = pd.date_range("2023-01-01", "2024-12-31", freq="D")
+    picked = days[rng.integers(0, len(days), rows)]
+    styles = rng.random(rows)
+
+    raw = np.where(styles < 0.7, picked.strftime("%Y-%m-%d"), picked.strftime("%m/%d/%Y")).astype(object)
+    # A few values dateutil has to handle itself, plus junk that becomes NaT and gets forward-filled
+    raw[styles > 0.97] = picked[styles > 0.97].strftime("%b %d %Y")
+    raw[styles > 0.995] = "not a date"
+    return pd.Series(raw, name="date")
+
+
+def run(rows):
+    series = make_dates(rows)
+
+    start = time.perf_counter()
+    legacy = series.apply(try_parse_date).ffill()
+    legacy_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vectorized = parse_dates(series).ffill()
+    vectorized_secs = time.perf_counter() - start
+
+    if not legacy.equals(vectorized):
+        raise SystemExit("Mismatch between dateutil and vectorized date parsing!")
+
+    print(f"rows={rows:,}  distinct={series.nunique():,}")
+    print(f"  dateutil per-row : {legacy_secs:8.3f}s")
+    print(f"  vectorized       : {vectorized_secs:8.3f}s  ({legacy_secs / vectorized_secs:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
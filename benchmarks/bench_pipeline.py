@@ -0,0 +1,318 @@
+"""
+Offline end-to-end run of the pipeline: synthetic raw upload -> data_cleaner ->
+glue_trigger -> athena_llm_report -> pdf_generator -> email_dispatcher, all
+in-process. S3, Glue and SES are local stand-ins (local_aws.py), Athena is the
+embedded DuckDB backend over the local bucket, and OpenRouter is a stub server.
+
+Reports per-stage latency, throughput, peak RSS and API calls, so a change to
+any stage can be measured against the same data. Handler output goes to
+{workdir}/handlers.log (--verbose prints it instead).
+
+Usage:
+    python benchmarks/bench_pipeline.py [--rows 100k] [--days 90] [--workdir DIR]
+        [--partition-mode crawler|register] [--stream] [--pdf-batch] [--llm-latency 0.5] [--json out.json]
+
+Handler settings (OUTPUT_FORMAT, REPORT_QUERY_MODE, LLM_GENERATION_MODE, ...)
+are read from the environment as in Lambda.
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+HANDLER_DIRS = ["shared", "data_cleaner", "glue_trigger", "athena_llm_report", "pdf_generator", "email_dispatcher"]
+sys.path[:0] = [os.path.join(ROOT, directory) for directory in HANDLER_DIRS]
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from local_aws import LocalEvents, LocalGlue, LocalS3, LocalSES, StubLLMServer  # noqa: E402
+from synthetic_data import generate, parse_rows  # noqa: E402
+
+# Hard-coded in the report and email handlers
+BUCKET = "sk-shopsense-retail-uploads"
+RAW_KEY = "raw/raw_sales.csv"
+# S3 -> SQS notifications delivered to the Glue trigger per invocation
+SQS_BATCH_SIZE = 10
+# --stream: chunks of ~150 products (16-bit category codes) after a first chunk
+# from an older 50-product export (8-bit codes), so Parquet pieces of one day differ
+STREAM_CHUNK_PRODUCTS = 150
+STREAM_OLDER_PRODUCTS = 50
+RSS_SAMPLE_SECONDS = 0.05
+
+
+def rss_mb():
+    """Resident set size of this process, from /proc where available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def children_peak_mb():
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+class Stage:
+    """Times one stage and samples RSS in the background to find its peak."""
+
+    def __init__(self, name, services):
+        self.name = name
+        self.services = services
+        self.result = {"stage": name}
+
+    def __enter__(self):
+        self.calls_before = {service: stand_in.calls.copy() for service, stand_in in self.services.items()}
+        self.peak = rss_mb()
+        self.stop = threading.Event()
+        self.sampler = threading.Thread(target=self._sample, daemon=True)
+        self.sampler.start()
+        self.start = time.perf_counter()
+        return self
+
+    def _sample(self):
+        while not self.stop.wait(RSS_SAMPLE_SECONDS):
+            self.peak = max(self.peak, rss_mb())
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        self.stop.set()
+        self.sampler.join()
+        calls = {}
+        for service, stand_in in self.services.items():
+            delta = stand_in.calls - self.calls_before[service]
+            calls.update({f"{service}.{operation}": count for operation, count in sorted(delta.items())})
+        self.result.update({
+            "seconds": round(seconds, 3),
+            "peak_rss_mb": round(max(self.peak, rss_mb()), 1),
+            "calls": calls,
+        })
+
+    def throughput(self, count, unit):
+        self.result["items"] = count
+        self.result["unit"] = unit
+        self.result["per_second"] = round(count / self.result["seconds"], 2) if self.result["seconds"] else None
+
+
+def s3_event(keys, s3=None):
+    """S3 notifications for `keys`; with the LocalS3 the objects live in, each carries its size like a real one."""
+    now = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+    return {"Records": [
+        {"eventTime": now, "s3": {"bucket": {"name": bucket},
+                                  "object": {"key": key, **({"size": os.path.getsize(s3.path(bucket, key))} if s3 else {})}}}
+        for bucket, key in keys
+    ]}
+
+
+def sqs_batches(keys, size=SQS_BATCH_SIZE):
+    """S3 notifications delivered through SQS, one object per message, `size` messages per invocation."""
+    messages = [{"messageId": f"msg-{i}", "body": json.dumps(s3_event([key]))} for i, key in enumerate(keys)]
+    return [{"Records": messages[i:i + size]} for i in range(0, len(messages), size)]
+
+
+def invoke(stage, handler, event):
+    """Calls a lambda_handler, recording a non-200 response or an exception as a stage error."""
+    try:
+        response = handler(event, None)
+    except Exception as e:
+        response = {"statusCode": 500, "error": f"{type(e).__name__}: {e}"}
+    status = response.get("statusCode", 200) if isinstance(response, dict) else 200
+    if status != 200:
+        stage.result.setdefault("errors", []).append(response)
+    return response or {}
+
+
+def configure(args, workdir, llm):
+    """Environment for the handlers; settings tied to the local setup always win."""
+    defaults = {
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "SES_SENDER": "reports@shopsense.local",
+        "SES_RECIPIENT": "team@shopsense.local",
+        "ATHENA_DATABASE": "retail_db",
+        "ATHENA_TABLE": "retail_cleaned_data",
+        "ATHENA_OUTPUT_LOCATION": f"s3://{BUCKET}/athena-results/",
+        "REPORT_MODE": "weekly",
+        "LLM_CACHE": "off",
+        # The stub has no rate limits
+        "LLM_MAX_CONCURRENT": "8",
+        "LLM_REQUESTS_PER_MINUTE": "0",
+        "LLM_TOKENS_PER_MINUTE": "0",
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+    os.environ.update({
+        "OPENROUTER_BASE_URL": llm.base_url,
+        "OPENROUTER_API_KEY": "local-harness",
+        "QUERY_BACKEND": "duckdb",
+        "DUCKDB_DATA_PATH": os.path.join(workdir, "s3", BUCKET),
+        "DUCKDB_CACHE_DIR": os.path.join(workdir, "duckdb-cache"),
+        "PARTITION_MODE": args.partition_mode,
+    })
+    if args.stream:
+        os.environ["STREAM_THRESHOLD_MB"] = "1"
+        os.environ.setdefault("STREAM_CHUNK_ROWS", str(STREAM_CHUNK_PRODUCTS * args.days))
+
+
+def run(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix="shopsense-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    rows = parse_rows(args.rows)
+
+    with StubLLMServer(latency=args.llm_latency) as llm:
+        configure(args, workdir, llm)
+
+        import runtime
+
+        s3 = LocalS3(os.path.join(workdir, "s3"))
+        glue = LocalGlue(s3, BUCKET, os.environ["ATHENA_DATABASE"], os.environ["ATHENA_TABLE"],
+                         os.environ.get("CRAWLER_NAME", "retail_cleaned_crawler"), crawl_seconds=args.crawl_seconds)
+        ses = LocalSES(os.path.join(workdir, "outbox"))
+        events = LocalEvents()
+        services = {"s3": s3, "glue": glue, "ses": ses, "events": events}
+        for service, stand_in in services.items():
+            runtime.override_client(service, stand_in)
+
+        print(f"Generating {rows:,} rows into s3://{BUCKET}/{RAW_KEY} (workdir {workdir})")
+        raw_path = s3.path(BUCKET, RAW_KEY)
+        os.makedirs(os.path.dirname(raw_path), exist_ok=True)
+        if args.stream:
+            # An older export of a small assortment, then the full one
+            older = generate(raw_path, min(int(os.environ["STREAM_CHUNK_ROWS"]), rows // 2), days=args.days,
+                             products=STREAM_OLDER_PRODUCTS, seed=7, hourly=not args.no_hourly)
+            data = generate(raw_path, rows - older["rows"], days=args.days, hourly=not args.no_hourly, append=True)
+            data.update(rows=older["rows"] + data["rows"], seconds=older["seconds"] + data["seconds"])
+        else:
+            data = generate(raw_path, rows, days=args.days, hourly=not args.no_hourly)
+        print(f"  {data['rows']:,} rows, {data['bytes'] / 2**20:.1f} MB in {data['seconds']:.1f}s\n")
+
+        log_path = os.path.join(workdir, "handlers.log")
+        stages = []
+        with open(log_path, "w") as log, contextlib.redirect_stdout(sys.stdout if args.verbose else log):
+            import data_cleaner
+            import glue_trigger
+            import athena_llm_report
+            import pdf_generator
+            import email_dispatcher
+
+            with Stage("clean", services) as stage:
+                invoke(stage, data_cleaner.lambda_handler, s3_event([(BUCKET, RAW_KEY)], s3))
+            stage.throughput(data["rows"], "rows")
+            stage.result["input_mb_per_second"] = round(data["bytes"] / 2**20 / stage.result["seconds"], 2)
+            stages.append(stage.result)
+
+            cleaned = s3.drain_events("retail-cleaned-data/")
+            # Each upload's manifest lands after its files, on the same queue
+            manifests = s3.drain_events("retail-upload-manifests/")
+            s3.drain_events()
+            with Stage("catalog", services) as stage:
+                for event in sqs_batches(cleaned + manifests):
+                    invoke(stage, glue_trigger.lambda_handler, event)
+            stage.throughput(len(cleaned), "files")
+            stage.result["crawls"] = glue.crawls
+            stage.result["partitions"] = len(glue.partitions)
+            stage.result["partition_events"] = len(events.entries)
+            stages.append(stage.result)
+
+            with Stage("insights", services) as stage:
+                invoke(stage, athena_llm_report.lambda_handler, {"resume": False})
+            insights = s3.drain_events("llm-insights/")
+            s3.drain_events()
+            stage.throughput(len(insights), "reports")
+            stage.result["llm_requests"] = llm.requests
+            stages.append(stage.result)
+
+            with Stage("pdf", services) as stage:
+                if args.pdf_batch:
+                    # Worker processes have their own copy of the stand-ins: their S3 calls
+                    # aren't counted here and the PDFs are taken from the response
+                    response = invoke(stage, pdf_generator.lambda_handler,
+                                      {"bucket": BUCKET, "json_keys": [key for _, key in insights]})
+                    pdfs = response.get("pdf_keys", [])
+                else:
+                    for key in insights:
+                        invoke(stage, pdf_generator.lambda_handler, s3_event([key]))
+                    pdfs = s3.drain_events("pdf-reports/")
+            s3.drain_events()
+            stage.throughput(len(pdfs), "pdfs")
+            stage.result["children_peak_rss_mb"] = round(children_peak_mb(), 1)
+            stages.append(stage.result)
+
+            with Stage("email", services) as stage:
+                invoke(stage, email_dispatcher.lambda_handler, {"lookback_minutes": 60})
+            stage.throughput(len(ses.sent), "emails")
+            stages.append(stage.result)
+
+    report = {
+        "rows": data["rows"],
+        "input_mb": round(data["bytes"] / 2**20, 1),
+        "settings": {name: os.environ.get(name) for name in sorted(os.environ) if name in SETTINGS},
+        "stages": stages,
+        "total_seconds": round(sum(stage["seconds"] for stage in stages), 3),
+        "peak_rss_mb": round(max(stage["peak_rss_mb"] for stage in stages), 1),
+        "workdir": workdir,
+    }
+    failed = any(stage.get("errors") for stage in stages)
+    keep = args.workdir or args.keep or failed
+    print_report(report, log_path if keep and not args.verbose else None)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if not keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if failed:
+        raise SystemExit(f"Some handlers failed, see {log_path}")
+    return report
+
+
+# Environment settings recorded with each run, so results stay comparable
+SETTINGS = {
+    "OUTPUT_FORMAT", "STREAM_THRESHOLD_MB", "STREAM_CHUNK_ROWS", "UPLOAD_WORKERS", "BATCH_WORKERS",
+    "ROLLUP_ENABLED", "PARTITION_MODE", "REPORT_MODE", "REPORT_QUERY_MODE", "PERIOD_CONCURRENCY",
+    "LLM_GENERATION_MODE", "LLM_MAX_CONCURRENT", "LLM_CACHE", "RENDER_WORKERS", "DUCKDB_THREADS",
+}
+
+
+def print_report(report, log_path):
+    print(f"{report['rows']:,} rows, {report['input_mb']} MB raw input\n")
+    print(f"{'stage':<10}{'seconds':>9}{'items':>10}  {'throughput':<20}{'peak RSS MB':>12}  calls")
+    for stage in report["stages"]:
+        rate = f"{stage['per_second']:,.1f} {stage['unit']}/s" if stage.get("per_second") is not None else "-"
+        calls = ", ".join(f"{name}={count}" for name, count in stage["calls"].items())
+        print(f"{stage['stage']:<10}{stage['seconds']:>9.2f}{stage.get('items', 0):>10,}  {rate:<20}"
+              f"{stage['peak_rss_mb']:>12.1f}  {calls or '-'}")
+        for error in stage.get("errors", []):
+            print(f"{'':<10}ERROR {json.dumps(error)[:200]}")
+    print(f"{'total':<10}{report['total_seconds']:>9.2f}{'':>32}{report['peak_rss_mb']:>12.1f}")
+    if log_path:
+        print(f"\nHandler output: {log_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", default="100k", help="synthetic rows, e.g. 10k, 1M, 100M")
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--no-hourly", action="store_true", help="leave the wide hours_* columns out of the input")
+    parser.add_argument("--workdir", help="keep the local bucket, outbox and logs here (default: temporary)")
+    parser.add_argument("--keep", action="store_true", help="don't delete the temporary workdir")
+    parser.add_argument("--partition-mode", choices=["crawler", "register"], default="crawler")
+    parser.add_argument("--crawl-seconds", type=float, default=60, help="how long a local crawl reports RUNNING")
+    parser.add_argument("--stream", action="store_true",
+                        help="clean inputs over 1 MB in streaming mode, from an upload whose first chunk has fewer product names")
+    parser.add_argument("--pdf-batch", action="store_true", help="render PDFs with the batch worker pool")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds the stub LLM takes per call")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="print handler output")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Behaviour check for the report's fused query mode (REPORT_QUERY_MODE=fused):
+the cleaner writes a synthetic upload to the local S3 stand-in, then
+prepare_report runs over it on the DuckDB backend once with the seven separate
+section queries and once with the single GROUPING SETS scan. Every section
+split out of the fused result must match the separate query's table:
+
+  * same headers and, for unordered sections, the same rows
+  * same order for the ranked (top-10) and weekly sections; rows tied at the
+    top-10 boundary may differ, and totals may differ in the last bits from
+    summation order
+  * a period without data is skipped in both modes
+
+Runs for CSV and, when pyarrow is installed, Parquet output. Exits non-zero
+when any section differs.
+
+Usage:
+    python benchmarks/check_fused_report.py [--rows 20k] [--days 14]
+"""
+import argparse
+import contextlib
+import io
+import math
+import os
+import sys
+import tempfile
+from datetime import date, timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path[:0] = [os.path.join(ROOT, directory) for directory in ["shared", "data_cleaner", "athena_llm_report"]]
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+for name, value in {"AWS_DEFAULT_REGION": "us-east-1", "METRICS_SAMPLE_RATE": "0", "LLM_CACHE": "off",
+                    "OPENROUTER_BASE_URL": "http://localhost", "OPENROUTER_API_KEY": "local-check"}.items():
+    os.environ.setdefault(name, value)
+
+from local_aws import LocalS3  # noqa: E402
+from synthetic_data import generate, parse_rows  # noqa: E402
+
+BUCKET = "sk-shopsense-retail-uploads"
+TABLE = "retail_cleaned_data"
+START = "2024-03-28"
+# Sections whose row order is part of the answer -> number of leading key columns
+RANKED = {"top_sellers": 1, "sales_by_city": 1, "co_purchase_simulation": 1, "weekly_trend": 1}
+
+
+class RecordingRunner:
+    """Passes queries to the real runner and keeps the results of the last period."""
+
+    def __init__(self, runner):
+        self.runner = runner
+        self.results = {}
+
+    def run(self, name, query):
+        self.results[name] = self.runner.run(name, query)
+        return self.results[name]
+
+    def run_many(self, queries):
+        self.results.update(self.runner.run_many(queries))
+        return {name: self.results[name] for name in queries}
+
+    def __getattr__(self, name):
+        return getattr(self.runner, name)
+
+
+def same_value(a, b):
+    try:
+        return math.isclose(float(a), float(b), rel_tol=1e-9, abs_tol=1e-9)
+    except ValueError:
+        return a == b
+
+
+def same_row(a, b):
+    return len(a) == len(b) and all(same_value(x, y) for x, y in zip(a, b))
+
+
+def compare(name, separate, fused):
+    """None when the fused section answers the same as the separate query, else why not."""
+    if separate[0] != fused[0]:
+        return f"headers {fused[0]} != {separate[0]}"
+    expected, actual = separate[1:], fused[1:]
+    if len(expected) != len(actual):
+        return f"{len(actual)} rows != {len(expected)}"
+    if name not in RANKED:
+        expected, actual = sorted(expected), sorted(actual)
+        return None if all(same_row(a, b) for a, b in zip(expected, actual)) else f"rows {actual} != {expected}"
+
+    keys = RANKED[name]
+    boundary = expected[-1][keys:] if expected else None
+    for position, (a, b) in enumerate(zip(actual, expected)):
+        if not same_row(a[keys:], b[keys:]):
+            return f"row {position + 1}: {a} != {b}"
+        # Keys may only differ among rows tied with the last one kept
+        if a[:keys] != b[:keys] and not same_row(a[keys:], boundary) and a not in expected:
+            return f"row {position + 1}: {a} != {b}"
+    return None
+
+
+def report_tables(athena_llm_report, runner, mode, start, end):
+    athena_llm_report.REPORT_QUERY_MODE = mode
+    recorder = RecordingRunner(runner)
+    with contextlib.redirect_stdout(io.StringIO()):
+        prepared = athena_llm_report.prepare_report("retail_db", TABLE, f"s3://{BUCKET}/athena-results/",
+                                                    start, end, end, "weekly", runner=recorder)
+    if mode == "fused":
+        tables = athena_llm_report.split_fused_results(recorder.results["fused_report"])
+    else:
+        tables = {name: athena_llm_report.results_to_table_data(result) for name, result in recorder.results.items()}
+    return prepared, tables
+
+
+def run_checks(workdir, raw_path, output_format, days):
+    import runtime
+    import data_cleaner
+    import athena_llm_report
+    from duckdb_runner import DuckDBQueryRunner
+
+    s3 = LocalS3(os.path.join(workdir, output_format))
+    runtime.override_client("s3", s3)
+    data_cleaner.OUTPUT_FORMAT = output_format
+    with open(raw_path, "rb") as f:
+        s3.put_object(Bucket=BUCKET, Key="raw/raw_sales.csv", Body=f.read())
+    event = {"Records": [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": "raw/raw_sales.csv"}}}]}
+    with contextlib.redirect_stdout(io.StringIO()):
+        status = data_cleaner.lambda_handler(event, None)["statusCode"]
+    if status != 200:
+        return [(f"{output_format}: upload is cleaned", False, f"status {status}")]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        runner = DuckDBQueryRunner(os.path.join(s3.root, BUCKET), {TABLE: "retail-cleaned-data"})
+    first = date.fromisoformat(START)
+    periods = {
+        "whole upload": (first, first + timedelta(days=days - 1)),
+        "one week": (first + timedelta(days=3), first + timedelta(days=9)),
+    }
+    results = []
+    for period, (start, end) in periods.items():
+        _, separate = report_tables(athena_llm_report, runner, "separate", start.isoformat(), end.isoformat())
+        _, fused = report_tables(athena_llm_report, runner, "fused", start.isoformat(), end.isoformat())
+        for name in separate:
+            problem = compare(name, separate[name], fused.get(name, [[]]))
+            results.append((f"{output_format}, {period}: {name}", problem is None, problem))
+
+    empty = first + timedelta(days=days + 30)
+    skipped = [report_tables(athena_llm_report, runner, mode, empty.isoformat(), empty.isoformat())[0] is None
+               for mode in ("separate", "fused")]
+    results.append((f"{output_format}: period without data is skipped in both modes", all(skipped), str(skipped)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", default="20k")
+    parser.add_argument("--days", type=int, default=14)
+    args = parser.parse_args()
+
+    formats = ["csv"]
+    try:
+        import pyarrow  # noqa: F401
+        formats.append("parquet")
+    except ImportError:
+        print("pyarrow is not installed, checking CSV output only")
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="shopsense-check-") as workdir:
+        raw_path = os.path.join(workdir, "raw_sales.csv")
+        generate(raw_path, parse_rows(args.rows), days=args.days, start=START)
+        for output_format in formats:
+            results += run_checks(workdir, raw_path, output_format, args.days)
+
+    failures = []
+    for name, ok, detail in results:
+        print(f"{'ok' if ok else 'FAIL':<6}{name}{f' ({detail})' if detail and not ok else ''}")
+        if not ok:
+            failures.append(name)
+    if failures:
+        raise SystemExit(f"{len(failures)} fused report check(s) failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+Behaviour check for the cleaner's cross-upload deduplication (ingest index),
+run in-process against the local S3 stand-in, in both the in-memory and the
+streaming path:
+
+  * re-sending an upload adds no rows and no rollup totals
+  * a retry after one partition failed to upload ends with the same rows and
+    rollups as a clean single run (index pieces are saved per partition, after
+    that partition's file and rollup)
+  * once a partition has more than INGEST_INDEX_MAX_PIECES pieces they are
+    merged, and the merged index still covers every key written
+
+Exits non-zero when any of them fails.
+
+Usage:
+    python benchmarks/check_ingest_index.py [--rows 20k] [--days 14]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path[:0] = [os.path.join(ROOT, "shared"), os.path.join(ROOT, "data_cleaner")]
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("METRICS_SAMPLE_RATE", "0")
+os.environ.update({"OUTPUT_FORMAT": "csv", "DEDUP_ENABLED": "true", "ROLLUP_ENABLED": "true"})
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+
+from local_aws import LocalS3  # noqa: E402
+from synthetic_data import generate, parse_rows  # noqa: E402
+
+BUCKET = "sk-shopsense-retail-uploads"
+MERGE_AFTER = 2
+
+
+class FlakyS3(LocalS3):
+    """LocalS3 whose uploads of cleaned files for one dt= partition fail while `failing` is set."""
+
+    failing = None
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        if self.failing and Key.startswith(f"retail-cleaned-data/dt={self.failing}/"):
+            raise IOError(f"injected upload failure for {Key}")
+        return super().upload_fileobj(Fileobj, Bucket, Key, **kwargs)
+
+
+def clean(data_cleaner, s3, key):
+    size = os.path.getsize(s3.path(BUCKET, key))
+    event = {"Records": [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": key, "size": size}}}]}
+    with contextlib.redirect_stdout(io.StringIO()):
+        return data_cleaner.lambda_handler(event, None)["statusCode"]
+
+
+def put_raw(s3, key, data):
+    s3.put_object(Bucket=BUCKET, Key=key, Body=data)
+
+
+def cleaned_frames(s3):
+    """dt -> cleaned rows, read back with the cleaner's key types."""
+    frames = {}
+    for key in s3.list_keys(BUCKET, "retail-cleaned-data/"):
+        partition_value = key.split("/")[1][3:]
+        frames.setdefault(partition_value, []).append(pd.read_csv(s3.path(BUCKET, key)))
+    return {value: pd.concat(parts, ignore_index=True) for value, parts in frames.items()}
+
+
+def row_counts(s3):
+    return {value: len(df) for value, df in sorted(cleaned_frames(s3).items())}
+
+
+def rollup_totals(s3):
+    """dt -> (total_sales, row_count) summed over every rollup file of the day grain."""
+    totals = {}
+    for key in s3.list_keys(BUCKET, "retail-rollups/"):
+        day = pd.read_csv(s3.path(BUCKET, key)).query("grain == 'day'")
+        partition_value = key.split("/")[1][3:]
+        sales, rows = totals.get(partition_value, (0.0, 0))
+        totals[partition_value] = (round(sales + day["total_sales"].sum(), 6), rows + int(day["row_count"].sum()))
+    return dict(sorted(totals.items()))
+
+
+def index_pieces(s3, partition_value):
+    return s3.list_keys(BUCKET, f"retail-ingest-index/dt={partition_value}/")
+
+
+def indexed_keys(s3, partition_value):
+    pieces = [np.load(s3.path(BUCKET, key)) for key in index_pieces(s3, partition_value)]
+    return set(np.concatenate(pieces).tolist()) if pieces else set()
+
+
+def run_checks(runtime, data_cleaner, workdir, raw, mode):
+    results = []
+
+    def check(name, ok, detail=""):
+        results.append((f"{mode}: {name}", ok, detail))
+
+    # Reference: one clean run
+    s3 = FlakyS3(os.path.join(workdir, mode, "reference"))
+    runtime.override_client("s3", s3)
+    put_raw(s3, "raw/raw_sales.csv", raw)
+    check("first upload is cleaned", clean(data_cleaner, s3, "raw/raw_sales.csv") == 200)
+    reference_rows, reference_rollups = row_counts(s3), rollup_totals(s3)
+
+    put_raw(s3, "raw/raw_sales_resent.csv", raw)
+    clean(data_cleaner, s3, "raw/raw_sales_resent.csv")
+    check("re-sent upload adds no rows", row_counts(s3) == reference_rows)
+    check("re-sent upload adds no rollup totals", rollup_totals(s3) == reference_rollups)
+
+    # Retry after one partition failed to upload
+    s3 = FlakyS3(os.path.join(workdir, mode, "retry"))
+    runtime.override_client("s3", s3)
+    put_raw(s3, "raw/raw_sales.csv", raw)
+    failing = s3.failing = sorted(reference_rows)[len(reference_rows) // 2]
+    first = clean(data_cleaner, s3, "raw/raw_sales.csv")
+    check("failed partition fails the upload", first == 500 and failing not in row_counts(s3),
+          f"status {first}")
+    check("failed partition has no index piece", not index_pieces(s3, failing))
+    s3.failing = None
+    retry = clean(data_cleaner, s3, "raw/raw_sales.csv")
+    rows = row_counts(s3)
+    check("retry is cleaned", retry == 200, f"status {retry}")
+    check("retry ends with the reference rows", rows == reference_rows,
+          f"{sum(rows.values())} rows vs {sum(reference_rows.values())}")
+    rollups = rollup_totals(s3)
+    check("retry ends with the reference rollups", rollups == reference_rollups,
+          f"{len(rollups)} of {len(reference_rollups)} days")
+
+    # Disjoint uploads (one per product group) until the pieces are merged
+    s3 = FlakyS3(os.path.join(workdir, mode, "merge"))
+    runtime.override_client("s3", s3)
+    frame = pd.read_csv(io.BytesIO(raw))
+    groups = MERGE_AFTER + 2
+    for group in range(groups):
+        part = frame[frame["product_id"] % groups == group].to_csv(index=False).encode()
+        put_raw(s3, f"raw/raw_products_{group}.csv", part)
+        clean(data_cleaner, s3, f"raw/raw_products_{group}.csv")
+    frames = cleaned_frames(s3)
+    # The last upload merges the pieces of the ones before it, then adds its own
+    pieces = {value: index_pieces(s3, value) for value in frames}
+    merged = [value for value, keys in pieces.items() if len(keys) == 2 and any("_merged" in key for key in keys)]
+    check(f"pieces merged once over {MERGE_AFTER}", len(merged) == len(frames), f"{len(merged)} of {len(frames)} days")
+    missing = 0
+    for value, df in frames.items():
+        df["date"] = pd.to_datetime(df["date"])
+        df[["store_id", "product_id"]] = df[["store_id", "product_id"]].astype("float64")
+        missing += len(set(data_cleaner.row_fingerprints(df).tolist()) - indexed_keys(s3, value))
+    check("merged index covers every written key", missing == 0, f"{missing} keys missing")
+    before = row_counts(s3)
+    clean(data_cleaner, s3, "raw/raw_products_0.csv")
+    check("re-sent upload adds no rows after a merge", row_counts(s3) == before)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", default="20k")
+    parser.add_argument("--days", type=int, default=14)
+    args = parser.parse_args()
+
+    import runtime
+    import data_cleaner
+    data_cleaner.INGEST_INDEX_MAX_PIECES = MERGE_AFTER
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="shopsense-check-") as workdir:
+        raw_path = os.path.join(workdir, "raw_sales.csv")
+        generate(raw_path, parse_rows(args.rows), days=args.days)
+        with open(raw_path, "rb") as f:
+            raw = f.read()
+        if len(raw) <= 2**20:
+            raise SystemExit("The upload must be over 1 MB to take the streaming path, use more --rows")
+
+        for mode, threshold_mb in [("in-memory", 0), ("stream", 1)]:
+            data_cleaner.STREAM_THRESHOLD_MB = threshold_mb
+            data_cleaner.STREAM_CHUNK_ROWS = max(1000, parse_rows(args.rows) // 7)
+            results += run_checks(runtime, data_cleaner, workdir, raw, mode)
+
+    failures = []
+    for name, ok, detail in results:
+        print(f"{'ok' if ok else 'FAIL':<6}{name}{f' ({detail})' if detail and not ok else ''}")
+        if not ok:
+            failures.append(name)
+    if failures:
+        raise SystemExit(f"{len(failures)} ingest index check(s) failed")
+
+
+if __name__ == "__main__":
+    main()
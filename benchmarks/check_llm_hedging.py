@@ -0,0 +1,141 @@
+"""
+Behaviour check for the report's hedged LLM client (athena_llm_report/llm_client.py),
+run against the local OpenAI-compatible stub with the report's own RateLimiter:
+
+  * a model slower than its hedge delay is raced by the next one, which wins
+  * the losing call gives its limiter slot back as soon as the race is settled,
+    and its latency is still recorded once its request finishes
+  * a failing model hands over without waiting for the hedge delay
+  * complete() gives up at its deadline with every slot released, and a call
+    still queued for a slot then never sends its request
+
+Exits non-zero when any of them fails.
+
+Usage:
+    python benchmarks/check_llm_hedging.py
+"""
+import contextlib
+import io
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path[:0] = [os.path.join(ROOT, "shared"), os.path.join(ROOT, "athena_llm_report")]
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+for name, value in {"AWS_DEFAULT_REGION": "us-east-1", "METRICS_SAMPLE_RATE": "0", "LLM_CACHE": "off",
+                    "OPENROUTER_BASE_URL": "http://localhost", "OPENROUTER_API_KEY": "local-check"}.items():
+    os.environ.setdefault(name, value)
+
+from local_aws import StubLLMServer  # noqa: E402
+
+SLOW_SECONDS = 2.0
+FAST_SECONDS = 0.05
+HEDGE_SECONDS = 0.2
+MESSAGES = [{"role": "user", "content": "### Top-Selling Products\nproduct_id,total_sales\n1,10.0\n"}]
+
+
+def free_slots(limiter, count):
+    """True when `count` slots can be taken right now (they are given back straight away)."""
+    taken = 0
+    while taken < count and limiter.slots.acquire(blocking=False):
+        taken += 1
+    for _ in range(taken):
+        limiter.slots.release()
+    return taken == count
+
+
+def main():
+    from openai import OpenAI
+    import llm_client
+    from athena_llm_report import RateLimiter
+    from llm_client import HedgedLLMClient, LLMUnavailableError
+
+    llm_client.LLM_HEDGE_DELAY_SECONDS = HEDGE_SECONDS
+    results = []
+
+    def check(name, ok, detail=""):
+        results.append((name, ok, detail))
+
+    latencies = {"slow": SLOW_SECONDS, "slow-too": SLOW_SECONDS, "fast": FAST_SECONDS}
+    with StubLLMServer(model_latency=latencies, failing_models={"broken"}) as stub, \
+            contextlib.redirect_stdout(io.StringIO()):
+        # The hedged client does its own retries
+        client = OpenAI(base_url=stub.base_url, api_key="local-check", max_retries=0)
+
+        limiter = RateLimiter(2, 0)
+        llm = HedgedLLMClient(client, ["slow", "fast"], limiter=limiter)
+        start = time.monotonic()
+        model, content = llm.complete(MESSAGES)
+        elapsed = time.monotonic() - start
+        check("slow model is hedged and the next one wins", model == "fast" and content and elapsed < SLOW_SECONDS / 2,
+              f"{model} after {elapsed:.2f}s")
+        time.sleep(0.1)
+        check("losing call gives its slot back while its request runs",
+              free_slots(limiter, 2) and time.monotonic() - start < SLOW_SECONDS)
+        time.sleep(max(0, start + SLOW_SECONDS + 0.5 - time.monotonic()))
+        check("losing call's latency is still recorded", llm.stats["slow"].successes == 1,
+              str(llm.stats["slow"].summary()))
+
+        llm = HedgedLLMClient(client, ["broken", "fast"], limiter=RateLimiter(2, 0), max_retries=0)
+        llm_client.LLM_HEDGE_DELAY_SECONDS = 5.0
+        start = time.monotonic()
+        model, _ = llm.complete(MESSAGES)
+        elapsed = time.monotonic() - start
+        check("failing model hands over without waiting for the hedge delay", model == "fast" and elapsed < 1.0,
+              f"{model} after {elapsed:.2f}s")
+        llm_client.LLM_HEDGE_DELAY_SECONDS = HEDGE_SECONDS
+
+        limiter = RateLimiter(2, 0)
+        llm = HedgedLLMClient(client, ["slow", "slow-too"], limiter=limiter, total_timeout=1.0)
+        start = time.monotonic()
+        try:
+            llm.complete(MESSAGES)
+            raised = False
+        except LLMUnavailableError:
+            raised = True
+        elapsed = time.monotonic() - start
+        check("complete() gives up at its deadline", raised and elapsed < 1.3, f"raised={raised} after {elapsed:.2f}s")
+        time.sleep(0.1)
+        check("slots are released at the deadline", free_slots(limiter, 2))
+
+        # Another caller holds the only slot for longer than the deadline
+        limiter = RateLimiter(1, 0)
+        llm = HedgedLLMClient(client, ["fast"], limiter=limiter, total_timeout=0.5)
+        released = threading.Event()
+
+        def hold_slot():
+            with limiter:
+                released.wait(2.0)
+
+        holder = threading.Thread(target=hold_slot)
+        holder.start()
+        time.sleep(0.05)
+        requests = stub.requests
+        start = time.monotonic()
+        try:
+            llm.complete(MESSAGES)
+            raised = False
+        except LLMUnavailableError:
+            raised = True
+        elapsed = time.monotonic() - start
+        check("call waiting for a slot still gives up at the deadline", raised and elapsed < 0.8,
+              f"raised={raised} after {elapsed:.2f}s")
+        released.set()
+        holder.join()
+        time.sleep(0.2)
+        check("queued call never sends its request after the deadline",
+              stub.requests == requests and free_slots(limiter, 1), f"{stub.requests - requests} request(s) sent")
+
+    failures = []
+    for name, ok, detail in results:
+        print(f"{'ok' if ok else 'FAIL':<6}{name}{f' ({detail})' if detail and not ok else ''}")
+        if not ok:
+            failures.append(name)
+    if failures:
+        raise SystemExit(f"{len(failures)} LLM hedging check(s) failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+Behaviour check for the Glue trigger in register mode (PARTITION_MODE=register):
+the cleaner writes synthetic uploads to the local S3 stand-in and their S3
+notifications reach glue_trigger through SQS-sized batches, against LocalGlue
+and a local EventBridge.
+
+  * before the table exists, every batch of the first upload leads to one crawl
+  * an upload with the table's schema has all of its partitions registered
+    without a crawl, and is announced by exactly one event, once its manifest
+    arrives
+  * a redelivered batch within the debounce window makes no partition calls
+  * a failed announcement retries only the manifest, which is then announced once
+  * two manifests in one batch give one event listing both uploads
+  * an upload that changes the schema is crawled once and not announced
+
+Exits non-zero when any of them fails.
+
+Usage:
+    python benchmarks/check_partition_events.py [--rows 2k] [--days 7]
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta, timezone
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path[:0] = [os.path.join(ROOT, directory) for directory in ["shared", "data_cleaner", "glue_trigger"]]
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("METRICS_SAMPLE_RATE", "0")
+os.environ.update({"PARTITION_MODE": "register", "OUTPUT_FORMAT": "csv"})
+
+import pandas as pd  # noqa: E402
+
+from local_aws import LocalEvents, LocalGlue, LocalS3  # noqa: E402
+from synthetic_data import generate, parse_rows  # noqa: E402
+
+BUCKET = "sk-shopsense-retail-uploads"
+START = date(2024, 3, 28)
+SQS_BATCH_SIZE = 10
+CRAWL_SECONDS = 1.0
+
+
+class FlakyEvents(LocalEvents):
+    """LocalEvents that rejects every entry while `failing` is set."""
+
+    failing = False
+
+    def put_events(self, Entries, **kwargs):
+        if self.failing:
+            self._count("put_events")
+            return {"FailedEntryCount": len(Entries), "Entries": [{"ErrorCode": "InternalFailure"} for _ in Entries]}
+        return super().put_events(Entries, **kwargs)
+
+
+class Pipeline:
+    """Cleans uploads and delivers their notifications to the glue trigger like an SQS queue."""
+
+    def __init__(self, workdir, rows, days):
+        import runtime
+
+        self.workdir, self.rows, self.days = workdir, rows, days
+        self.s3 = LocalS3(os.path.join(workdir, "s3"))
+        self.glue = LocalGlue(self.s3, BUCKET, "retail_db", "retail_cleaned_data", "retail_cleaned_crawler",
+                              crawl_seconds=CRAWL_SECONDS)
+        self.events = FlakyEvents()
+        for service, stand_in in {"s3": self.s3, "glue": self.glue, "events": self.events}.items():
+            runtime.override_client(service, stand_in)
+        self.message_ids = itertools.count()
+        self.uploads = 0
+
+    def upload(self, extra_column=None):
+        """Cleans the next `days` days as one upload. Returns (cleaned records, manifest records, dt values)."""
+        import data_cleaner
+
+        first = START + timedelta(days=self.uploads * self.days)
+        key = f"raw/raw_sales_{self.uploads}.csv"
+        path = os.path.join(self.workdir, f"upload_{self.uploads}.csv")
+        generate(path, self.rows, days=self.days, start=first.isoformat(), seed=self.uploads)
+        if extra_column:
+            pd.read_csv(path).assign(**{extra_column: "x"}).to_csv(path, index=False)
+        self.uploads += 1
+        with open(path, "rb") as f:
+            self.s3.put_object(Bucket=BUCKET, Key=key, Body=f.read())
+        self.s3.drain_events()
+        event = {"Records": [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": key}}}]}
+        with contextlib.redirect_stdout(io.StringIO()):
+            status = data_cleaner.lambda_handler(event, None)["statusCode"]
+        if status != 200:
+            raise SystemExit(f"Cleaning {key} failed with status {status}")
+        cleaned = self.messages(self.s3.drain_events("retail-cleaned-data/"))
+        manifests = self.messages(self.s3.drain_events("retail-upload-manifests/"))
+        self.s3.drain_events()
+        days = [(first + timedelta(days=i)).isoformat() for i in range(self.days)]
+        return cleaned, manifests, days
+
+    def messages(self, objects):
+        now = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+        return [{"messageId": f"msg-{next(self.message_ids)}", "body": json.dumps({"Records": [
+            {"eventTime": now, "s3": {"bucket": {"name": bucket}, "object": {"key": key}}}]})}
+            for bucket, key in objects]
+
+    def deliver(self, messages, batch_size=SQS_BATCH_SIZE):
+        """Invokes the trigger per batch; returns the messages it asked to retry."""
+        import glue_trigger
+
+        retry = []
+        for i in range(0, len(messages), batch_size):
+            batch = messages[i:i + batch_size]
+            with contextlib.redirect_stdout(io.StringIO()):
+                response = glue_trigger.lambda_handler({"Records": batch}, None)
+            failed = {item["itemIdentifier"] for item in response.get("batchItemFailures", [])}
+            retry += [message for message in batch if message["messageId"] in failed]
+        return retry
+
+    def announced(self):
+        return [json.loads(entry["Detail"]) for entry in self.events.entries]
+
+
+def partition_calls(glue):
+    return sum(count for call, count in glue.calls.items() if call.endswith("_partition"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", default="2k")
+    parser.add_argument("--days", type=int, default=7)
+    args = parser.parse_args()
+
+    results = []
+
+    def check(name, ok, detail=""):
+        results.append((name, ok, detail))
+
+    with tempfile.TemporaryDirectory(prefix="shopsense-check-") as workdir:
+        pipeline = Pipeline(workdir, parse_rows(args.rows), args.days)
+        glue, events = pipeline.glue, pipeline.events
+
+        cleaned, manifests, _ = pipeline.upload()
+        retry = pipeline.deliver(cleaned + manifests)
+        check("first upload without a table starts one crawl", glue.crawls == 1 and not retry,
+              f"{glue.crawls} crawl(s), {len(retry)} retried")
+        check("crawled upload is not announced", not events.entries)
+        time.sleep(CRAWL_SECONDS)
+
+        cleaned, manifests, days = pipeline.upload()
+        retry = pipeline.deliver(cleaned)
+        check("upload's partitions are registered without a crawl",
+              set(days) <= set(glue.partitions) and glue.crawls == 1 and not retry)
+        check("nothing is announced before the manifest", not events.entries)
+        retry = pipeline.deliver(manifests)
+        announced = pipeline.announced()
+        check("manifest announces the upload once",
+              len(announced) == 1 and announced[0]["partitions"] == days
+              and len(announced[0].get("uploads", [])) == 1 and not retry, json.dumps(announced))
+
+        calls = partition_calls(glue)
+        retry = pipeline.deliver(cleaned)
+        check("redelivered batch within the debounce window makes no partition calls",
+              partition_calls(glue) == calls and len(events.entries) == 1 and not retry,
+              f"{partition_calls(glue) - calls} partition call(s)")
+
+        cleaned, manifests, days = pipeline.upload()
+        pipeline.deliver(cleaned)
+        events.failing = True
+        retry = pipeline.deliver(manifests)
+        events.failing = False
+        retried = [message["messageId"] for message in retry]
+        check("failed announcement retries only the manifest",
+              retried == [message["messageId"] for message in manifests] and set(days) <= set(glue.partitions))
+        retry = pipeline.deliver(retry)
+        announced = pipeline.announced()
+        check("retried manifest is announced once", len(announced) == 2 and announced[-1]["partitions"] == days
+              and not retry, json.dumps(announced[1:]))
+
+        first_cleaned, first_manifests, first_days = pipeline.upload()
+        second_cleaned, second_manifests, second_days = pipeline.upload()
+        pipeline.deliver(first_cleaned + second_cleaned)
+        retry = pipeline.deliver(first_manifests + second_manifests)
+        announced = pipeline.announced()
+        check("two manifests in one batch give one event",
+              len(announced) == 3 and announced[-1]["partitions"] == first_days + second_days
+              and len(announced[-1].get("uploads", [])) == 2 and not retry, json.dumps(announced[2:]))
+
+        cleaned, manifests, days = pipeline.upload(extra_column="promo_code")
+        retry = pipeline.deliver(cleaned + manifests)
+        check("schema change starts one crawl", glue.crawls == 2 and not retry,
+              f"{glue.crawls - 1} crawl(s), {len(retry)} retried")
+        check("schema change is not announced", len(events.entries) == 3)
+
+    failures = []
+    for name, ok, detail in results:
+        print(f"{'ok' if ok else 'FAIL':<6}{name}{f' ({detail})' if detail and not ok else ''}")
+        if not ok:
+            failures.append(name)
+    if failures:
+        raise SystemExit(f"{len(failures)} partition event check(s) failed")
+
+
+if __name__ == "__main__":
+    main()
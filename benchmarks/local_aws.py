@@ -0,0 +1,429 @@
+"""
+In-process stand-ins for the AWS services the handlers use, plus a stub
+OpenRouter server, for running the pipeline offline (see bench_pipeline.py).
+
+Each stand-in implements only the client calls the handlers make, with the
+same request/response shapes, and counts the calls it serves so a run can
+report API usage per stage. Install them with runtime.override_client().
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from types import SimpleNamespace
+
+LIST_PAGE_SIZE = 1000
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+class EntityNotFoundException(Exception):
+    pass
+
+
+class CrawlerRunningException(Exception):
+    pass
+
+
+class CallCounter:
+    """Thread-safe per-operation call counts."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self._calls_lock = threading.Lock()
+
+    def _count(self, operation):
+        with self._calls_lock:
+            self.calls[operation] += 1
+
+
+class LocalS3(CallCounter):
+    """
+    S3 on a local directory: s3://bucket/key is {root}/bucket/key. Writes go to a
+    staging file first and are renamed into place, so readers and listings never
+    see partial objects. Every write is also appended to `events`, which the
+    harness turns into the notifications that trigger the next stage.
+    """
+
+    exceptions = SimpleNamespace(NoSuchKey=NoSuchKey)
+
+    def __init__(self, root):
+        super().__init__()
+        self.root = root
+        self.staging = os.path.join(root, ".staging")
+        os.makedirs(self.staging, exist_ok=True)
+        self.events = []
+        self._events_lock = threading.Lock()
+
+    def path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split("/"))
+
+    def drain_events(self, prefix=""):
+        """Returns and forgets the (bucket, key) of objects written under `prefix`."""
+        with self._events_lock:
+            matched = [event for event in self.events if event[1].startswith(prefix)]
+            self.events = [event for event in self.events if not event[1].startswith(prefix)]
+        return matched
+
+    def _write(self, bucket, key, fileobj):
+        fd, staged = tempfile.mkstemp(dir=self.staging)
+        with os.fdopen(fd, "wb") as out:
+            shutil.copyfileobj(fileobj, out, 1024 * 1024)
+        path = self.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(staged, path)
+        with self._events_lock:
+            self.events.append((bucket, key))
+
+    def _stat(self, bucket, key):
+        try:
+            return os.stat(self.path(bucket, key))
+        except FileNotFoundError:
+            raise NoSuchKey(f"s3://{bucket}/{key}") from None
+
+    @staticmethod
+    def _etag(stat):
+        return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+    def put_object(self, Bucket, Key, Body=b"", **kwargs):
+        self._count("put_object")
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        self._write(Bucket, Key, BytesIO(Body) if isinstance(Body, (bytes, bytearray)) else Body)
+        return {"ETag": self._etag(self._stat(Bucket, Key))}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Callback=None, Config=None):
+        self._count("upload_fileobj")
+        self._write(Bucket, Key, Fileobj)
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self._count("get_object")
+        stat = self._stat(Bucket, Key)
+        body = open(self.path(Bucket, Key), "rb")
+        length = stat.st_size
+        if Range:
+            start, end = re.fullmatch(r"bytes=(\d*)-(\d*)", Range).groups()
+            if not start:
+                start, end = max(0, stat.st_size - int(end)), stat.st_size - 1
+            else:
+                start, end = int(start), min(int(end) if end else stat.st_size - 1, stat.st_size - 1)
+            with body:
+                body.seek(start)
+                body = BytesIO(body.read(end - start + 1))
+            length = end - start + 1
+        return {
+            "Body": body,
+            "ContentLength": length,
+            "ETag": self._etag(stat),
+            "LastModified": datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+        }
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._count("head_object")
+        stat = self._stat(Bucket, Key)
+        return {"ContentLength": stat.st_size, "ETag": self._etag(stat),
+                "LastModified": datetime.fromtimestamp(stat.st_mtime, timezone.utc)}
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        self._count("download_file")
+        self._stat(Bucket, Key)
+        shutil.copyfile(self.path(Bucket, Key), Filename)
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._count("delete_object")
+        try:
+            os.remove(self.path(Bucket, Key))
+        except FileNotFoundError:
+            pass
+        return {}
+
+    def generate_presigned_url(self, ClientMethod, Params=None, ExpiresIn=3600):
+        self._count("generate_presigned_url")
+        return "file://" + self.path(Params["Bucket"], Params["Key"])
+
+    def list_keys(self, bucket, prefix="", start_after=""):
+        """Sorted keys under `prefix`, walking only the directories the prefix can match."""
+        bucket_root = os.path.join(self.root, bucket)
+        directory = prefix.rsplit("/", 1)[0] if "/" in prefix else ""
+        keys = []
+        for dirpath, _, filenames in os.walk(os.path.join(bucket_root, *directory.split("/"))):
+            relative = os.path.relpath(dirpath, bucket_root).replace(os.sep, "/")
+            for filename in filenames:
+                key = filename if relative == "." else f"{relative}/{filename}"
+                if key.startswith(prefix) and key > start_after:
+                    keys.append(key)
+        return sorted(keys)
+
+    def get_paginator(self, operation):
+        if operation != "list_objects_v2":
+            raise NotImplementedError(f"LocalS3 has no paginator for {operation}")
+
+        def paginate(Bucket, Prefix="", StartAfter="", **kwargs):
+            keys = self.list_keys(Bucket, Prefix, StartAfter)
+            for i in range(0, max(len(keys), 1), LIST_PAGE_SIZE):
+                self._count("list_objects_v2")
+                contents = []
+                for key in keys[i:i + LIST_PAGE_SIZE]:
+                    stat = os.stat(self.path(Bucket, key))
+                    contents.append({
+                        "Key": key, "Size": stat.st_size, "ETag": self._etag(stat),
+                        "LastModified": datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+                    })
+                page = {"KeyCount": len(contents)}
+                if contents:
+                    page["Contents"] = contents
+                yield page
+
+        return SimpleNamespace(paginate=paginate)
+
+
+class LocalGlue(CallCounter):
+    """
+    The Glue catalog for one table. A crawl runs when it is started: it reads the
+    column names of the first cleaned file and registers every dt= partition. The
+    crawler then reports RUNNING for `crawl_seconds`, like a real crawl, so
+    triggers arriving meanwhile see it busy.
+    """
+
+    exceptions = SimpleNamespace(EntityNotFoundException=EntityNotFoundException,
+                                 CrawlerRunningException=CrawlerRunningException)
+
+    def __init__(self, s3, bucket, database, table, crawler_name, prefix="retail-cleaned-data/", crawl_seconds=60):
+        super().__init__()
+        self.s3 = s3
+        self.bucket = bucket
+        self.database = database
+        self.table_name = table
+        self.crawler_name = crawler_name
+        self.prefix = prefix
+        self.crawl_seconds = crawl_seconds
+        self.table = None
+        self.partitions = {}
+        self.crawls = 0
+        self.last_crawl_start = None
+        self._lock = threading.Lock()
+
+    def _crawl(self):
+        keys = [key for key in self.s3.list_keys(self.bucket, self.prefix) if "/dt=" in f"/{key}"]
+        if not keys:
+            return
+        parquet = keys[0].endswith(".parquet")
+        if parquet:
+            import pyarrow.parquet as pq
+
+            columns = pq.read_schema(self.s3.path(self.bucket, keys[0])).names
+        else:
+            with open(self.s3.path(self.bucket, keys[0]), "rb") as f:
+                columns = f.readline().decode("utf-8").strip().split(",")
+        input_format = ("org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat" if parquet
+                        else "org.apache.hadoop.mapred.TextInputFormat")
+        descriptor = {
+            "Columns": [{"Name": column, "Type": "string"} for column in columns if column != "dt"],
+            "Location": f"s3://{self.bucket}/{self.prefix}",
+            "InputFormat": input_format,
+        }
+        self.table = {"Name": self.table_name, "DatabaseName": self.database, "StorageDescriptor": descriptor,
+                      "PartitionKeys": [{"Name": "dt", "Type": "string"}]}
+        for key in keys:
+            value = key[len(self.prefix):].split("/", 1)[0][3:]
+            self.partitions.setdefault(value, {"Values": [value], "StorageDescriptor": descriptor})
+
+    def _running(self):
+        return self.last_crawl_start is not None and \
+            datetime.now(timezone.utc).timestamp() - self.last_crawl_start.timestamp() < self.crawl_seconds
+
+    def get_crawler(self, Name):
+        self._count("get_crawler")
+        with self._lock:
+            crawler = {"Name": Name, "State": "RUNNING" if self._running() else "READY"}
+            if self.last_crawl_start:
+                if self._running():
+                    crawler["CrawlElapsedTime"] = int(
+                        (datetime.now(timezone.utc) - self.last_crawl_start).total_seconds() * 1000)
+                else:
+                    crawler["LastCrawl"] = {"Status": "SUCCEEDED", "StartTime": self.last_crawl_start}
+            return {"Crawler": crawler}
+
+    def start_crawler(self, Name):
+        self._count("start_crawler")
+        with self._lock:
+            if self._running():
+                raise CrawlerRunningException(f"Crawler with name {Name} has already started")
+            self.last_crawl_start = datetime.now(timezone.utc)
+            self.crawls += 1
+            self._crawl()
+        return {}
+
+    def get_table(self, DatabaseName, Name):
+        self._count("get_table")
+        with self._lock:
+            if self.table is None or (DatabaseName, Name) != (self.database, self.table_name):
+                raise EntityNotFoundException(f"Table {Name} not found")
+            return {"Table": self.table}
+
+    def batch_get_partition(self, DatabaseName, TableName, PartitionsToGet):
+        self._count("batch_get_partition")
+        with self._lock:
+            found = [self.partitions[p["Values"][0]] for p in PartitionsToGet if p["Values"][0] in self.partitions]
+        return {"Partitions": found, "UnprocessedKeys": []}
+
+    def batch_create_partition(self, DatabaseName, TableName, PartitionInputList):
+        self._count("batch_create_partition")
+        errors = []
+        with self._lock:
+            for partition in PartitionInputList:
+                value = partition["Values"][0]
+                if value in self.partitions:
+                    errors.append({"PartitionValues": [value],
+                                   "ErrorDetail": {"ErrorCode": "AlreadyExistsException"}})
+                else:
+                    self.partitions[value] = dict(partition)
+        return {"Errors": errors}
+
+
+class LocalSES(CallCounter):
+    """Writes every message to {outbox}/<message id>.json instead of sending it."""
+
+    def __init__(self, outbox):
+        super().__init__()
+        self.outbox = outbox
+        self.sent = []
+        os.makedirs(outbox, exist_ok=True)
+
+    def send_email(self, Source, Destination, Message, **kwargs):
+        self._count("send_email")
+        message_id = uuid.uuid4().hex
+        record = {"MessageId": message_id, "Source": Source, "Destination": Destination, "Message": Message}
+        with open(os.path.join(self.outbox, f"{message_id}.json"), "w") as f:
+            json.dump(record, f, indent=2)
+        self.sent.append(record)
+        return {"MessageId": message_id}
+
+
+class LocalEvents(CallCounter):
+    """Keeps every EventBridge entry put in `entries` instead of publishing it."""
+
+    def __init__(self):
+        super().__init__()
+        self.entries = []
+
+    def put_events(self, Entries, **kwargs):
+        self._count("put_events")
+        self.entries.extend(Entries)
+        return {"FailedEntryCount": 0, "Entries": [{"EventId": uuid.uuid4().hex} for _ in Entries]}
+
+
+def stub_insight(prompt):
+    """A deterministic report in the LLM's usual markdown layout, built from the prompt's tables."""
+    def section(title):
+        match = re.search(rf"{re.escape(title)}:\s*\n((?:\s*\|.*\|\s*\n?)+)", prompt)
+        if not match:
+            return []
+        rows = [[cell.strip() for cell in line.strip().strip("|").split("|")] for line in match.group(1).splitlines()]
+        return [row for row in rows[1:] if len(row) > 1]
+
+    top = section("Top-Selling Products")
+    cities = section("City-wise Sales")
+    weekly = section("Weekly Trends")
+    lines = ["### Executive Summary",
+             f"Sales were led by product {top[0][0]} ({top[0][1]}). " if top else "No sales were recorded. ",
+             f"The period covers {len(weekly)} week(s) of data across {len(cities)} top cities.",
+             "", "### Sales Highlights"]
+    lines += [f"- **Product {row[0]}**: total sales {row[1]}" for row in top[:5]]
+    lines += [f"- **City {row[0]}**: total sales {row[1]}" for row in cities[:3]]
+    lines += ["", "### Consumer Behavior"]
+    lines += [f"- Product {row[0]} sold on {row[1]} store-days" for row in section("Co-purchase Simulation")[:3]]
+    lines += ["", "### External Influences"]
+    for title in ("Holiday Sales Impact", "Weather Influence", "Discount Impact"):
+        lines += [f"- {' / '.join(row[:-1])}: average sale {row[-1]}" for row in section(title)]
+    lines += ["", "### Strategic Recommendations",
+              "- Keep the top products in stock ahead of holidays.",
+              "- Review discount levels that do not lift average sales."]
+    return "\n".join(lines)
+
+
+class StubLLMServer:
+    """
+    OpenAI-compatible /chat/completions endpoint on localhost that answers with
+    stub_insight() after `latency` seconds. `model_latency` overrides the latency
+    per requested model and models in `failing_models` answer with a 500. Use as
+    a context manager; base_url is what OPENROUTER_BASE_URL should point to.
+    """
+
+    def __init__(self, latency=0.0, model_latency=None, failing_models=()):
+        self.latency = latency
+        self.model_latency = dict(model_latency or {})
+        self.failing_models = set(failing_models)
+        self.requests = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not self.path.endswith("/chat/completions"):
+                    self._reply(404, {"error": {"message": f"no route for {self.path}"}})
+                    return
+                with stub._lock:
+                    stub.requests += 1
+                model = request.get("model", "stub")
+                if model in stub.failing_models:
+                    self._reply(500, {"error": {"message": f"{model} is failing"}})
+                    return
+                time.sleep(stub.model_latency.get(model, stub.latency))
+                prompt = request["messages"][-1]["content"]
+                try:
+                    content = stub_insight(prompt)
+                except Exception as e:
+                    self._reply(500, {"error": {"message": f"stub failed: {e}"}})
+                    return
+                self._reply(200, {
+                    "id": "stub-" + hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16],
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": content}}],
+                    "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4,
+                              "total_tokens": (len(prompt) + len(content)) // 4},
+                })
+
+            def _reply(self, status, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client timed out and closed the connection
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
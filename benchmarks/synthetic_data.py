@@ -0,0 +1,187 @@
+"""
+Synthetic raw retail uploads with the columns the data cleaner expects
+(FreshRetailNet layout: one row per store, product and day), written in chunks
+so anything from 10k to 100M rows can be generated in bounded memory.
+
+A small share of the rows is deliberately dirty, the way real uploads are:
+missing and outlier sale amounts, US-style dates, badly cased product names
+and exact duplicate rows.
+
+Usage:
+    python benchmarks/synthetic_data.py out.csv [--rows 1M] [--days 90] [--dirty 0.01] [--no-hourly]
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+COLUMNS = [
+    "city_id", "store_id", "management_group_id", "first_category_id", "second_category_id",
+    "third_category_id", "product_id", "product_name", "dt", "sale_amount", "quantity", "hours_sale",
+    "stock_hour6_22_cnt", "hours_stock_status", "discount", "holiday_flag", "activity_flag",
+    "precpt", "avg_temperature", "avg_humidity", "avg_wind_level",
+]
+CHUNK_ROWS = 1_000_000
+# Hourly sale/stock profiles are drawn from a small pool: they are dropped by the
+# cleaner, but keep the raw file about as wide as a real upload (~4x wider than without)
+HOURLY_PROFILES = 64
+HOURLY_COLUMNS = ["hours_sale", "hours_stock_status"]
+# One name per product id; a chunk holds as many distinct names as products
+BRANDS = ["Fresh Farm", "Golden Mill", "Blue Coast", "Green Valley", "Sunrise", "Old Oak", "Riverside"]
+GOODS = ["whole milk", "rye bread", "apples", "cheddar", "yogurt", "coffee beans", "rice", "olive oil",
+         "tomatoes", "orange juice", "butter", "pasta", "eggs"]
+
+
+def product_names(products):
+    return np.array([f"{BRANDS[pid % len(BRANDS)]} {GOODS[pid // len(BRANDS) % len(GOODS)]} {pid}"
+                     for pid in range(products)], dtype=object)
+
+
+def parse_rows(value):
+    """'10k', '2.5M' or '100000' -> int."""
+    value = str(value).strip().lower().replace("_", "")
+    scale = {"k": 1_000, "m": 1_000_000, "b": 1_000_000_000}.get(value[-1:], 1)
+    return int(float(value[:-1] if scale > 1 else value) * scale)
+
+
+def hourly_profiles(rng):
+    sales = rng.gamma(0.6, 0.15, (HOURLY_PROFILES, 24)).round(2)
+    stock = (rng.random((HOURLY_PROFILES, 24)) < 0.1).astype(int)
+    return (
+        np.array(["[" + ", ".join(f"{v:g}" for v in row) + "]" for row in sales], dtype=object),
+        np.array(["[" + ", ".join(str(v) for v in row) + "]" for row in stock], dtype=object),
+        24 - stock[:, 6:23].sum(axis=1),
+    )
+
+
+def make_chunk(first_row, rows, calendar, weather, profiles, names, cities, dirty, rng):
+    """Rows [first_row, first_row + rows): row i is day i % days of store/product series i // days."""
+    days = len(calendar["dates"])
+    index = np.arange(first_row, first_row + rows)
+    series, day = np.divmod(index, days)
+    product_id = series % len(names)
+    store_id = series // len(names)
+    city_id = store_id % cities
+    precpt, avg_temperature, avg_humidity, avg_wind_level = (w[city_id, day] for w in weather)
+    holiday_flag = calendar["holiday"][day]
+
+    discount = np.where(rng.random(rows) < 0.4, 0.0, rng.uniform(0.05, 0.95, rows).round(2))
+    activity_flag = (rng.random(rows) < 0.15).astype(int)
+    # Popular products sell more; holidays, promotions and rain move the rest
+    base = 0.3 + 2.5 / (1 + product_id % 97)
+    sale_amount = rng.gamma(1.5, base * (1 + 0.3 * holiday_flag + 0.4 * activity_flag + 0.5 * discount)
+                            * np.where(precpt > 5, 0.85, 1.0)).round(2)
+    quantity = np.maximum(0, np.rint(sale_amount * rng.uniform(0.8, 1.6, rows))).astype(int)
+    profile = rng.integers(0, HOURLY_PROFILES, rows)
+    dates = calendar["dates"][day].astype(object)
+    product_name = names[product_id]
+
+    if dirty:
+        marks = rng.random(rows)
+        sale_amount = sale_amount.astype(float)
+        sale_amount[marks < dirty * 0.3] = np.nan
+        sale_amount[(marks >= dirty * 0.3) & (marks < dirty * 0.5)] *= 60
+        us_dates = (marks >= dirty * 0.5) & (marks < dirty)
+        dates[us_dates] = calendar["us_dates"][day[us_dates]]
+        messy = (marks >= dirty) & (marks < dirty * 1.2)
+        product_name = product_name.copy()
+        product_name[messy] = [f" {name.upper()} " for name in product_name[messy]]
+
+    chunk = pd.DataFrame({
+        "city_id": city_id,
+        "store_id": store_id,
+        "management_group_id": product_id % 7,
+        "first_category_id": product_id % 31,
+        "second_category_id": product_id % 113,
+        "third_category_id": product_id % 281,
+        "product_id": product_id,
+        "product_name": product_name,
+        "dt": dates,
+        "sale_amount": sale_amount,
+        "quantity": quantity,
+        "hours_sale": profiles[0][profile],
+        "stock_hour6_22_cnt": profiles[2][profile],
+        "hours_stock_status": profiles[1][profile],
+        "discount": discount,
+        "holiday_flag": holiday_flag,
+        "activity_flag": activity_flag,
+        "precpt": precpt,
+        "avg_temperature": avg_temperature,
+        "avg_humidity": avg_humidity,
+        "avg_wind_level": avg_wind_level,
+    }, columns=COLUMNS)
+
+    if dirty:
+        # Re-sent rows, as when a store's export is uploaded twice
+        repeats = chunk[rng.random(rows) < dirty * 0.2]
+        chunk = pd.concat([chunk, repeats]) if len(repeats) else chunk
+    return chunk
+
+
+def generate(path, rows, days=90, start="2024-03-28", products=800, cities=18, dirty=0.01, seed=42,
+             hourly=True, chunk_rows=CHUNK_ROWS, append=False):
+    """
+    Writes `rows` synthetic rows (plus a few duplicates when dirty) to the CSV at
+    `path`, or adds them without a header with append=True; hourly=False leaves
+    out the wide hours_* columns. Returns {"rows", "bytes", "seconds",
+    "first_date", "last_date"}.
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(start, periods=days, freq="D")
+    calendar = {
+        "dates": np.array(dates.strftime("%Y-%m-%d")),
+        "us_dates": np.array(dates.strftime("%m/%d/%Y")),
+        "holiday": ((dates.dayofweek.to_numpy() >= 5) | (rng.random(days) < 0.03)).astype(int),
+    }
+    # Weather is shared by every store of a city on a given day
+    season = 12 * np.sin(np.linspace(0, np.pi, days))
+    weather = (
+        np.where(rng.random((cities, days)) < 0.3, rng.exponential(8, (cities, days)), 0.0).round(1),
+        (rng.normal(18, 6, (cities, 1)) + season + rng.normal(0, 2.5, (cities, days))).round(1),
+        rng.uniform(35, 95, (cities, days)).round(0),
+        rng.uniform(0.5, 4.5, (cities, days)).round(1),
+    )
+    profiles = hourly_profiles(rng)
+    names = product_names(products)
+
+    start_time = time.perf_counter()
+    written = 0
+    with open(path, "a" if append else "w", newline="") as out:
+        for first_row in range(0, rows, chunk_rows):
+            chunk = make_chunk(first_row, min(chunk_rows, rows - first_row), calendar, weather, profiles,
+                               names, cities, dirty, rng)
+            if not hourly:
+                chunk = chunk.drop(columns=HOURLY_COLUMNS)
+            chunk.to_csv(out, index=False, header=first_row == 0 and not append)
+            written += len(chunk)
+    return {
+        "rows": written,
+        "bytes": os.path.getsize(path),
+        "seconds": round(time.perf_counter() - start_time, 3),
+        "first_date": calendar["dates"][0],
+        "last_date": calendar["dates"][min(days, max(rows, 1)) - 1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument("--rows", default="1M", help="e.g. 10k, 1M, 100M")
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--start", default="2024-03-28")
+    parser.add_argument("--products", type=int, default=800)
+    parser.add_argument("--dirty", type=float, default=0.01, help="share of rows with injected problems")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-hourly", action="store_true", help="leave out the wide hours_* columns")
+    args = parser.parse_args()
+
+    stats = generate(args.path, parse_rows(args.rows), days=args.days, start=args.start,
+                     products=args.products, dirty=args.dirty, seed=args.seed, hourly=not args.no_hourly)
+    print(f"Wrote {stats['rows']:,} rows ({stats['bytes'] / 2**20:.1f} MB, {stats['first_date']} to "
+          f"{stats['last_date']}) to {args.path} in {stats['seconds']:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,124 +1,929 @@
 import json
-import boto3
-import pandas as pd
-import numpy as np
-from dateutil.parser import parse
 from io import BytesIO
 import os
+import shutil
+import tempfile
+import time
+import urllib.parse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
+from runtime import LazyClient, lazy_import, load_now
+import telemetry
 
-s3 = boto3.client("s3")
+# pandas/numpy load on the first cleaned file, not for events this Lambda ignores
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
+dateutil_parser = lazy_import("dateutil.parser")
+
+# --- Partition upload settings ---
+# Partitions are serialized and uploaded by a bounded thread pool sharing one S3 client.
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "8"))
+UPLOAD_PART_CONCURRENCY = int(os.environ.get("UPLOAD_PART_CONCURRENCY", "4"))
+MULTIPART_THRESHOLD_MB = int(os.environ.get("MULTIPART_THRESHOLD_MB", "64"))
+# Files from one batched event that are cleaned at the same time
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", "4"))
+
+# Every file cleaned at once runs its own upload pool on this client
+s3 = LazyClient("s3", max_pool_connections=max(10, BATCH_WORKERS * UPLOAD_WORKERS * UPLOAD_PART_CONCURRENCY))
+
+# --- Streaming mode for large uploads ---
+# Objects larger than STREAM_THRESHOLD_MB are cleaned chunk by chunk instead of
+# being loaded into a single DataFrame (0 disables streaming entirely).
+STREAM_THRESHOLD_MB = int(os.environ.get("STREAM_THRESHOLD_MB", "512"))
+STREAM_CHUNK_ROWS = int(os.environ.get("STREAM_CHUNK_ROWS", "200000"))
+# Per-column reservoir used to estimate IQR bounds and fill values in pass 1.
+# Files with fewer non-null values than this get exact statistics.
+STREAM_SAMPLE_SIZE = int(os.environ.get("STREAM_SAMPLE_SIZE", "200000"))
+
+# --- Output format for cleaned partitions ---
+# "csv" keeps the original layout; "parquet" writes typed, compressed files with a
+# fixed schema so Athena scans less and the Glue table stops drifting between uploads.
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "csv").lower()
+PARQUET_COMPRESSION = os.environ.get("PARQUET_COMPRESSION", "snappy")
+# A dt= partition holds a single day, so by default it is written as one row group
+PARQUET_ROW_GROUP_ROWS = int(os.environ.get("PARQUET_ROW_GROUP_ROWS", "1000000"))
+
+DROP_COLS = ['hours_sale', 'hours_stock_status']
+
+# --- Daily rollup ---
+# A small per-day aggregate written next to each upload's dt= partitions, so the
+# report can read sums and counts instead of rescanning the row-level data
+ROLLUP_ENABLED = os.environ.get("ROLLUP_ENABLED", "true").lower() == "true"
+ROLLUP_PREFIX = "retail-rollups"
+# grain -> columns it is grouped by (stored as key1/key2)
+ROLLUP_GRAINS = {
+    'day': [],
+    'product': ['product_id'],
+    'city': ['city_id'],
+    'store': ['store_id'],
+    'holiday': ['day_type'],
+    'weather': ['weather', 'temp_range'],
+    'discount': ['discount_level'],
+}
+ROLLUP_COLUMNS = ['date', 'grain', 'key1', 'key2', 'total_sales', 'sales_count', 'row_count', 'active_stores']
+
+# --- Cross-upload deduplication ---
+# Every dt= partition has an index of the rows already written to it: sorted
+# uint64 hashes of DEDUP_KEYS, kept outside the table location under
+# INGEST_INDEX_PREFIX. Rows whose key an earlier upload wrote are dropped, so
+# re-sent or overlapping exports add no data for Athena to scan.
+DEDUP_ENABLED = os.environ.get("DEDUP_ENABLED", "true").lower() == "true"
+DEDUP_KEYS = [col.strip() for col in os.environ.get("DEDUP_KEYS", "store_id,product_id,date").split(",") if col.strip()]
+INGEST_INDEX_PREFIX = os.environ.get("INGEST_INDEX_PREFIX", "retail-ingest-index")
+# Each upload adds one index piece per partition; above this many they are merged into one
+INGEST_INDEX_MAX_PIECES = int(os.environ.get("INGEST_INDEX_MAX_PIECES", "8"))
+
+# --- Upload manifest ---
+# One JSON per cleaned upload, written once all of its files are in place. Its S3
+# event tells the glue trigger (register mode) that the whole upload can be announced.
+UPLOAD_MANIFEST_PREFIX = os.environ.get("UPLOAD_MANIFEST_PREFIX", "retail-upload-manifests")
 
-def lambda_handler(event, context):
-    print("Lambda triggered with event:", json.dumps(event))
 
+def standardize_columns(df):
+    df.columns = df.columns.str.strip().str.lower().str.replace(' ', '_')
+    # Check if the column 'dt' exists and rename it to 'date'
+    if 'dt' in df.columns:
+        df.rename(columns={'dt': 'date'}, inplace=True)
+    return df
+
+
+# Formats tried vectorized before falling back to dateutil. Only unambiguous,
+# zero-padded layouts that dateutil reads the same way belong here.
+DATE_FORMATS = [
+    '%Y-%m-%d',
+    '%Y/%m/%d',
+    '%m/%d/%Y',
+    '%m-%d-%Y',
+    '%Y%m%d',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S',
+]
+
+
+def try_parse_date(x):
     try:
-        # Step 1: Extract bucket and key
-        bucket = event['Records'][0]['s3']['bucket']['name']
-        key = event['Records'][0]['s3']['object']['key']
-        print(f"File received: Bucket = {bucket}, Key = {key}")
+        return dateutil_parser.parse(str(x))
+    except:
+        return pd.NaT
+
+
+def parse_dates(series):
+    """
+    Same result as series.apply(try_parse_date), but each distinct raw value is
+    parsed once and known formats are handled by pd.to_datetime in bulk.
+    """
+    if series.empty:
+        return series.apply(try_parse_date)
+
+    raw = series.astype(str)
+    pending = pd.Series(raw.unique())
+    resolved = pd.Series(pd.NaT, index=pending.index, dtype=object)
+
+    for fmt in DATE_FORMATS:
+        if pending.empty:
+            break
+        attempt = pd.to_datetime(pending, format=fmt, errors='coerce')
+        # Only accept values that round-trip, so '1/2/2024'-style input still goes to dateutil
+        matched = attempt.notna() & (attempt.dt.strftime(fmt) == pending)
+        resolved[matched[matched].index] = attempt[matched]
+        pending = pending[~matched]
+
+    # Per-row dateutil fallback only for the leftover distinct values
+    if not pending.empty:
+        resolved[pending.index] = pending.map(try_parse_date)
+
+    lookup = pd.Series(resolved.tolist(), index=raw.unique())
+    return raw.map(lookup)
+
+
+def coerce_numeric(df):
+    if 'sale_amount' in df.columns:
+        df['sale_amount'] = pd.to_numeric(df['sale_amount'], errors='coerce')
+    if 'quantity' in df.columns:
+        df['quantity'] = pd.to_numeric(df['quantity'], errors='coerce')
+    return df
+
+
+def column_matrix(values):
+    """The columns of a numeric frame as the rows of one float64 array, each column contiguous."""
+    data = np.empty((len(values.columns), len(values)), dtype="float64")
+    for row, col in enumerate(values.columns):
+        data[row] = values[col].to_numpy()
+    return data
+
+
+def as_frame(data, values):
+    """Wraps a column_matrix() array as a frame shaped like `values`, without copying."""
+    return pd.DataFrame(data.T, index=values.index, columns=values.columns, copy=False)
+
+
+def numeric_stats(values):
+    """
+    IQR fences and fill values for every column of a numeric frame at once: one
+    quantile call, then the median of the values inside the fences and the mean
+    once outliers are replaced by that median (NaN is ignored throughout).
+    Returns a frame indexed by column with lower/upper/median/mean.
+    """
+    data = column_matrix(values)
+    quantiles = as_frame(data, values).quantile([0.25, 0.75])
+    q1, q3 = quantiles.loc[0.25], quantiles.loc[0.75]
+    iqr = q3 - q1
+    lower, upper = q1 - 1.5 * iqr, q3 + 1.5 * iqr
+    outliers = (data < lower.to_numpy()[:, None]) | (data > upper.to_numpy()[:, None])
+    data[outliers] = np.nan
+    median = as_frame(data, values).median()
+    np.copyto(data, median.to_numpy()[:, None], where=outliers)
+    mean = as_frame(data, values).mean()
+    return pd.DataFrame({'lower': lower, 'upper': upper, 'median': median, 'mean': mean})
+
+
+def fill_numeric(values, stats):
+    """
+    Steps 6-7 in place on one float64 copy of the columns: values outside the
+    fences become the column median, missing values the column mean, and
+    everything is rounded to 2 places.
+    Returns (filled float64 frame, number of outliers replaced).
+    """
+    stats = stats.loc[values.columns]
+    data = column_matrix(values)
+    outliers = (data < stats['lower'].to_numpy()[:, None]) | (data > stats['upper'].to_numpy()[:, None])
+    count = int(outliers.sum())
+    np.copyto(data, stats['median'].to_numpy()[:, None], where=outliers)
+    del outliers
+    np.copyto(data, stats['mean'].to_numpy()[:, None], where=np.isnan(data))
+    np.round(data, 2, out=data)
+    return as_frame(data, values), count
+
+
+def clean_text(values):
+    """Step 8 for an array of raw values: str(), strip, 'nan' -> 'unknown', lower-case."""
+    return pd.Series(values, dtype=object).astype(str).str.strip().replace("nan", "unknown").str.lower()
+
+
+def clean_strings(df):
+    """
+    Step 8 once per distinct value instead of once per row: each text column is
+    factorized, its distinct values cleaned, and the column stored as a
+    categorical of the cleaned text (same values on output, a fraction of the memory).
+    """
+    for col in df.select_dtypes(include='object').columns:
+        codes, uniques = pd.factorize(df[col], use_na_sentinel=False)
+        # factorize treats 1, 1.0 and True as one value, but str() doesn't
+        if any(not isinstance(value, str) and value == value for value in uniques):
+            codes, uniques = pd.factorize(df[col].astype(str))
+        cleaned = clean_text(uniques)
+        if col == 'city':
+            cleaned = cleaned.str.title()
+        # Different raw values can clean to the same text (" A" and "a")
+        cleaned_codes, categories = pd.factorize(cleaned)
+        df[col] = pd.Categorical.from_codes(cleaned_codes[codes], categories=categories)
+    return df
+
+
+def parquet_schema(df):
+    """
+    Column types depend only on the pandas dtype kind, never on the values in a
+    particular upload: numbers are double, dates are timestamps, the rest is text.
+    """
+    import pyarrow as pa
+
+    fields = []
+    for col, dtype in df.dtypes.items():
+        if col == 'date' and dtype.kind == 'M':
+            fields.append(pa.field(col, pa.timestamp('ms')))
+        elif dtype.kind == 'b':
+            fields.append(pa.field(col, pa.bool_()))
+        elif dtype.kind in 'iuf':
+            fields.append(pa.field(col, pa.float64()))
+        else:
+            fields.append(pa.field(col, pa.string()))
+    return pa.schema(fields)
 
-        # Step 2: Read the file from S3
-        response = s3.get_object(Bucket=bucket, Key=key)
-        file_content = response['Body'].read()
 
+def partition_filename(timestamp, partition_value, filename_base):
+    new_filename = f"cleaned_{timestamp}_{partition_value}_{filename_base}"
+    if OUTPUT_FORMAT == 'parquet':
+        new_filename = os.path.splitext(new_filename)[0] + '.parquet'
+    return new_filename
+
+
+def serialize_partition(sub_df):
+    cleaned_buffer = BytesIO()
+    if OUTPUT_FORMAT == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # Text columns are categoricals in memory but plain strings in the file
+        sub_df = sub_df.astype({col: object for col, dtype in sub_df.dtypes.items() if dtype == 'category'})
+        table = pa.Table.from_pandas(sub_df, schema=parquet_schema(sub_df), preserve_index=False, safe=False)
+        pq.write_table(
+            table,
+            cleaned_buffer,
+            compression=PARQUET_COMPRESSION,
+            row_group_size=PARQUET_ROW_GROUP_ROWS,
+        )
+    else:
+        sub_df.to_csv(cleaned_buffer, index=False)
+    return cleaned_buffer.getvalue()
+
+
+def merge_parquet_pieces(path):
+    """Pieces spooled by serialize_partition, rewritten as one file without a pandas round trip."""
+    import pyarrow.parquet as pq
+
+    merged_buffer = BytesIO()
+    pq.write_table(
+        pq.read_table(path),
+        merged_buffer,
+        compression=PARQUET_COMPRESSION,
+        row_group_size=PARQUET_ROW_GROUP_ROWS,
+    )
+    return merged_buffer.getvalue()
+
+
+def write_partitions(bucket, jobs, stage="write_partitions", on_uploaded=None):
+    """
+    Serializes and uploads partitions concurrently. `jobs` yields
+    (partition_value, cleaned_key, open_body) where open_body() returns a binary
+    file object; at most 2 * UPLOAD_WORKERS jobs are in flight, so only that many
+    serialized partitions are held in memory at once. Parts above
+    MULTIPART_THRESHOLD_MB go up as multipart uploads. on_uploaded(partition_value)
+    runs in the worker as soon as that partition's upload has succeeded. Returns
+    per-partition timings, and emits their totals as the `stage` metric.
+    """
+    from boto3.s3.transfer import TransferConfig
+
+    transfer_config = TransferConfig(
+        multipart_threshold=MULTIPART_THRESHOLD_MB * 1024 * 1024,
+        multipart_chunksize=MULTIPART_THRESHOLD_MB * 1024 * 1024,
+        max_concurrency=UPLOAD_PART_CONCURRENCY,
+    )
+
+    def upload(partition_value, cleaned_key, open_body):
+        start = time.perf_counter()
+        with open_body() as body:
+            serialized = time.perf_counter()
+            size = body.seek(0, os.SEEK_END)
+            body.seek(0)
+            s3.upload_fileobj(body, bucket, cleaned_key, Config=transfer_config)
+        uploaded = time.perf_counter()
+        if on_uploaded:
+            on_uploaded(partition_value)
+        print(
+            f"Uploaded partition {partition_value} → s3://{bucket}/{cleaned_key} "
+            f"({size / 1024:.1f} KB, serialize {serialized - start:.2f}s, upload {uploaded - serialized:.2f}s)"
+        )
+        return {
+            'partition': partition_value,
+            'key': cleaned_key,
+            'bytes': size,
+            'serialize_seconds': round(serialized - start, 3),
+            'upload_seconds': round(uploaded - serialized, 3),
+        }
+
+    start = time.perf_counter()
+    timings = []
+    with telemetry.span(stage, workers=UPLOAD_WORKERS) as span:
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+            pending = set()
+            for job in jobs:
+                if len(pending) >= 2 * UPLOAD_WORKERS:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    timings.extend(f.result() for f in done)
+                pending.add(pool.submit(upload, *job))
+            timings.extend(f.result() for f in pending)
+        span.set(
+            partitions=len(timings),
+            bytes_out=sum(t['bytes'] for t in timings),
+            serialize_ms=round(sum(t['serialize_seconds'] for t in timings) * 1000),
+            upload_ms=round(sum(t['upload_seconds'] for t in timings) * 1000),
+        )
+
+    print(f"Wrote {len(timings)} partitions in {time.perf_counter() - start:.2f}s using {UPLOAD_WORKERS} workers")
+    return sorted(timings, key=lambda t: t['partition'])
+
+
+def rollup_buckets(df):
+    """Bucket labels exactly as the report queries compute them, including NULL handling."""
+    buckets = pd.DataFrame(index=df.index)
+    if 'holiday_flag' in df.columns:
+        buckets['day_type'] = np.where(df['holiday_flag'].fillna(0) >= 0.9, 'Holiday', 'Non-Holiday')
+    if 'precpt' in df.columns and 'avg_temperature' in df.columns:
+        buckets['weather'] = np.where(df['precpt'] > 5, 'Rainy', 'Dry')
+        buckets['temp_range'] = np.select(
+            [df['avg_temperature'] < 15, df['avg_temperature'].between(15, 30)], ['Cold', 'Moderate'], 'Hot'
+        )
+    if 'discount' in df.columns:
+        buckets['discount_level'] = np.select(
+            [df['discount'] == 0, df['discount'] < 0.5], ['No Discount', 'Low Discount'], 'High Discount'
+        )
+    return buckets
+
+
+class DailyRollup:
+    """
+    Accumulates per-day sums and counts by product, city, store and by the
+    holiday/weather/discount buckets, from one DataFrame or many chunks.
+
+    active_stores (product grain) is the exact number of distinct stores that
+    sold the product that day. Summed over days it gives the report's distinct
+    store-days, so no approximate sketch is needed for the single distinct count
+    the report uses.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.active_pairs = []
+
+    def add(self, df):
+        if 'date' not in df.columns or 'sale_amount' not in df.columns or df.empty:
+            return
+        frame = pd.concat([df, rollup_buckets(df)], axis=1)
+        for grain, keys in ROLLUP_GRAINS.items():
+            if not all(col in frame.columns for col in keys):
+                continue
+            part = frame.groupby(['date'] + keys, dropna=False)['sale_amount'].agg(
+                total_sales='sum', sales_count='count', row_count='size'
+            ).reset_index()
+            part['grain'] = grain
+            part['key1'] = part[keys[0]].astype(str) if keys else ''
+            part['key2'] = part[keys[1]].astype(str) if len(keys) > 1 else ''
+            self.parts.append(part[['date', 'grain', 'key1', 'key2', 'total_sales', 'sales_count', 'row_count']])
+        if 'product_id' in df.columns and 'store_id' in df.columns:
+            sold = df.loc[df['sale_amount'] > 0, ['date', 'product_id', 'store_id']]
+            self.active_pairs.append(sold.drop_duplicates())
+
+    def partitions(self):
+        """Yields (partition_value, rollup DataFrame) per day."""
+        if not self.parts:
+            return
+        rollup = pd.concat(self.parts).groupby(['date', 'grain', 'key1', 'key2'], as_index=False).sum()
+        if self.active_pairs:
+            pairs = pd.concat(self.active_pairs).drop_duplicates()
+            active = pairs.groupby(['date', 'product_id']).size().rename('active_stores').reset_index()
+            active['grain'] = 'product'
+            active['key1'] = active['product_id'].astype(str)
+            active['key2'] = ''
+            rollup = rollup.merge(active[['date', 'grain', 'key1', 'key2', 'active_stores']],
+                                  on=['date', 'grain', 'key1', 'key2'], how='left')
+        else:
+            rollup['active_stores'] = np.nan
+        rollup['active_stores'] = rollup['active_stores'].fillna(0)
+        for dt_val, sub_df in rollup[ROLLUP_COLUMNS].groupby('date'):
+            # `date` is yyyy-MM-dd text in both formats, matching the daily_rollup DDL
+            yield dt_val.strftime('%Y-%m-%d'), sub_df.assign(date=sub_df['date'].dt.strftime('%Y-%m-%d'))
+
+
+def partition_committer(bucket, rollup, index, timestamp, filename_base):
+    """
+    on_uploaded step for write_partitions: once a partition's rows are in S3, its
+    rollup is written and only then its ingest index piece. A retry after a partial
+    failure skips exactly the rows whose rollup already landed.
+    """
+    rollups = dict(rollup.partitions()) if rollup else {}
+
+    def commit(partition_value):
+        sub_df = rollups.pop(partition_value, None)
+        if sub_df is not None:
+            new_filename = partition_filename(timestamp, partition_value, filename_base).replace("cleaned_", "rollup_", 1)
+            s3.put_object(Bucket=bucket, Key=f"{ROLLUP_PREFIX}/dt={partition_value}/{new_filename}",
+                          Body=serialize_partition(sub_df))
+        if index:
+            index.save(partition_value)
+
+    return commit
+
+
+def write_upload_manifest(bucket, key, timestamp, filename_base, timings):
+    """Lists the dt= partitions and files one upload wrote. Nothing is written when it added no rows."""
+    if not timings:
+        return
+    manifest_key = f"{UPLOAD_MANIFEST_PREFIX}/{timestamp}_{os.path.splitext(filename_base)[0]}.json"
+    s3.put_object(Bucket=bucket, Key=manifest_key, ContentType='application/json', Body=json.dumps({
+        'source': f"s3://{bucket}/{key}",
+        'partitions': [t['partition'] for t in timings],
+        'keys': [t['key'] for t in timings],
+    }))
+
+
+def row_fingerprints(df):
+    """
+    One uint64 per row from its DEDUP_KEYS. Cleaned numeric keys are always
+    float64 and dates datetime64, so the same key hashes the same in every upload.
+    """
+    return pd.util.hash_pandas_object(df[DEDUP_KEYS], index=False).to_numpy()
+
+
+def index_piece_key(partition_value, name):
+    return f"{INGEST_INDEX_PREFIX}/dt={partition_value}/{datetime.now():%Y%m%d%H%M%S%f}_{name}.npy"
+
+
+def save_index_piece(bucket, key, fingerprints):
+    buffer = BytesIO()
+    np.save(buffer, fingerprints, allow_pickle=False)
+    s3.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue(), ContentType='application/octet-stream')
+
+
+def load_index(bucket, partition_value):
+    """
+    Fingerprints already ingested into one partition, sorted. Pieces are never
+    rewritten, so concurrent uploads can't lose each other's entries; once there
+    are more than INGEST_INDEX_MAX_PIECES they are merged into one piece.
+    """
+    prefix = f"{INGEST_INDEX_PREFIX}/dt={partition_value}/"
+    paginator = s3.get_paginator("list_objects_v2")
+    while True:
+        keys = [obj['Key'] for page in paginator.paginate(Bucket=bucket, Prefix=prefix) for obj in page.get('Contents', [])]
         try:
-            df = pd.read_csv(BytesIO(file_content))
-            print("Raw preview:\n", df.head())
+            pieces = [np.load(BytesIO(s3.get_object(Bucket=bucket, Key=key)['Body'].read()), allow_pickle=False)
+                      for key in keys]
+            break
+        except s3.exceptions.NoSuchKey:
+            # Another upload merged the pieces between listing and reading
+            continue
+
+    fingerprints = np.unique(np.concatenate(pieces)) if pieces else np.empty(0, dtype="uint64")
+    if len(keys) > INGEST_INDEX_MAX_PIECES:
+        save_index_piece(bucket, index_piece_key(partition_value, "merged"), fingerprints)
+        for key in keys:
+            s3.delete_object(Bucket=bucket, Key=key)
+    return fingerprints
+
+
+class IngestIndex:
+    """
+    Drops rows whose key an earlier upload already wrote to the same dt=
+    partition, from one DataFrame or many chunks, and records the keys this
+    upload adds as each partition is written (save(partition_value)), so a
+    retry after a partial failure only rewrites the partitions that never
+    landed. Rows sharing a key within one upload are left to the usual
+    duplicate handling.
+    """
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.ingested = {}
+        self.added = defaultdict(list)
+
+    def load(self, partition_values):
+        missing = [value for value in partition_values if value not in self.ingested]
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(UPLOAD_WORKERS, len(missing))) as pool:
+                self.ingested.update(zip(missing, pool.map(lambda value: load_index(self.bucket, value), missing)))
+
+    def filter(self, df):
+        """Rows of `df` not already ingested. Rows without a date are kept (they are never written)."""
+        partitions = defaultdict(list)
+        for dt_val, positions in df.groupby('date').indices.items():
+            partitions[dt_val.strftime('%Y-%m-%d')].append(positions)
+        if not partitions:
+            return df
+        self.load(list(partitions))
+
+        fingerprints = row_fingerprints(df)
+        keep = np.ones(len(df), dtype=bool)
+        for partition_value, parts in partitions.items():
+            positions = np.concatenate(parts)
+            seen = np.isin(fingerprints[positions], self.ingested[partition_value])
+            keep[positions[seen]] = False
+            self.added[partition_value].append(fingerprints[positions[~seen]])
+        return df if keep.all() else df[keep]
+
+    def save(self, partition_value):
+        """Writes the index piece for one partition once its rows have been uploaded."""
+        parts = self.added.pop(partition_value, None)
+        fingerprints = np.unique(np.concatenate(parts)) if parts else []
+        if len(fingerprints):
+            save_index_piece(self.bucket, index_piece_key(partition_value, self.name), fingerprints)
+
+
+def ingest_index(bucket, columns, filename_base):
+    """An IngestIndex for an upload with these columns, or None when deduplication is off or impossible."""
+    if not DEDUP_ENABLED:
+        return None
+    missing = [col for col in DEDUP_KEYS if col not in columns]
+    if missing:
+        print(f"Cross-upload deduplication skipped, missing key columns: {missing}")
+        return None
+    return IngestIndex(bucket, os.path.splitext(filename_base)[0])
+
+
+class ReservoirSample:
+    """Fixed-size uniform sample of a numeric column (Algorithm R, vectorized per chunk)."""
+
+    def __init__(self, size, seed=0):
+        self.size = size
+        self.seen = 0
+        self.values = np.empty(0, dtype="float64")
+        self.rng = np.random.default_rng(seed)
+
+    def add(self, values):
+        values = np.asarray(values, dtype="float64")
+        free = self.size - len(self.values)
+        if free > 0:
+            self.values = np.concatenate([self.values, values[:free]])
+            self.seen += min(free, len(values))
+            values = values[free:]
+        if len(values) == 0:
+            return
+        positions = self.seen + np.arange(1, len(values) + 1)
+        slots = (self.rng.random(len(values)) * positions).astype("int64")
+        keep = slots < self.size
+        self.values[slots[keep]] = values[keep]
+        self.seen += len(values)
+
+    @property
+    def exact(self):
+        return self.seen <= self.size
+
+
+class SeenRows:
+    """
+    Hashes of the rows already written from this file, kept per dt= partition since
+    rows with different dates are never duplicates. Each partition holds a few sorted
+    runs, each at most half the size of the one before it, so a chunk is checked with
+    binary searches instead of re-sorting every hash seen so far.
+    """
+
+    def __init__(self):
+        self.runs = defaultdict(list)
+
+    def fresh(self, partition, hashes):
+        """Marks the first occurrence of each row not seen before, and remembers them."""
+        keep = ~pd.Series(hashes).duplicated().to_numpy()
+        runs = self.runs[partition]
+        for run in runs:
+            found = run[np.searchsorted(run, hashes).clip(max=len(run) - 1)] == hashes
+            keep &= ~found
+        if keep.any():
+            runs.append(np.sort(hashes[keep]))
+        while len(runs) > 1 and 2 * len(runs[-1]) > len(runs[-2]):
+            newest = runs.pop()
+            runs[-1] = np.sort(np.concatenate([runs[-1], newest]))
+        return keep
+
+    def close(self):
+        self.runs.clear()
+
+
+def scan_column_stats(body):
+    """
+    Pass 1 of streaming mode: find which columns are numeric across the whole file
+    and build per-column samples for the outlier bounds and fill values. Columns
+    that read as bool in every chunk are reported too, so pass 2 keeps them bool
+    instead of reading them as text.
+    """
+    numeric = None
+    boolean = None
+    samples = {}
+    raw_columns = []
+    rows = 0
+
+    for chunk in pd.read_csv(body, chunksize=STREAM_CHUNK_ROWS):
+        raw_columns = raw_columns or list(chunk.columns)
+        chunk = coerce_numeric(standardize_columns(chunk))
+        rows += len(chunk)
+        chunk_numeric = [c for c in chunk.select_dtypes(include='number').columns if c != 'date']
+        numeric = chunk_numeric if numeric is None else [c for c in numeric if c in chunk_numeric]
+        chunk_boolean = list(chunk.select_dtypes(include='bool').columns)
+        boolean = chunk_boolean if boolean is None else [c for c in boolean if c in chunk_boolean]
+
+        for col in numeric:
+            sample = samples.setdefault(col, ReservoirSample(STREAM_SAMPLE_SIZE))
+            sample.add(chunk[col].dropna().to_numpy())
+
+    # Samples differ in length; the NaN padding is ignored by the statistics
+    stats = numeric_stats(pd.DataFrame({col: pd.Series(samples[col].values) for col in numeric or []}, dtype="float64"))
+    stats['exact'] = [samples[col].exact for col in stats.index]
+
+    print(f"Stats pass complete: {rows} rows, numeric columns = {list(stats.index)}")
+    return raw_columns, stats, boolean or []
+
+
+def stream_clean(bucket, key, body):
+    """
+    Cleans a large object in bounded chunks. Pass 1 collects column statistics,
+    pass 2 re-reads the object and appends each cleaned chunk to per-date spool
+    files in /tmp, which are uploaded once the whole file has been processed.
+    In Parquet mode each partition is spooled as pieces and merged into a single
+    file (one row group) at upload time, so memory is bounded by one day of data.
+    """
+    with telemetry.span("stats_pass", mode="stream") as span:
+        raw_columns, stats, bool_cols = scan_column_stats(body)
+        span.set(numeric_columns=len(stats))
+    num_cols = list(stats.index)
+    approx = [col for col in num_cols if not stats.at[col, 'exact']]
+    if approx:
+        print(f"Using sampled quantiles (n={STREAM_SAMPLE_SIZE}) for: {approx}")
+
+    # Keep every non-numeric, non-bool column as text so dtype inference can't flip between chunks
+    std_columns = standardize_columns(pd.DataFrame(columns=raw_columns)).columns
+    text_dtypes = {raw: str for raw, std in zip(raw_columns, std_columns) if std not in num_cols and std not in bool_cols}
+
+    timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    filename_base = os.path.basename(key).replace("raw_", "").lower()
+    seen = SeenRows()
+    last_date = None
+    spooled = {}
+    rollup = DailyRollup()
+    index = ingest_index(bucket, standardize_columns(pd.DataFrame(columns=raw_columns)).columns, filename_base)
+
+    body = s3.get_object(Bucket=bucket, Key=key)['Body']
+
+    with tempfile.TemporaryDirectory() as spool_dir:
+        with telemetry.span("clean_pass", mode="stream") as span:
+            for chunk_no, chunk in enumerate(pd.read_csv(body, chunksize=STREAM_CHUNK_ROWS, dtype=text_dtypes)):
+                chunk = coerce_numeric(standardize_columns(chunk))
+                span.add(chunks=1, rows_in=len(chunk))
+
+                if 'date' in chunk.columns:
+                    # Forward-fill across chunk boundaries using the last date seen
+                    dates = parse_dates(chunk['date']).ffill()
+                    if last_date is not None:
+                        dates = dates.fillna(last_date)
+                    chunk['date'] = dates
+                    if dates.notna().any():
+                        last_date = dates.dropna().iloc[-1]
+
+                if num_cols:
+                    # Step 6 always upcasts numeric columns to float, even without outliers
+                    chunk[num_cols], outliers = fill_numeric(chunk[num_cols], stats)
+                    span.add(outliers=outliers)
+
+                chunk = clean_strings(chunk)
+
+                # Drop duplicates against the rows already written to the same dt= partition.
+                # Rows without a date are never written, so they are left alone.
+                row_hashes = pd.util.hash_pandas_object(chunk, index=False).to_numpy()
+                fresh = np.ones(len(chunk), dtype=bool)
+                for dt_val, positions in chunk.groupby('date').indices.items():
+                    fresh[positions] = seen.fresh(dt_val, row_hashes[positions])
+                chunk = chunk[fresh]
+                chunk = chunk.drop(columns=[col for col in DROP_COLS if col in chunk.columns])
+                if index:
+                    rows = len(chunk)
+                    chunk = index.filter(chunk)
+                    span.add(already_ingested=rows - len(chunk))
+                span.add(rows_out=len(chunk))
+                if ROLLUP_ENABLED:
+                    rollup.add(chunk)
+
+                for dt_val, sub_df in chunk.groupby('date'):
+                    partition_value = dt_val.strftime('%Y-%m-%d')
+                    if OUTPUT_FORMAT == 'parquet':
+                        path = os.path.join(spool_dir, partition_value)
+                        os.makedirs(path, exist_ok=True)
+                        # Same fixed schema for every piece: categoricals' code width varies by chunk
+                        with open(os.path.join(path, f"{chunk_no:06d}.parquet"), 'wb') as piece:
+                            piece.write(serialize_partition(sub_df))
+                    else:
+                        path = os.path.join(spool_dir, f"{partition_value}.csv")
+                        sub_df.to_csv(path, mode='a', index=False, header=partition_value not in spooled)
+                    spooled[partition_value] = path
+            # Every spool is complete, so the row hashes are no longer needed
+            seen.close()
+
+        def spooled_jobs():
+            for partition_value, path in sorted(spooled.items()):
+                new_filename = partition_filename(timestamp, partition_value, filename_base)
+                cleaned_key = f"retail-cleaned-data/dt={partition_value}/{new_filename}"
+                if OUTPUT_FORMAT == 'parquet':
+                    yield partition_value, cleaned_key, lambda path=path: BytesIO(merge_parquet_pieces(path))
+                else:
+                    yield partition_value, cleaned_key, lambda path=path: open(path, 'rb')
+
+        commit = partition_committer(bucket, rollup if ROLLUP_ENABLED else None, index, timestamp, filename_base)
+        timings = write_partitions(bucket, spooled_jobs(), on_uploaded=commit)
+        write_upload_manifest(bucket, key, timestamp, filename_base, timings)
+        return timings
+
+
+def clean_object(bucket, key):
+    """Cleans one raw upload and writes its dt= partitions. Raises on failure."""
+    print(f"File received: Bucket = {bucket}, Key = {key}")
+
+    # Step 2: Read the file from S3
+    response = s3.get_object(Bucket=bucket, Key=key)
+
+    size_mb = response.get('ContentLength', 0) / (1024 * 1024)
+    if STREAM_THRESHOLD_MB and size_mb > STREAM_THRESHOLD_MB:
+        print(f"Object is {size_mb:.0f} MB, cleaning in streaming mode ({STREAM_CHUNK_ROWS} rows/chunk)")
+        # The per-date spool holds the whole cleaned output until it is uploaded
+        spool_free_mb = shutil.disk_usage(tempfile.gettempdir()).free / (1024 * 1024)
+        if spool_free_mb < size_mb:
+            print(f"Warning: only {spool_free_mb:.0f} MB free in {tempfile.gettempdir()} for the spool; "
+                  f"raise the function's ephemeral storage to at least {size_mb:.0f} MB")
+        try:
+            stream_clean(bucket, key, response['Body'])
+        except pd.errors.ParserError as read_err:
+            print("Failed to read CSV:", str(read_err))
+            raise Exception("Invalid or unreadable CSV format")
+        return
+
+    with telemetry.span("read") as span:
+        try:
+            # Parsed straight from the response stream, so the raw bytes are never held in memory
+            df = pd.read_csv(response['Body'])
         except Exception as read_err:
             print("Failed to read CSV:", str(read_err))
             raise Exception("Invalid or unreadable CSV format")
+        span.set(bytes_in=response.get('ContentLength', 0), rows=len(df), columns=len(df.columns))
+    print(f"Read {len(df)} rows, {len(df.columns)} columns")
+
+    # Step 3: Standardize column names ('dt' becomes 'date')
+    df = standardize_columns(df)
+
+    # Step 4: Robust date parsing
+    if 'date' in df.columns:
+        with telemetry.span("parse_dates") as span:
+            df['date'] = parse_dates(df['date'])
+            span.set(rows=len(df), unparsed=int(df['date'].isna().sum()))
+            df['date'] = df['date'].ffill()
+
+    # Step 5: Convert numeric columns
+    df = coerce_numeric(df)
+
+    with telemetry.span("outliers") as span:
+        # Steps 6-7: Replace IQR outliers with the median, fill gaps with the mean
+        num_cols = list(df.select_dtypes(include='number').columns)
+        if num_cols:
+            stats = numeric_stats(df[num_cols])
+            df[num_cols], outliers = fill_numeric(df[num_cols], stats)
+            span.set(numeric_columns=len(num_cols), outliers=outliers)
 
-        # Step 3: Standardize column names
-        df.columns = df.columns.str.strip().str.lower().str.replace(' ', '_')
-        # Check if the column 'dt' exists and rename it to 'date'
-        if 'dt' in df.columns:
-            print("Found 'dt' column, renaming to 'date'.")
-            df.rename(columns={'dt': 'date'}, inplace=True)
-
-        # Step 4: Robust date parsing
-        if 'date' in df.columns:
-            def try_parse_date(x):
-                try:
-                    return parse(str(x))
-                except:
-                    return pd.NaT
-            df['date'] = df['date'].apply(try_parse_date)
-            df['date'].fillna(method='ffill', inplace=True)
-
-        # Step 5: Convert numeric columns
-        if 'sale_amount' in df.columns:
-            df['sale_amount'] = pd.to_numeric(df['sale_amount'], errors='coerce')
-        if 'quantity' in df.columns:
-            df['quantity'] = pd.to_numeric(df['quantity'], errors='coerce')
-
-        # Step 6: Outlier handling
-        num_cols = df.select_dtypes(include='number').columns
-        outlier_mask = {}
-        for col in num_cols:
-            Q1 = df[col].quantile(0.25)
-            Q3 = df[col].quantile(0.75)
-            IQR = Q3 - Q1
-            is_outlier = (df[col] < Q1 - 1.5 * IQR) | (df[col] > Q3 + 1.5 * IQR)
-            outlier_mask[col] = is_outlier
-            df.loc[is_outlier, col] = np.nan
-
-        # Step 7: Fill missing values (updated with .loc to avoid chained assignment)
-        for col in num_cols:
-            outliers = outlier_mask[col]
-            median_val = df[col].median()
-            df.loc[outliers, col] = median_val
-            df[col] = df[col].fillna(df[col].mean()).round(2)
-
-        # Step 8: String cleaning
-        for col in df.select_dtypes(include='object').columns:
-            df[col] = df[col].astype(str).str.strip().replace("nan", "unknown")
-            df[col].fillna("unknown", inplace=True)
-            df[col] = df[col].str.lower()
-
-        if 'city' in df.columns:
-            df['city'] = df['city'].str.title()
-
-        # Drop duplicates
+    # Step 8: String cleaning (text columns become categoricals)
+    with telemetry.span("clean_strings"):
+        df = clean_strings(df)
+
+    # Drop duplicates
+    with telemetry.span("dedupe") as span:
+        rows_in = len(df)
         df.drop_duplicates(inplace=True)
-        drop_cols = ['hours_sale', 'hours_stock_status']
-        df.drop(columns=[col for col in drop_cols if col in df.columns], inplace=True)
+        df.drop(columns=[col for col in DROP_COLS if col in df.columns], inplace=True)
+        span.set(rows_in=rows_in, rows_out=len(df))
 
-        print("Cleaned preview:\n", df.head())
+    timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    filename_base = os.path.basename(key).replace("raw_", "").lower()
 
-        # Step 9: Save to buffer
-        cleaned_buffer = BytesIO()
-        df.to_csv(cleaned_buffer, index=False)
-        cleaned_buffer.seek(0)
+    # Drop rows that earlier uploads already wrote to the same partitions
+    index = ingest_index(bucket, df.columns, filename_base)
+    if index:
+        with telemetry.span("ingest_index") as span:
+            rows_in = len(df)
+            df = index.filter(df)
+            span.set(partitions=len(index.ingested), rows_in=rows_in, rows_out=len(df))
+        print(f"{rows_in - len(df)} rows already ingested by earlier uploads, {len(df)} new")
 
-        # Step 10: Upload to partitioned & timestamped S3 path (one file per date)
-        timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-        filename_base = os.path.basename(key).replace("raw_", "").lower()
+    # Step 9: Upload to partitioned & timestamped S3 path (one file per date)
 
+    def partition_jobs():
         for dt_val, sub_df in df.groupby('date'):
             partition_value = dt_val.strftime('%Y-%m-%d')
-            cleaned_buffer = BytesIO()
-            sub_df.to_csv(cleaned_buffer, index=False)
-            cleaned_buffer.seek(0)
-
-            new_filename = f"cleaned_{timestamp}_{partition_value}_{filename_base}"
+            new_filename = partition_filename(timestamp, partition_value, filename_base)
             cleaned_key = f"retail-cleaned-data/dt={partition_value}/{new_filename}"
+            yield partition_value, cleaned_key, lambda sub_df=sub_df: BytesIO(serialize_partition(sub_df))
+
+    # Step 10: Daily rollup of the same rows for the report's rollup mode, written
+    # per partition right after its rows
+    rollup = None
+    if ROLLUP_ENABLED:
+        rollup = DailyRollup()
+        rollup.add(df)
+
+    commit = partition_committer(bucket, rollup, index, timestamp, filename_base)
+    timings = write_partitions(bucket, partition_jobs(), on_uploaded=commit)
 
-            response = s3.put_object(
-                Bucket=bucket,
-                Key=cleaned_key,
-                Body=cleaned_buffer.getvalue()
+    write_upload_manifest(bucket, key, timestamp, filename_base, timings)
+
+
+def read_s3_records(event):
+    """
+    Returns ([(message_id, bucket, key, size)] for every object in the event,
+    [unreadable records]). Handles direct S3 notifications and SQS messages wrapping
+    them; message_id is the SQS messageId used for partial batch responses (None for
+    direct S3 records) and size is the object size in bytes, None if the event has none. Each record is parsed on its own, so one malformed
+    message is reported as (message_id, error) without losing the rest of the batch.
+    """
+    records, unreadable = [], []
+    for record in event.get('Records', []):
+        message_id = record.get('messageId') if isinstance(record, dict) else None
+        try:
+            if 'body' in record:
+                s3_records = json.loads(record['body']).get('Records', [])
+            else:
+                message_id = None
+                s3_records = [record]
+            records.extend(
+                (message_id, s3_record['s3']['bucket']['name'],
+                 urllib.parse.unquote_plus(s3_record['s3']['object']['key']),
+                 s3_record['s3']['object'].get('size'))
+                for s3_record in s3_records
             )
-            print(f"Uploaded partition {partition_value} → s3://{bucket}/{cleaned_key}")
+        except Exception as e:
+            print(f"ERROR: unreadable record {message_id}: {e}")
+            unreadable.append((message_id, str(e)))
+    return records, unreadable
 
-        return {
-            'statusCode': 200,
-            'body': json.dumps('Cleaning complete and partitioned upload successful!')
-        }
 
+def cleaned_alone(size):
+    """Files that stream (or whose size is unknown) need the whole spool and a large share of memory."""
+    return size is None or bool(STREAM_THRESHOLD_MB) and size > STREAM_THRESHOLD_MB * 1024 * 1024
+
+
+def process_record(message_id, bucket, key):
+    try:
+        with telemetry.span("clean_file", key=key):
+            clean_object(bucket, key)
+        return {'key': key, 'status': 'cleaned'}
+    except Exception as e:
+        print(f"ERROR cleaning s3://{bucket}/{key}:", str(e))
+        return {'key': key, 'status': 'failed', 'error': str(e), 'message_id': message_id}
+
+
+@telemetry.instrument("data_cleaner")
+def lambda_handler(event, context):
+    print("Lambda triggered with event:", json.dumps(event))
+
+    try:
+        # Step 1: Extract bucket and key of every record in the batch
+        records, unreadable = read_s3_records(event)
     except Exception as e:
         print("ERROR:", str(e))
         return {
             'statusCode': 500,
             'body': json.dumps(str(e))
         }
+
+    # Several small files can arrive in one batch; clean them side by side, then
+    # the large ones one at a time. The libraries are loaded first, as a lazy
+    # module's first load isn't thread-safe.
+    if records:
+        load_now(pd, np, dateutil_parser)
+    small = [record for record in records if not cleaned_alone(record[3])]
+    large = [record for record in records if cleaned_alone(record[3])]
+    if len(small) > 1:
+        with ThreadPoolExecutor(max_workers=min(BATCH_WORKERS, len(small))) as pool:
+            results = list(pool.map(lambda record: process_record(*record[:3]), small))
+    else:
+        results = [process_record(*record[:3]) for record in small]
+    results += [process_record(*record[:3]) for record in large]
+
+    results += [{'key': None, 'status': 'failed', 'error': f"Unreadable record: {error}", 'message_id': message_id}
+                for message_id, error in unreadable]
+    failed = [r for r in results if r['status'] == 'failed']
+    print(f"Batch complete: {len(results) - len(failed)} cleaned, {len(failed)} failed")
+
+    response = {
+        'statusCode': 500 if failed else 200,
+        'body': json.dumps({
+            'message': 'Cleaning complete and partitioned upload successful!' if not failed else 'Some files failed to clean.',
+            'results': [{k: v for k, v in r.items() if k != 'message_id'} for r in results],
+        })
+    }
+    # SQS partial batch response: only the failed messages are retried
+    if any(message_id for message_id, _, _, _ in records) or any(message_id for message_id, _ in unreadable):
+        failed_ids = sorted({r['message_id'] for r in failed if r['message_id']})
+        response['batchItemFailures'] = [{'itemIdentifier': message_id} for message_id in failed_ids]
+    return response
@@ -1,36 +1,73 @@
-import boto3
 import os
 import json
 from datetime import datetime, timezone, timedelta
+from runtime import LazyClient
+import telemetry
 
-s3 = boto3.client("s3")
-ses = boto3.client("ses")
+s3 = LazyClient("s3")
+ses = LazyClient("ses")
 
 BUCKET_NAME = "sk-shopsense-retail-uploads"
-REPORT_PREFIXES = ["pdf-reports/weekly/", "pdf-reports/monthly/"]
+# Written by the PDF generator: one JSON record per PDF under {prefix}/dt=YYYY-MM-DD/
+REPORT_MANIFEST_PREFIX = os.environ.get("REPORT_MANIFEST_PREFIX", "report-manifest")
 SES_SENDER = os.environ["SES_SENDER"]
 SES_RECIPIENT = os.environ["SES_RECIPIENT"]
-LOOKBACK_MINUTES = int(os.environ.get("LOOKBACK_MINUTES", "60"))
+# The digest is scheduled weekly, so by default it covers the past week
+LOOKBACK_MINUTES = int(os.environ.get("LOOKBACK_MINUTES", "10080"))
 
-def get_recent_pdfs():
-    recent_keys = []
+def read_manifest(since, until):
+    """
+    Manifest records generated in [since, until]. Only the day partitions in the
+    window are listed, and within the first day listing starts at the cutoff
+    (record keys begin with the generation time), so the cost follows the number
+    of new reports rather than the size of the report history.
+    """
+    paginator = s3.get_paginator("list_objects_v2")
+    records = []
+    day = since.date()
+    with telemetry.span("read_manifest") as span:
+        while day <= until.date():
+            prefix = f"{REPORT_MANIFEST_PREFIX}/dt={day.isoformat()}/"
+            params = {"Bucket": BUCKET_NAME, "Prefix": prefix}
+            if day == since.date():
+                params["StartAfter"] = prefix + since.strftime("%H%M%S%f")
+            for page in paginator.paginate(**params):
+                for obj in page.get("Contents", []):
+                    span.add(objects=1)
+                    record = json.loads(s3.get_object(Bucket=BUCKET_NAME, Key=obj["Key"])["Body"].read())
+                    if since <= datetime.fromisoformat(record["generated_at"]) <= until:
+                        records.append(record)
+            day += timedelta(days=1)
+        span.set(records=len(records))
+    return records
+
+def read_report_text(key):
+    """The report's plain-text rendering saved by the PDF generator, or None."""
+    if not key:
+        return None
+    try:
+        return s3.get_object(Bucket=BUCKET_NAME, Key=key)["Body"].read().decode("utf-8")
+    except s3.exceptions.NoSuchKey:
+        return None
+
+def get_recent_pdfs(lookback_minutes=LOOKBACK_MINUTES):
     now = datetime.now(timezone.utc)
-    cutoff = datetime(2024, 4, 24, tzinfo=timezone.utc)
+    cutoff = now - timedelta(minutes=lookback_minutes)
+
+    # A re-rendered report appears once, with its latest record
+    latest = {}
+    for record in sorted(read_manifest(cutoff, now), key=lambda r: r["generated_at"]):
+        latest[record["pdf_key"]] = record
+    print(f"{len(latest)} report(s) generated since {cutoff.isoformat()}")
 
-    for prefix in REPORT_PREFIXES:
-        paginator = s3.get_paginator("list_objects_v2")
-        for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=prefix):
-            for obj in page.get("Contents", []):
-                key = obj["Key"]
-                last_modified = obj["LastModified"]
-                # Accept all files, skip time filter
-                if key.endswith(".pdf"):
-                    url = s3.generate_presigned_url(
-                        "get_object",
-                        Params={"Bucket": BUCKET_NAME, "Key": key},
-                        ExpiresIn=3600
-                    )
-                    recent_keys.append((key, url))
+    recent_keys = []
+    for key, record in latest.items():
+        url = s3.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": BUCKET_NAME, "Key": key},
+            ExpiresIn=3600
+        )
+        recent_keys.append((key, url, read_report_text(record.get("text_key"))))
 
     return recent_keys
 
@@ -42,10 +79,13 @@ def send_email(pdfs):
     subject = "ShopSense Report Digest"
     body = "Hi,\n\nHere are the latest ShopSense reports:\n\n"
 
-    for key, url in pdfs:
+    for key, url, text in pdfs:
         report_type = "Weekly" if "weekly" in key else "Monthly"
         date_str = key.split("_")[-1].replace(".pdf", "")
         body += f"📄 {report_type} Report – {date_str}:\n{url}\n\n"
+        if text:
+            # Reports recorded before the text rendering existed only get the link
+            body += f"{text}\n"
 
     body += "Best,\nShopSense Bot"
 
@@ -58,9 +98,10 @@ def send_email(pdfs):
         },
     )
 
+@telemetry.instrument("email_dispatcher")
 def lambda_handler(event, context):
     try:
-        pdfs = get_recent_pdfs()
+        pdfs = get_recent_pdfs(int(event.get("lookback_minutes", LOOKBACK_MINUTES)))
         send_email(pdfs)
         return {
             "statusCode": 200,
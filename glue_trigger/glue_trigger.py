@@ -1,42 +1,368 @@
-import boto3
+import json
+import os
+import re
+import time
+import urllib.parse
+from datetime import datetime, timezone
+from io import BytesIO
+from runtime import LazyClient
+import telemetry
 
-def lambda_handler(event, context):
-    print("Lambda triggered by new CSV upload!")
+# Created on first use and reused by every invocation of a warm container
+glue = LazyClient("glue")
+s3 = LazyClient("s3")
+events = LazyClient("events")
 
-    glue = boto3.client('glue')
-    crawler_name = 'retail_cleaned_crawler'
+# --- Partition registration ---
+# "crawler" starts the Glue crawler for cleaned uploads; "register" adds the new
+# dt= partitions to the catalog directly and only crawls when the schema changes
+PARTITION_MODE = os.environ.get("PARTITION_MODE", "crawler").lower()
+CRAWLER_NAME = os.environ.get("CRAWLER_NAME", "retail_cleaned_crawler")
+GLUE_DATABASE = os.environ.get("GLUE_DATABASE", "retail_db")
+GLUE_TABLE = os.environ.get("GLUE_TABLE", "retail_cleaned_data")
+CLEANED_PREFIX = "retail-cleaned-data/"
+# The cleaner writes one manifest per upload once all of its files are in place
+UPLOAD_MANIFEST_PREFIX = os.environ.get("UPLOAD_MANIFEST_PREFIX", "retail-upload-manifests").rstrip("/") + "/"
+# Partitions registered and uploads schema-checked by this container within the
+# window are skipped without calling Glue again
+PARTITION_DEBOUNCE_SECONDS = int(os.environ.get("PARTITION_DEBOUNCE_SECONDS", "300"))
+# Register mode never finishes a crawl, so the "Glue Crawler State Change" rule
+# that starts the report Lambda doesn't fire; this EventBridge event replaces it,
+# sent once per upload when its manifest arrives
+PARTITIONS_EVENT_BUS = os.environ.get("PARTITIONS_EVENT_BUS", "default")
+PARTITIONS_EVENT_SOURCE = os.environ.get("PARTITIONS_EVENT_SOURCE", "shopsense.glue-trigger")
+PARTITIONS_EVENT_DETAIL_TYPE = "Partitions Registered"
+# Glue API limits
+GET_PARTITIONS_BATCH = 1000
+CREATE_PARTITIONS_BATCH = 100
 
-    #Only trigger for cleaned data uploads
-    key = event['Records'][0]['s3']['object']['key']
-    if not key.startswith("retail-cleaned-data/"):
-        print(f"Ignoring file not in cleaned data folder: {key}")
-        return {
-            'statusCode': 200,
-            'body': 'Ignored non-cleaned upload.'
-        }
+# retail-cleaned-data/dt=YYYY-MM-DD/cleaned_{timestamp}_{dt}_{source file}
+CLEANED_KEY_RE = re.compile(r"^retail-cleaned-data/dt=([^/]+)/cleaned_(.+?)_\1_(.+?)(\.csv|\.parquet)?$")
+
+# Warm-container state: dt -> registered at; upload -> schema checked at
+recent_partitions = {}
+recent_uploads = {}
+
+
+def read_s3_records(event):
+    """
+    Returns ([(message_id, bucket, key, event_time)] for every object in the event,
+    [unreadable records]). Handles direct S3 notifications and SQS messages wrapping
+    them; message_id is the SQS messageId used for partial batch responses (None
+    for direct S3 records). Each record is parsed on its own, so one malformed
+    message is reported as (message_id, error) without losing the rest of the batch.
+    """
+    records, unreadable = [], []
+    for record in event.get('Records', []):
+        message_id = record.get('messageId') if isinstance(record, dict) else None
+        try:
+            if 'body' in record:
+                s3_records = json.loads(record['body']).get('Records', [])
+            else:
+                message_id = None
+                s3_records = [record]
+            parsed = []
+            for s3_record in s3_records:
+                event_time = s3_record.get('eventTime')
+                parsed.append((
+                    message_id,
+                    s3_record['s3']['bucket']['name'],
+                    urllib.parse.unquote_plus(s3_record['s3']['object']['key']),
+                    datetime.fromisoformat(event_time.replace("Z", "+00:00")) if event_time else datetime.now(timezone.utc),
+                ))
+            records.extend(parsed)
+        except Exception as e:
+            print(f"Unreadable record {message_id}: {e}")
+            unreadable.append((message_id, str(e)))
+    return records, unreadable
+
+
+def recently_seen(cache, key):
+    seen = cache.get(key)
+    return seen is not None and time.monotonic() - seen < PARTITION_DEBOUNCE_SECONDS
+
+
+def read_file_columns(s3, bucket, key):
+    """
+    Column names of a cleaned file from ranged reads: the CSV header line, or the
+    Parquet footer (needs pyarrow). Returns None when they can't be read cheaply.
+    """
+    if key.endswith(".parquet"):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            return None
+        tail = s3.get_object(Bucket=bucket, Key=key, Range="bytes=-8")['Body'].read()
+        footer_length = int.from_bytes(tail[:4], "little")
+        footer = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes=-{footer_length + 8}")['Body'].read()
+        return pq.read_schema(BytesIO(b"PAR1" + footer)).names
+    head = s3.get_object(Bucket=bucket, Key=key, Range="bytes=0-65535")['Body'].read()
+    header = head.split(b"\n", 1)[0].decode("utf-8").strip()
+    return [column.strip().strip('"').lower() for column in header.split(",")]
+
+
+def schema_changed(s3, table, bucket, key):
+    """True if the file's format or columns differ from the Glue table's."""
+    descriptor = table['StorageDescriptor']
+    if ("parquet" in descriptor.get('InputFormat', "").lower()) != key.endswith(".parquet"):
+        return True
+    columns = read_file_columns(s3, bucket, key)
+    if columns is None:
+        return False
+    table_columns = [column['Name'] for column in descriptor['Columns']]
+    partition_keys = {column['Name'] for column in table.get('PartitionKeys', [])}
+    return [column for column in columns if column not in partition_keys] != table_columns
+
+
+def register_partitions(glue, table, partition_values):
+    """Adds the dt= partitions missing from the table, copying its storage descriptor. Returns those added."""
+    values = sorted(partition_values)
+    existing = set()
+    for i in range(0, len(values), GET_PARTITIONS_BATCH):
+        response = glue.batch_get_partition(
+            DatabaseName=GLUE_DATABASE, TableName=GLUE_TABLE,
+            PartitionsToGet=[{'Values': [value]} for value in values[i:i + GET_PARTITIONS_BATCH]],
+        )
+        existing.update(partition['Values'][0] for partition in response.get('Partitions', []))
+
+    missing = [value for value in values if value not in existing]
+    descriptor = table['StorageDescriptor']
+    location = descriptor['Location'].rstrip("/")
+    for i in range(0, len(missing), CREATE_PARTITIONS_BATCH):
+        response = glue.batch_create_partition(
+            DatabaseName=GLUE_DATABASE, TableName=GLUE_TABLE,
+            PartitionInputList=[
+                {'Values': [value], 'StorageDescriptor': {**descriptor, 'Location': f"{location}/dt={value}/"}}
+                for value in missing[i:i + CREATE_PARTITIONS_BATCH]
+            ],
+        )
+        # Another invocation may have added the same partition in the meantime
+        errors = [error for error in response.get('Errors', [])
+                  if error['ErrorDetail'].get('ErrorCode') != 'AlreadyExistsException']
+        if errors:
+            raise RuntimeError(f"batch_create_partition failed: {errors}")
+    return missing
+
+
+def announce_partitions(events, partition_values, uploads):
+    """
+    Publishes one "Partitions Registered" event for the uploads whose manifests
+    are in the batch, as a finished crawl would in crawler mode. Raises if
+    EventBridge rejects it.
+    """
+    response = events.put_events(Entries=[{
+        'Source': PARTITIONS_EVENT_SOURCE,
+        'DetailType': PARTITIONS_EVENT_DETAIL_TYPE,
+        'Detail': json.dumps({
+            'databaseName': GLUE_DATABASE,
+            'tableName': GLUE_TABLE,
+            'partitions': sorted(partition_values),
+            'uploads': sorted(uploads),
+        }),
+        'EventBusName': PARTITIONS_EVENT_BUS,
+    }])
+    if response.get('FailedEntryCount'):
+        raise RuntimeError(f"put_events failed: {response['Entries']}")
+
+
+def crawl_covering(glue, uploaded_at):
+    """
+    Makes sure a crawl that started after `uploaded_at` (the newest file's upload
+    time) runs, starting one only if needed, so the hundreds of events one upload
+    produces lead to a single crawl. Returns "started", "covered" (a crawl that
+    began after the upload is running or done) or "busy" (a crawl that began
+    before it is still running; retry later).
+    """
+    crawler = glue.get_crawler(Name=CRAWLER_NAME)['Crawler']
+    if crawler['State'] == 'READY':
+        last_start = crawler.get('LastCrawl', {}).get('StartTime')
+        if last_start and last_start >= uploaded_at:
+            return "covered"
+        glue.start_crawler(Name=CRAWLER_NAME)
+        return "started"
+    elapsed = crawler.get('CrawlElapsedTime')
+    if crawler['State'] == 'RUNNING' and elapsed is not None \
+            and datetime.now(timezone.utc).timestamp() - elapsed / 1000 >= uploaded_at.timestamp():
+        return "covered"
+    return "busy"
+
+
+def handle_register(glue, s3, cleaned, manifests=()):
+    """
+    Registers the dt= partitions of every cleaned file in the batch, coalesced
+    into one set, without a crawl. An upload's manifest (written after all of its
+    files) registers every partition it lists and is announced on EventBridge, so
+    the reports run once per upload rather than once per batch. Files whose upload
+    changes the table's schema (or a missing table) go to the crawler instead,
+    whose finished crawl starts the reports. Returns the result dict and the SQS
+    message ids to retry.
+    """
+    try:
+        table = glue.get_table(DatabaseName=GLUE_DATABASE, Name=GLUE_TABLE)['Table']
+    except glue.exceptions.EntityNotFoundException:
+        print(f"Table {GLUE_DATABASE}.{GLUE_TABLE} doesn't exist yet, crawling instead")
+        table = None
 
+    partitions, to_crawl, skipped = {}, [], 0
+    changed = {}
+    for message_id, bucket, key, event_time in cleaned:
+        match = CLEANED_KEY_RE.match(key)
+        if table is None or not match:
+            to_crawl.append((message_id, event_time))
+            continue
+        partition_value, upload = match.group(1), (match.group(2), match.group(3))
+        # One schema check per source upload, not per partition file
+        if upload not in changed:
+            changed[upload] = not recently_seen(recent_uploads, upload) and schema_changed(s3, table, bucket, key)
+            if not changed[upload]:
+                recent_uploads[upload] = time.monotonic()
+        if changed[upload]:
+            to_crawl.append((message_id, event_time))
+        elif recently_seen(recent_partitions, partition_value):
+            skipped += 1
+        else:
+            partitions.setdefault(partition_value, set()).add(message_id)
+
+    failed_ids = set()
+    announce, uploads = set(), []
+    for message_id, bucket, key, _ in manifests:
+        try:
+            manifest = json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+            match = CLEANED_KEY_RE.match(manifest['keys'][0])
+        except Exception as e:
+            print(f"Unreadable upload manifest {key}: {e}")
+            failed_ids.add(message_id)
+            continue
+        upload = (match.group(2), match.group(3)) if match else None
+        if table is None or upload is None:
+            continue
+        if upload not in changed:
+            changed[upload] = not recently_seen(recent_uploads, upload) and schema_changed(s3, table, bucket, manifest['keys'][0])
+            if not changed[upload]:
+                recent_uploads[upload] = time.monotonic()
+        if changed[upload]:
+            # The crawl its files started announces it
+            continue
+        uploads.append((message_id, manifest['source']))
+        announce.update(manifest['partitions'])
+        for partition_value in manifest['partitions']:
+            if not recently_seen(recent_partitions, partition_value):
+                partitions.setdefault(partition_value, set()).add(message_id)
+
+    added = []
+    if partitions:
+        try:
+            with telemetry.span("register_partitions") as span:
+                added = register_partitions(glue, table, partitions)
+                span.set(partitions=len(partitions), added=len(added))
+            for value in partitions:
+                recent_partitions[value] = time.monotonic()
+        except Exception as e:
+            print(f"Failed to register partitions: {e}")
+            failed_ids.update(message_id for ids in partitions.values() for message_id in ids)
+    print(f"Registered {len(added)} new partition(s) of {len(partitions)} in the batch, "
+          f"{skipped} file(s) in partitions registered recently: {added}")
+
+    announce_ids = {message_id for message_id, _ in uploads}
+    if uploads and not failed_ids & announce_ids:
+        try:
+            # New files in existing partitions need new reports too, as after a crawl
+            announce_partitions(events, announce, [source for _, source in uploads])
+            print(f"Announced {len(uploads)} upload(s) covering {len(announce)} partition(s)")
+        except Exception as e:
+            print(f"Failed to announce partitions: {e}")
+            failed_ids.update(announce_ids)
+
+    crawl = "not needed"
+    if to_crawl:
+        try:
+            crawl = crawl_covering(glue, max(event_time for _, event_time in to_crawl))
+            print(f"Schema change or new table for {len(to_crawl)} file(s): crawler {crawl}")
+            if crawl == "busy":
+                failed_ids.update(message_id for message_id, _ in to_crawl)
+        except Exception as e:
+            print(f"Failed to start crawler: {e}")
+            failed_ids.update(message_id for message_id, _ in to_crawl)
+
+    telemetry.emit("catalog", {"files": len(cleaned), "schema_checks": len(changed), "skipped": skipped,
+                               "crawl_files": len(to_crawl), "announced_uploads": len(uploads),
+                               "failed": len(failed_ids)}, mode="register", crawl=crawl)
+    result = {
+        'statusCode': 500 if failed_ids else 200,
+        'body': f"Registered {len(added)} new partition(s); crawler {crawl}.",
+        'partitions_added': added,
+    }
+    return result, sorted(message_id for message_id in failed_ids if message_id)
+
+
+def handle_crawler(glue, cleaned):
+    # One crawler run picks up every new partition in the batch
     try:
         # Check crawler status
-        response = glue.get_crawler(Name=crawler_name)
+        response = glue.get_crawler(Name=CRAWLER_NAME)
         status = response['Crawler']['State']
 
         if status == 'READY':
-            glue.start_crawler(Name=crawler_name)
-            print(f"Crawler '{crawler_name}' started.")
-            return {
+            glue.start_crawler(Name=CRAWLER_NAME)
+            print(f"Crawler '{CRAWLER_NAME}' started for {len(cleaned)} cleaned file(s).")
+            result = {
                 'statusCode': 200,
-                'body': f"Crawler '{crawler_name}' started successfully."
+                'body': f"Crawler '{CRAWLER_NAME}' started successfully."
             }
         else:
             print(f"⚠️ Crawler is already running or not ready. Status: {status}")
-            return {
+            result = {
                 'statusCode': 200,
                 'body': f"Crawler is currently {status}. Skipping start."
             }
+        failed_ids = []
 
     except Exception as e:
         print(f"Failed to start crawler: {e}")
+        result = {
+            'statusCode': 500,
+            'body': str(e)
+        }
+        failed_ids = sorted({message_id for message_id, _, _, _ in cleaned if message_id})
+    telemetry.emit("catalog", {"files": len(cleaned), "failed": len(failed_ids)}, mode="crawler",
+                   crawl=result['body'])
+    return result, failed_ids
+
+
+@telemetry.instrument("glue_trigger")
+def lambda_handler(event, context):
+    print("Lambda triggered by new CSV upload!")
+
+    try:
+        records, unreadable = read_s3_records(event)
+    except Exception as e:
+        print(f"Failed to read event records: {e}")
         return {
             'statusCode': 500,
             'body': str(e)
-        }
\ No newline at end of file
+        }
+
+    #Only trigger for cleaned data uploads (and, in register mode, their manifests)
+    cleaned = [record for record in records if record[2].startswith(CLEANED_PREFIX)]
+    manifests = [record for record in records
+                 if PARTITION_MODE == "register" and record[2].startswith(UPLOAD_MANIFEST_PREFIX)]
+    for record in records:
+        if record not in cleaned and record not in manifests:
+            print(f"Ignoring file not in cleaned data folder: {record[2]}")
+
+    if not cleaned and not manifests:
+        result, failed_ids = {'statusCode': 200, 'body': 'Ignored non-cleaned upload.'}, []
+    elif PARTITION_MODE == "register":
+        result, failed_ids = handle_register(glue, s3, cleaned, manifests)
+    else:
+        result, failed_ids = handle_crawler(glue, cleaned)
+
+    if unreadable:
+        result['statusCode'] = 500
+        result['unreadable'] = [error for _, error in unreadable]
+        failed_ids = sorted(set(failed_ids) | {message_id for message_id, _ in unreadable if message_id})
+
+    # SQS partial batch response: only messages carrying cleaned files, or unreadable ones, are retried
+    if any(message_id for message_id, _, _, _ in records) or any(message_id for message_id, _ in unreadable):
+        result['batchItemFailures'] = [{'itemIdentifier': message_id} for message_id in failed_ids]
+    return result
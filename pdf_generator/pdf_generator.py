@@ -1,104 +1,431 @@
-import fitz  # PyMuPDF
-import boto3
 import json
 from io import BytesIO
 import urllib.parse
-import textwrap
 import re
+import os
+import unicodedata
+import time
+import multiprocessing
+from datetime import datetime, timezone
+from multiprocessing.connection import wait as wait_for_pipes
+from concurrent.futures import ThreadPoolExecutor
+from report_document import build_document, to_html, to_text
+from runtime import LazyClient, lazy_import
+import telemetry
 
-s3 = boto3.client('s3')
+# PyMuPDF loads when the first page is measured or drawn
+fitz = lazy_import("fitz")
+s3 = LazyClient("s3")
 
-def generate_pdf(llm_json_data, report_type, report_date):
-    pdf_buffer = BytesIO()
-    doc = fitz.open()
-    page = doc.new_page()
-    y = 50
-    subheading_mode = False
-
-    def wrap_text(text, bullet=False):
-        wrapper = textwrap.TextWrapper(width=90, break_long_words=True)
-        lines = wrapper.wrap(text)
-        wrapped = []
-        for i, line in enumerate(lines):
-            if bullet and i == 0:
-                wrapped.append(u"\u2022 " + line)
-            elif bullet:
-                wrapped.append("    " + line)
-            else:
-                wrapped.append(line)
-        return wrapped
+# --- Batch rendering ---
+# Worker processes for batch mode (one per vCPU by default). Lambda has no /dev/shm,
+# so the pool is plain Processes + Pipes rather than multiprocessing.Pool.
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", str(os.cpu_count() or 2)))
+# Uploads in flight per worker while it renders the next report
+UPLOADS_PER_WORKER = int(os.environ.get("UPLOADS_PER_WORKER", "2"))
 
-    # Title
-    title = f"ShopSense {report_type.title()} Report · {report_date}"
-    page.insert_text((50, y), title, fontsize=16)
-    y += 30
+# --- Report manifest ---
+# One small JSON record per generated PDF under {prefix}/dt=YYYY-MM-DD/, keyed by
+# generation time, so the email dispatcher can read a time window without listing pdf-reports/
+REPORT_MANIFEST_PREFIX = os.environ.get("REPORT_MANIFEST_PREFIX", "report-manifest")
 
-    lines = llm_json_data.get("llm_summary", "").split('\n')
+# --- Page layout ---
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842  # fitz.paper_size("a4")
+MARGIN_LEFT = 50
+MARGIN_RIGHT = 50
+TOP = 50
+BOTTOM = PAGE_HEIGHT - 50
+# block type -> (font, size, indent, space before)
+STYLES = {
+    "title": ("hebo", 16, 0, 0),
+    "heading": ("hebo", 13, 0, 8),
+    "subheading": ("hebo", 11, 5, 6),
+    "paragraph": ("helv", 10, 15, 0),
+    "bullet": ("helv", 10, 15, 0),
+    "table": ("helv", 9, 15, 4),
+}
+LINE_SPACING = 1.3
+BREAK_SPACE = 8
+BULLET_GAP = 4
+TABLE_CELL_PADDING = 12
 
-    for raw in lines:
-        line = raw.strip()
-        if not line:
-            y += 10
-            subheading_mode = False
+# Latin-1 advance widths (per point of font size) of the two fonts used, read once
+# per process on first use; measuring is then a table lookup instead of a PyMuPDF call per character
+FONT_WIDTHS = {}
+
+# The built-in Helvetica is a simple (Latin-1) font: PyMuPDF can only draw characters up
+# to U+00FF, and builds a glyph table up to the highest code point in the text (~128k
+# entries for an emoji) for every new document. So before measuring and drawing,
+# typographic punctuation and currency signs are mapped to ASCII, accented letters
+# lose their accents, emoji and other symbols are dropped, and any other run of
+# characters (a name in a non-Latin script) becomes a single "?".
+PDF_TRANSLATION = str.maketrans({"\u2018": "'", "\u2019": "'", "\u201c": '"', "\u201d": '"',
+                                 "\u2013": "-", "\u2014": "-", "\u2026": "...", "\u2022": "\xb7",
+                                 # Latin letters without a decomposition
+                                 "\u0141": "L", "\u0142": "l", "\u0110": "D", "\u0111": "d",
+                                 "\u0152": "OE", "\u0153": "oe", "\u0131": "i"})
+CURRENCY_CODES = {"\u20ac": "EUR", "\u20b9": "INR", "\u20bd": "RUB", "\u20a9": "KRW", "\u20ba": "TRY",
+                  "\u20b1": "PHP", "\u20aa": "ILS", "\u20a6": "NGN", "\u20ab": "VND", "\u20b4": "UAH"}
+NON_LATIN1_RE = re.compile(r"([^\x00-\xff]+)(\s*)")
+
+
+def to_latin1(match):
+    parts = []
+    for char in match.group(1):
+        if char in CURRENCY_CODES:
+            parts.append(CURRENCY_CODES[char] + " ")
             continue
+        folded = "".join(c for c in unicodedata.normalize("NFKD", char) if not unicodedata.combining(c))
+        if folded and max(folded) <= "\xff":
+            parts.append(folded)
+        elif unicodedata.category(char)[0] not in "SMC" and parts[-1:] != ["?"]:
+            parts.append("?")
+    text = "".join(parts)
+    if not text:
+        return ""
+    if text.endswith(" "):
+        # A trailing currency code keeps a space before the amount that follows it
+        following = match.string[match.end():match.end() + 1]
+        return text.rstrip() + (match.group(2) or (" " if following.isalnum() else ""))
+    return text + match.group(2)
+
 
-        if y > 720:
-            page = doc.new_page()
-            y = 50
+def pdf_text(text):
+    return NON_LATIN1_RE.sub(to_latin1, text.translate(PDF_TRANSLATION)).strip()
 
-        # Remove markdown artifacts but only after checking for subheadings
-        raw_clean = re.sub(r"[·\-\s]+", "", line)
 
-        # Main headings (e.g. Summary, Performance Report)
-        if "Summary" in line or "Performance Report" in line:
-            page.insert_text((50, y), line.strip("#·- "), fontsize=13)
-            y += 20
-            subheading_mode = False
+def text_width(text, fontname, fontsize):
+    widths = FONT_WIDTHS.get(fontname)
+    if widths is None:
+        font = fitz.Font(fontname)
+        widths = FONT_WIDTHS[fontname] = [font.glyph_advance(code) for code in range(256)]
+    return sum(widths[ord(char)] for char in text) * fontsize
+
+
+def wrap_to_width(text, fontname, fontsize, width):
+    """Greedy word wrap using measured widths; words wider than a line are split."""
+    space = text_width(" ", fontname, fontsize)
+    lines, current, current_width = [], "", 0.0
+    for word in text.split():
+        word_width = text_width(word, fontname, fontsize)
+        if current and current_width + space + word_width <= width:
+            current, current_width = f"{current} {word}", current_width + space + word_width
             continue
+        if current:
+            lines.append(current)
+        while word_width > width:
+            cut = len(word) - 1
+            while cut > 1 and text_width(word[:cut], fontname, fontsize) > width:
+                cut -= 1
+            lines.append(word[:cut])
+            word = word[cut:]
+            word_width = text_width(word, fontname, fontsize)
+        current, current_width = word, word_width
+    if current:
+        lines.append(current)
+    return lines
+
+
+def fit_cell(text, fontname, fontsize, width):
+    if text_width(text, fontname, fontsize) <= width:
+        return text
+    while text and text_width(text + "...", fontname, fontsize) > width:
+        text = text[:-1]
+    return text + "..."
 
-        # Subheadings like · · Sales Highlights
-        if re.match(r"^[·\-\s]{0,3}(Sales Highlights|Consumer Behavior|External Influences|Strategic Recommendations)", line):
-            clean_heading = re.sub(r"^[#·\-\s]+", "", line).rstrip(":")
-            page.insert_text((55, y), clean_heading, fontsize=11)
-            y += 16
-            subheading_mode = True
+
+def layout_document(document):
+    """
+    Single layout pass over the parsed blocks. Returns one list of draw operations
+    per page: ("text", x, y, text, font, size) with y as the baseline, and
+    ("rule", x0, x1, y) for table lines.
+    """
+    pages = [[]]
+    y = TOP
+    content_width = PAGE_WIDTH - MARGIN_LEFT - MARGIN_RIGHT
+
+    def advance(height):
+        nonlocal y
+        if y + height > BOTTOM and pages[-1]:
+            pages.append([])
+            y = TOP
+        y_line = y
+        y += height
+        return y_line
+
+    def add_lines(lines, fontname, size, x, first_prefix=None):
+        line_height = size * LINE_SPACING
+        for i, line in enumerate(lines):
+            y_line = advance(line_height)
+            if first_prefix and i == 0:
+                pages[-1].append(("text", x - first_prefix[1], y_line, first_prefix[0], fontname, size))
+            pages[-1].append(("text", x, y_line, line, fontname, size))
+
+    fontname, size, _, _ = STYLES["title"]
+    add_lines([pdf_text(document["title"])], fontname, size, MARGIN_LEFT)
+    y += 10
+
+    for block in document["blocks"]:
+        kind = block["type"]
+        if kind == "break":
+            y += BREAK_SPACE
             continue
+        fontname, size, indent, space_before = STYLES[kind]
+        if pages[-1] and y > TOP:
+            y += space_before
+        x = MARGIN_LEFT + indent
 
-        # Now clean markdown for all remaining lines
-        line = re.sub(r"^#+\s*", "", line)
-        line = re.sub(r"^[·\-\s]+", "", line)
-        line = re.sub(r"`(.*?)`", r"\1", line)
-        line = re.sub(r"\*\*(.*?)\*\*", r"\1", line)
-
-        # Main headings (e.g. Summary, Performance Report)
-        if "Summary" in line or "Performance Report" in line:
-            page.insert_text((50, y), line.strip(), fontsize=13)
-            y += 20
-            subheading_mode = False
+        if kind == "table":
+            layout_table(block, fontname, size, x, content_width - indent, advance, pages)
             continue
 
-        # Subheading (e.g. Sales Highlights, Strategic Recommendations)
-        if line.endswith(":") or line in [
-            "Sales Highlights", "Consumer Behavior", "External Influences", "Strategic Recommendations"
-        ]:
-            page.insert_text((55, y), line.rstrip(":"), fontsize=11)
-            y += 16
-            subheading_mode = True
+        text = pdf_text(block["text"])
+        if not text:
             continue
+        if kind == "bullet":
+            marker = pdf_text(block["marker"])
+            marker_width = text_width(marker, fontname, size) + BULLET_GAP
+            x += marker_width
+            lines = wrap_to_width(text, fontname, size, PAGE_WIDTH - MARGIN_RIGHT - x)
+            add_lines(lines, fontname, size, x, first_prefix=(marker, marker_width))
+        else:
+            add_lines(wrap_to_width(text, fontname, size, PAGE_WIDTH - MARGIN_RIGHT - x), fontname, size, x)
+    return pages
+
+
+def layout_table(block, fontname, size, x, available_width, advance, pages):
+    columns = len(block["header"])
+    rows = [[pdf_text(cell) for cell in block["header"]]] + [
+        [pdf_text(cell) for cell in row[:columns]] + [""] * (columns - len(row)) for row in block["rows"]
+    ]
+    widths = [
+        max(text_width(row[i], "hebo" if r == 0 else fontname, size) for r, row in enumerate(rows)) + TABLE_CELL_PADDING
+        for i in range(columns)
+    ]
+    scale = min(1.0, available_width / sum(widths))
+    widths = [width * scale for width in widths]
+    line_height = size * LINE_SPACING
+    for r, row in enumerate(rows):
+        row_font = "hebo" if r == 0 else fontname
+        y_line = advance(line_height + (3 if r == 0 else 0))
+        cell_x = x
+        for cell, width in zip(row, widths):
+            pages[-1].append(("text", cell_x, y_line, fit_cell(cell, row_font, size, width - TABLE_CELL_PADDING / 2),
+                              row_font, size))
+            cell_x += width
+        if r == 0:
+            pages[-1].append(("rule", x, cell_x, y_line + 3))
+
+
+def draw_pages(pages):
+    """Draws the laid-out pages, committing each page's text in one content stream."""
+    doc = fitz.open()
+    for operations in pages:
+        page = doc.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+        shape = page.new_shape()
+        for operation in operations:
+            if operation[0] == "rule":
+                _, x0, x1, y = operation
+                shape.draw_line((x0, y), (x1, y))
+                shape.finish(color=(0.6, 0.6, 0.6), width=0.5)
+            else:
+                _, x, y, text, fontname, size = operation
+                shape.insert_text((x, y), text, fontname=fontname, fontsize=size)
+        shape.commit()
+    return doc
 
-        # Bullet content
-        wrapped = wrap_text(line, bullet=True)
-        for wline in wrapped:
-            indent = 85 if subheading_mode else 65
-            page.insert_text((indent, y), wline, fontsize=10)
-            y += 12
 
+def build_pdf_document(llm_json_data, report_type, report_date, actual_sales_csv=None):
+    document = build_document(llm_json_data, report_type, report_date, actual_sales_csv)
+    return draw_pages(layout_document(document))
+
+
+def generate_pdf(llm_json_data, report_type, report_date, actual_sales_csv=None):
+    pdf_buffer = BytesIO()
+    doc = build_pdf_document(llm_json_data, report_type, report_date, actual_sales_csv)
     doc.save(pdf_buffer)
     pdf_buffer.seek(0)
     return pdf_buffer
 
 
+def read_actual_sales(bucket, report_type, report_date):
+    """The period's actual-sales CSV written by the report job, or None if there isn't one."""
+    key = f"actual-sales/{report_type}/actual_{report_date}.csv"
+    try:
+        return s3.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+    except s3.exceptions.NoSuchKey:
+        return None
+
+
+def document_key(report_type, report_date):
+    """Key prefix of a report's saved renderings (.json, .html, .txt)."""
+    return f"report-documents/{report_type}/report_{report_date}"
+
+
+def render_report(bucket, json_key):
+    """
+    Reads one llm-insights JSON (plus its actual-sales CSV), parses it once into
+    the block model and renders the PDF from it. The model and an HTML rendering
+    are saved under report-documents/ for reuse, with a plain-text rendering for
+    the email digest. Returns (pdf_key, pdf_bytes, page_count).
+    """
+    # Extract type and date from key: llm-insights/{weekly|monthly}/report_YYYY-MM[-DD].json
+    parts = json_key.split("/")
+    report_type = parts[1]
+    report_date = parts[2].replace("report_", "").replace(".json", "")
+
+    with telemetry.span("pdf_render", report_type=report_type, report_date=report_date) as span:
+        # Read JSON from S3
+        raw = s3.get_object(Bucket=bucket, Key=json_key)['Body'].read()
+        llm_json_data = json.loads(raw.decode('utf-8'))
+        actual_sales_csv = read_actual_sales(bucket, report_type, report_date)
+        span.set(bytes_in=len(raw))
+
+        # Parse once, then render every format from the same model
+        start = time.perf_counter()
+        document = build_document(llm_json_data, report_type, report_date, actual_sales_csv)
+        parsed = time.perf_counter()
+        pages = layout_document(document)
+        laid_out = time.perf_counter()
+        doc = draw_pages(pages)
+        pdf_bytes = doc.tobytes()
+        span.set(parse_ms=round((parsed - start) * 1000, 2), layout_ms=round((laid_out - parsed) * 1000, 2),
+                 draw_ms=round((time.perf_counter() - laid_out) * 1000, 2), pages=doc.page_count,
+                 bytes_out=len(pdf_bytes))
+
+        key = document_key(report_type, report_date)
+        s3.put_object(Bucket=bucket, Key=f"{key}.json", Body=json.dumps(document), ContentType='application/json')
+        s3.put_object(Bucket=bucket, Key=f"{key}.html", Body=to_html(document).encode('utf-8'),
+                      ContentType='text/html; charset=utf-8')
+        s3.put_object(Bucket=bucket, Key=f"{key}.txt", Body=to_text(document).encode('utf-8'),
+                      ContentType='text/plain; charset=utf-8')
+
+    pdf_key = f"pdf-reports/{report_type}/ShopSense_{report_type.title()}_{report_date}.pdf"
+    return pdf_key, pdf_bytes, doc.page_count
+
+
+def record_report(bucket, pdf_key, pages, size):
+    """
+    Appends the PDF to the report manifest. Records are never rewritten: each one
+    is its own object, so concurrent renders can't lose each other's entries.
+    """
+    generated_at = datetime.now(timezone.utc)
+    # pdf-reports/{type}/ShopSense_{Type}_{date}.pdf
+    report_type = pdf_key.split("/")[1]
+    report_date = pdf_key.rsplit("_", 1)[-1].replace(".pdf", "")
+    record = {
+        "pdf_key": pdf_key,
+        "report_type": report_type,
+        "report_date": report_date,
+        "generated_at": generated_at.isoformat(),
+        "pages": pages,
+        "size": size,
+        "text_key": f"{document_key(report_type, report_date)}.txt",
+    }
+    manifest_key = (f"{REPORT_MANIFEST_PREFIX}/dt={generated_at:%Y-%m-%d}/"
+                    f"{generated_at:%H%M%S%f}_{report_type}_{report_date}.json")
+    s3.put_object(Bucket=bucket, Key=manifest_key, Body=json.dumps(record), ContentType='application/json')
+
+
+def upload_pdf(bucket, pdf_key, pdf_bytes, pages=None):
+    with telemetry.span("pdf_upload", bytes=len(pdf_bytes)):
+        s3.put_object(Bucket=bucket, Key=pdf_key, Body=pdf_bytes, ContentType='application/pdf')
+        record_report(bucket, pdf_key, pages, len(pdf_bytes))
+    print(f"PDF generated at: s3://{bucket}/{pdf_key}")
+
+
+def render_worker(bucket, json_keys, conn):
+    """
+    Worker process: renders its share of a batch, uploading each PDF in the
+    background while the next one renders, and sends one result dict per key.
+    Its S3 client is created fresh in the child (runtime drops cached clients on fork).
+    """
+    def upload(json_key, pdf_key, pdf_bytes, pages):
+        upload_pdf(bucket, pdf_key, pdf_bytes, pages)
+        return {"json_key": json_key, "pdf_key": pdf_key, "pages": pages}
+
+    with ThreadPoolExecutor(max_workers=UPLOADS_PER_WORKER) as uploads:
+        futures = []
+        for json_key in json_keys:
+            try:
+                pdf_key, pdf_bytes, pages = render_report(bucket, json_key)
+                futures.append((json_key, uploads.submit(upload, json_key, pdf_key, pdf_bytes, pages)))
+            except Exception as e:
+                conn.send({"json_key": json_key, "error": str(e)})
+        for json_key, future in futures:
+            try:
+                conn.send(future.result())
+            except Exception as e:
+                conn.send({"json_key": json_key, "error": str(e)})
+    conn.close()
+
+
+def render_batch(bucket, json_keys, workers=RENDER_WORKERS):
+    """Renders and uploads many reports across `workers` processes. Returns per-key results."""
+    workers = max(1, min(workers, len(json_keys)))
+    pipes, processes, results = [], [], []
+    for i in range(workers):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=render_worker, args=(bucket, json_keys[i::workers], sender))
+        process.start()
+        sender.close()
+        pipes.append(receiver)
+        processes.append(process)
+
+    while pipes:
+        for receiver in wait_for_pipes(pipes):
+            try:
+                results.append(receiver.recv())
+            except EOFError:
+                pipes.remove(receiver)
+    for process in processes:
+        process.join()
+
+    # A worker that died (e.g. out of memory) leaves its keys without a result
+    reported = {result["json_key"] for result in results}
+    results.extend({"json_key": key, "error": "worker exited before rendering"} for key in json_keys if key not in reported)
+    return results
+
+
+def list_insight_keys(bucket, prefix):
+    keys = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []) if obj['Key'].endswith('.json'))
+    return keys
+
+
+def batch_handler(event):
+    """Event: {"bucket": ..., "json_keys": [...]} or {"bucket": ..., "prefix": "llm-insights/weekly/"}."""
+    bucket = event['bucket']
+    json_keys = event.get('json_keys') or list_insight_keys(bucket, event['prefix'])
+    print(f"Batch rendering {len(json_keys)} report(s) with {min(RENDER_WORKERS, len(json_keys))} worker(s)")
+
+    start = time.perf_counter()
+    results = render_batch(bucket, json_keys) if json_keys else []
+    elapsed = time.perf_counter() - start
+
+    failed = [result for result in results if "error" in result]
+    for result in failed:
+        print(f"Error rendering {result['json_key']}: {result['error']}")
+    pages = sum(result.get("pages", 0) for result in results)
+    print(f"Rendered {len(results) - len(failed)} PDF(s), {pages} page(s) in {elapsed:.2f}s "
+          f"({pages / elapsed if elapsed else 0:.1f} pages/s), {len(failed)} failed")
+
+    return {
+        "statusCode": 500 if failed else 200,
+        "pdf_keys": [result["pdf_key"] for result in results if "pdf_key" in result],
+        "failed": [{"json_key": result["json_key"], "error": result["error"]} for result in failed],
+        "pages": pages,
+        "pages_per_second": round(pages / elapsed, 2) if elapsed else None,
+    }
+
+
+@telemetry.instrument("pdf_generator")
 def lambda_handler(event, context):
+    if 'json_keys' in event or 'prefix' in event:
+        return batch_handler(event)
+
     try:
         # Get S3 key and bucket from event trigger
         record = event['Records'][0]['s3']
@@ -107,22 +434,10 @@ def lambda_handler(event, context):
 
         print(f"Generating PDF for: s3://{bucket}/{json_key}")
 
-        # Extract type and date from key: llm-insights/{weekly|monthly}/report_YYYY-MM[-DD].json
-        parts = json_key.split("/")
-        report_type = parts[1]
-        report_date = parts[2].replace("report_", "").replace(".json", "")
-
-        # Read JSON from S3
-        llm_json_data = json.loads(s3.get_object(Bucket=bucket, Key=json_key)['Body'].read().decode('utf-8'))
-
-        # Generate PDF
-        pdf_buffer = generate_pdf(llm_json_data, report_type, report_date)
-
-        # Save PDF to S3
-        pdf_key = f"pdf-reports/{report_type}/ShopSense_{report_type.title()}_{report_date}.pdf"
-        s3.put_object(Bucket=bucket, Key=pdf_key, Body=pdf_buffer.getvalue(), ContentType='application/pdf')
+        pdf_key, pdf_bytes, pages = render_report(bucket, json_key)
 
-        print(f"PDF generated at: s3://{bucket}/{pdf_key}")
+        # Save PDF to S3 and record it in the report manifest
+        upload_pdf(bucket, pdf_key, pdf_bytes, pages)
 
         return {
             "statusCode": 200,
@@ -0,0 +1,182 @@
+import csv
+import html
+import re
+from io import StringIO
+
+# Section names the report prompt asks the LLM for
+SUBHEADINGS = ["Sales Highlights", "Consumer Behavior", "External Influences", "Strategic Recommendations"]
+
+HEADING_RE = re.compile(r"^#{1,6}\s*(.*)$")
+RULE_RE = re.compile(r"^([-*_·])(\s*\1){2,}$")
+BULLET_RE = re.compile(r"^[-*•·]+\s+(.*)$")
+NUMBERED_RE = re.compile(r"^(\d+)[.)]\s+(.*)$")
+TABLE_SEPARATOR_RE = re.compile(r"^\|?(\s*:?-{2,}:?\s*\|)+\s*(:?-{2,}:?\s*)?$")
+CODE_RE = re.compile(r"`(.*?)`")
+BOLD_RE = re.compile(r"\*\*(.*?)\*\*")
+# Emoji and other decoration in front of a heading's words
+LEADING_SYMBOLS_RE = re.compile(r"^[^\w(]+")
+
+
+def clean_inline(text):
+    return BOLD_RE.sub(r"\1", CODE_RE.sub(r"\1", text)).strip()
+
+
+def heading_block(text):
+    """Section titles contain "Summary"/"Performance Report"; the prompt's sections are subheadings."""
+    bare = LEADING_SYMBOLS_RE.sub("", text).rstrip(":")
+    if "Summary" in bare or "Performance Report" in bare:
+        return {"type": "heading", "text": text.rstrip(":")}
+    return {"type": "subheading", "text": text.rstrip(":")}
+
+
+def parse_summary(text):
+    """
+    Parses the LLM's markdown once into a list of blocks:
+      {"type": "heading" | "subheading" | "paragraph", "text": ...}
+      {"type": "bullet", "text": ..., "marker": "•" or "1."}
+      {"type": "table", "header": [...], "rows": [[...], ...]}
+      {"type": "break"}  (blank line)
+    """
+    blocks = []
+    table = None
+    for raw in text.split("\n"):
+        line = raw.strip()
+
+        # Markdown tables: first row is the header, the |---| separator is skipped
+        if len(line) > 1 and line.startswith("|") and line.endswith("|"):
+            if TABLE_SEPARATOR_RE.match(line):
+                continue
+            cells = [clean_inline(cell) for cell in line[1:-1].split("|")]
+            if table is None:
+                table = {"type": "table", "header": cells, "rows": []}
+                blocks.append(table)
+            else:
+                table["rows"].append(cells)
+            continue
+        table = None
+
+        if not line:
+            if blocks and blocks[-1]["type"] != "break":
+                blocks.append({"type": "break"})
+            continue
+        if RULE_RE.match(line):
+            continue
+
+        heading = HEADING_RE.match(line)
+        if heading:
+            blocks.append(heading_block(clean_inline(heading.group(1))))
+            continue
+
+        bullet = BULLET_RE.match(line)
+        if bullet:
+            blocks.append({"type": "bullet", "text": clean_inline(bullet.group(1)), "marker": "•"})
+            continue
+        numbered = NUMBERED_RE.match(line)
+        if numbered:
+            blocks.append({"type": "bullet", "text": clean_inline(numbered.group(2)), "marker": f"{numbered.group(1)}."})
+            continue
+
+        text_line = clean_inline(line)
+        bare = LEADING_SYMBOLS_RE.sub("", text_line)
+        if text_line.endswith(":") or bare in SUBHEADINGS or "Summary" in bare or "Performance Report" in bare:
+            blocks.append(heading_block(text_line))
+        else:
+            blocks.append({"type": "paragraph", "text": text_line})
+
+    while blocks and blocks[-1]["type"] == "break":
+        blocks.pop()
+    return blocks
+
+
+def format_cell(value):
+    """Athena's doubles as readable numbers: 580.0 -> 580, 61.39999999999999 -> 61.40."""
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    return str(int(number)) if number.is_integer() else f"{number:.2f}"
+
+
+def sales_table_blocks(csv_text):
+    """Blocks for the period's actual-sales CSV (top sellers, as queried from Athena)."""
+    rows = list(csv.reader(StringIO(csv_text)))
+    if len(rows) < 2:
+        return []
+    return [
+        {"type": "break"},
+        {"type": "subheading", "text": "Top-Selling Products (data)"},
+        {"type": "table", "header": rows[0], "rows": [[format_cell(cell) for cell in row] for row in rows[1:]]},
+    ]
+
+
+def build_document(llm_json_data, report_type, report_date, actual_sales_csv=None):
+    """The parsed report: {"title", "report_type", "report_date", "blocks"} (plain JSON, safe to cache)."""
+    blocks = parse_summary(llm_json_data.get("llm_summary", ""))
+    if actual_sales_csv:
+        blocks.extend(sales_table_blocks(actual_sales_csv))
+    return {
+        "title": f"ShopSense {report_type.title()} Report · {report_date}",
+        "report_type": report_type,
+        "report_date": report_date,
+        "blocks": blocks,
+    }
+
+
+def to_text(document):
+    """Plain-text rendering, e.g. for an email body."""
+    lines = [document["title"], "=" * len(document["title"]), ""]
+    for block in document["blocks"]:
+        kind = block["type"]
+        if kind == "break":
+            if lines[-1]:
+                lines.append("")
+        elif kind == "heading":
+            lines.extend([block["text"].upper(), ""])
+        elif kind == "subheading":
+            lines.extend([block["text"], "-" * len(block["text"])])
+        elif kind == "bullet":
+            lines.append(f"  {block['marker']} {block['text']}")
+        elif kind == "table":
+            table = [block["header"]] + block["rows"]
+            widths = [max(len(row[i]) if i < len(row) else 0 for row in table) for i in range(len(block["header"]))]
+            for row in table:
+                lines.append("  " + "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+        else:
+            lines.append(block["text"])
+    return "\n".join(lines).strip() + "\n"
+
+
+def to_html(document):
+    """Self-contained HTML rendering of the same blocks."""
+    parts = [f"<h1>{html.escape(document['title'])}</h1>"]
+    in_list = False
+    for block in document["blocks"]:
+        kind = block["type"]
+        if kind != "bullet" and in_list:
+            parts.append("</ul>")
+            in_list = False
+        if kind == "heading":
+            parts.append(f"<h2>{html.escape(block['text'])}</h2>")
+        elif kind == "subheading":
+            parts.append(f"<h3>{html.escape(block['text'])}</h3>")
+        elif kind == "paragraph":
+            parts.append(f"<p>{html.escape(block['text'])}</p>")
+        elif kind == "bullet":
+            if not in_list:
+                parts.append("<ul>")
+                in_list = True
+            marker = "" if block["marker"] == "•" else f"{html.escape(block['marker'])} "
+            parts.append(f"<li>{marker}{html.escape(block['text'])}</li>")
+        elif kind == "table":
+            header = "".join(f"<th>{html.escape(cell)}</th>" for cell in block["header"])
+            rows = "".join(
+                "<tr>" + "".join(f"<td>{html.escape(cell)}</td>" for cell in row) + "</tr>" for row in block["rows"]
+            )
+            parts.append(f"<table><thead><tr>{header}</tr></thead><tbody>{rows}</tbody></table>")
+    if in_list:
+        parts.append("</ul>")
+    body = "\n".join(parts)
+    return (
+        "<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\">"
+        f"<title>{html.escape(document['title'])}</title></head>\n<body>\n{body}\n</body></html>\n"
+    )
@@ -0,0 +1,145 @@
+"""
+Shared Lambda runtime helpers: one boto3 session per process, cached clients
+with tunable connection pools, retries and keep-alive, and lazy imports for
+heavy libraries. Deployed with the shared dependencies layer (python/runtime.py).
+"""
+import importlib.util
+import os
+import sys
+import threading
+
+# --- AWS client settings ---
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get("AWS_MAX_POOL_CONNECTIONS", "10"))
+AWS_RETRY_MODE = os.environ.get("AWS_RETRY_MODE", "standard")  # legacy | standard | adaptive
+AWS_MAX_ATTEMPTS = int(os.environ.get("AWS_MAX_ATTEMPTS", "5"))
+AWS_TCP_KEEPALIVE = os.environ.get("AWS_TCP_KEEPALIVE", "true").lower() == "true"
+AWS_CONNECT_TIMEOUT = float(os.environ.get("AWS_CONNECT_TIMEOUT", "5"))
+AWS_READ_TIMEOUT = float(os.environ.get("AWS_READ_TIMEOUT", "60"))
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+# service -> object returned instead of a boto3 client (see benchmarks/local_aws.py)
+_overrides = {}
+
+
+def _reset_after_fork():
+    # boto3 sessions and connection pools must not be shared with a forked child
+    global _session, _lock
+    _lock = threading.Lock()
+    _session = None
+    _clients.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def override_client(service, stand_in):
+    """
+    Serves `stand_in` for every client(service), and so every LazyClient(service),
+    in this process and its forks. Pass None to go back to boto3.
+    """
+    if stand_in is None:
+        _overrides.pop(service, None)
+    else:
+        _overrides[service] = stand_in
+
+
+def client(service, **config):
+    """
+    Cached boto3 client for `service`, created on first use. Keyword arguments
+    are botocore Config options overriding the defaults above (for example
+    max_pool_connections); each distinct combination gets its own client.
+    """
+    if service in _overrides:
+        return _overrides[service]
+    key = (service, tuple(sorted(config.items())))
+    cached = _clients.get(key)
+    if cached is not None:
+        return cached
+    with _lock:
+        if key not in _clients:
+            global _session
+            import boto3
+            from botocore.config import Config
+
+            if _session is None:
+                _session = boto3.session.Session()
+            settings = {
+                "max_pool_connections": AWS_MAX_POOL_CONNECTIONS,
+                "retries": {"mode": AWS_RETRY_MODE, "max_attempts": AWS_MAX_ATTEMPTS},
+                "tcp_keepalive": AWS_TCP_KEEPALIVE,
+                "connect_timeout": AWS_CONNECT_TIMEOUT,
+                "read_timeout": AWS_READ_TIMEOUT,
+            }
+            settings.update(config)
+            _clients[key] = _session.client(service, config=Config(**settings))
+        return _clients[key]
+
+
+class LazyClient:
+    """
+    Module-level stand-in for a boto3 client: `s3 = LazyClient("s3")` costs
+    nothing at import, and every attribute access goes to the cached client,
+    so it's created on first use and re-created in forked workers.
+    """
+
+    def __init__(self, service, **config):
+        self._service = service
+        self._config = config
+
+    def __getattr__(self, name):
+        return getattr(client(self._service, **self._config), name)
+
+
+class LazyObject:
+    """
+    Proxy for an expensive object built by `factory()` on first attribute access,
+    e.g. an SDK client whose import or construction only some invocations need.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._target = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    self._target = self._factory()
+        return getattr(self._target, name)
+
+
+def lazy_import(name):
+    """
+    Returns module `name` without executing it; it is loaded on first attribute
+    access. For heavy libraries used only on some code paths. The first access
+    isn't thread-safe (LazyLoader before Python 3.12): call load_now() before
+    threads use the module.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+_import_lock = threading.Lock()
+
+
+def load_now(*modules):
+    """
+    Finishes loading lazy_import() modules. Call it before starting threads
+    that use them: on a concurrent first access LazyLoader lets other threads
+    see the module before it has executed ("has no attribute 'read_csv'").
+    """
+    with _import_lock:
+        for module in modules:
+            getattr(module, "__name__")
@@ -0,0 +1,124 @@
+"""
+Lightweight tracing for the Lambda handlers: timed spans and one-off metrics,
+written to stdout as CloudWatch Embedded Metric Format (EMF) JSON lines, so
+CloudWatch Logs turns them into metrics without any API calls. Deployed with
+the shared dependencies layer next to runtime.py.
+
+Every record has the Function and Stage dimensions; other values passed as
+properties are kept in the log line for Logs Insights but don't become metrics.
+"""
+import functools
+import json
+import os
+import random
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+# --- Metric settings ---
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "ShopSense")
+# Share of invocations that emit metrics (1 = all, 0 = off); decided once per invocation
+METRICS_SAMPLE_RATE = float(os.environ.get("METRICS_SAMPLE_RATE", "1"))
+
+_state = {
+    "function": os.environ.get("AWS_LAMBDA_FUNCTION_NAME", ""),
+    "sampled": METRICS_SAMPLE_RATE >= 1 or random.random() < METRICS_SAMPLE_RATE,
+}
+
+
+def peak_rss_mb():
+    """Memory high-water mark of this process so far."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 2**20 if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def unit(name):
+    if name.endswith("_ms"):
+        return "Milliseconds"
+    if name.endswith("_mb"):
+        return "Megabytes"
+    if name == "bytes" or name.startswith("bytes_") or name.endswith("_bytes"):
+        return "Bytes"
+    return "Count"
+
+
+def emit(stage, metrics, **properties):
+    """Writes one EMF record for `stage` if this invocation is sampled. Metric values must be numbers."""
+    if not _state["sampled"]:
+        return
+    values = {name: float(value) for name, value in metrics.items() if value is not None}
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [["Function", "Stage"]],
+                "Metrics": [{"Name": name, "Unit": unit(name)} for name in values],
+            }],
+        },
+        "Function": _state["function"],
+        "Stage": stage,
+        **properties,
+        **values,
+    }
+    print(json.dumps(record, default=str))
+
+
+class Span:
+    """Collects the metrics of one timed block; see span()."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.properties = {}
+
+    def set(self, **metrics):
+        self.metrics.update(metrics)
+
+    def add(self, **metrics):
+        for name, value in metrics.items():
+            self.metrics[name] = self.metrics.get(name, 0) + value
+
+    def tag(self, **properties):
+        self.properties.update(properties)
+
+
+@contextmanager
+def span(stage, **properties):
+    """
+    Times the block and emits duration_ms and peak_rss_mb for `stage`, plus
+    whatever the block records with span.set()/add()/tag(). A block that raises
+    is emitted with error=1.
+    """
+    current = Span()
+    current.tag(**properties)
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException:
+        current.set(error=1)
+        raise
+    finally:
+        if _state["sampled"]:
+            current.metrics.setdefault("duration_ms", round((time.perf_counter() - start) * 1000, 2))
+            current.metrics["peak_rss_mb"] = peak_rss_mb()
+            emit(stage, current.metrics, **current.properties)
+
+
+def instrument(function):
+    """
+    Decorator for a lambda_handler: sets the Function dimension, makes the
+    sampling decision for the invocation and wraps it in an "invocation" span.
+    """
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            _state["function"] = os.environ.get("AWS_LAMBDA_FUNCTION_NAME", function)
+            _state["sampled"] = METRICS_SAMPLE_RATE >= 1 or random.random() < METRICS_SAMPLE_RATE
+            with span("invocation", request_id=getattr(context, "aws_request_id", None)) as current:
+                response = handler(event, context)
+                if isinstance(response, dict) and "statusCode" in response:
+                    current.set(error=int(response["statusCode"] >= 500))
+                return response
+        return wrapper
+    return decorate